@@ -0,0 +1,601 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Fake libiMobileDevice backed by a local directory tree, plus a benchmark runner
+    usage: python fake_libimobiledevice.py [-h] [-c COMPARE] [-f FILE_SIZE] [-l LATENCY]
+                                           [-n OPS] [-o OUTPUT] [-p POOL_SIZES] [-r ROOT]
+                                           [-t LABEL] [-v] [-w BANDWIDTH]
+
+libiMobileDevice in this file implements the subset of the libimobiledevice glue
+used by the driver overlays, so driver I/O can be measured and regression-tested
+without an iDevice. Each container is a folder below root:
+    <root>/Media           mount_ios_media_folder()
+    <root>/Apps/<app_id>   mount_ios_app(app_id=<app_id>)
+
+Every AFC round trip sleeps for latency seconds, and every transferred byte is
+throttled to bandwidth bytes/second (0 = unthrottled). Clients made with clone()
+share one SharedLink, so concurrent transfers divide the bandwidth, as they
+do over one USB connection.
+
+To use it with a driver, replace
+    self.ios = libiMobileDevice(...)
+with
+    from fake_libimobiledevice import libiMobileDevice
+    self.ios = libiMobileDevice(root='/path/to/tree', latency=0.002, bandwidth=20*1024*1024)
+
+The benchmark runner reports ops/s and MB/s for each API, and the scaling of
+concurrent copies across 1..N cloned clients (the driver's AFCClientPool), and
+saves the results as JSON. Pass an earlier results file with -c to compare two
+versions.
+'''
+import argparse, json, os, platform, shutil, sys, tempfile, threading, time
+
+from collections import OrderedDict, defaultdict
+
+
+class libiMobileDeviceException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class libiMobileDeviceIOException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class FakeAFCFile(object):
+    '''
+    Read-only, seekable file-like object returned by libiMobileDevice.open_file().
+    Each read is one simulated AFC round trip
+    '''
+    def __init__(self, lib, path, local_path):
+        self.lib = lib
+        self.name = path
+        self.size = os.path.getsize(local_path)
+        self._f = open(local_path, 'rb')
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def read(self, n=-1):
+        data = self._f.read() if n is None or n < 0 else self._f.read(n)
+        self.lib._transfer(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        self.lib._transfer(n)
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+
+class SharedLink(object):
+    '''
+    Bandwidth shared by every client cloned from one libiMobileDevice.
+    Transfers are queued on the link, so N concurrent clients each see
+    1/N of the bandwidth, while their per-request latencies overlap
+    '''
+    def __init__(self, bandwidth=0):
+        self.bandwidth = bandwidth
+        self._free_at = 0.0
+        self._lock = threading.Lock()
+
+    def transfer(self, nbytes):
+        if not self.bandwidth or not nbytes:
+            return
+        with self._lock:
+            now = time.time()
+            self._free_at = max(now, self._free_at) + nbytes / float(self.bandwidth)
+            delay = self._free_at - now
+        time.sleep(delay)
+
+
+class libiMobileDevice():
+    '''
+    Drop-in replacement for the libimobiledevice glue, backed by a local folder
+    '''
+    # Client state saved by detach_session(), restored by attach_session()
+    SESSION_ATTRIBUTES = ('container', 'device_mounted')
+
+    # Default size of the buffer used by copy_to_idevice(), copy_from_idevice()
+    TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root=None, latency=0.0, bandwidth=0, installed_apps=None, **kwargs):
+        '''
+        root: folder holding the simulated containers, a temp folder if None
+        latency: seconds added to every AFC round trip
+        bandwidth: bytes/second for transfers, 0 for unthrottled
+        installed_apps: app_ids mount_ios_app() accepts, any app_id if None
+        link: SharedLink to share with other clients, overrides bandwidth
+        '''
+        self.link = kwargs.get('link') or SharedLink(bandwidth)
+        self.bandwidth = self.link.bandwidth
+        self.bytes_transferred = 0
+        self.calls = defaultdict(int)
+        self.container = None
+        self.device_connected = False
+        self.device_mounted = False
+        self.device_name = 'Fake iDevice'
+        self.handshakes = 0
+        self.installed_apps = installed_apps
+        self.latency = latency
+        self.root = root or tempfile.mkdtemp(prefix='fake_idevice_')
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size', self.TRANSFER_CHUNK_SIZE)
+        self.udid = 'f' * 40
+        self.verbose = kwargs.get('verbose', False)
+
+    # ~~~ Connection ~~~
+    def attach_session(self, session):
+        for attr in self.SESSION_ATTRIBUTES:
+            setattr(self, attr, session[attr])
+
+    def clone(self):
+        '''
+        Return a new, unmounted client on the same device and link
+        '''
+        return libiMobileDevice(root=self.root, latency=self.latency,
+            installed_apps=self.installed_apps, link=self.link,
+            transfer_chunk_size=self.transfer_chunk_size, verbose=self.verbose)
+
+    def close_session(self, session):
+        '''
+        Free a session returned by detach_session(), leaving the current session
+        and device connection untouched
+        '''
+        self._log_location(session['container'])
+
+    def connect_idevice(self):
+        self._handshake('connect_idevice')
+        self.device_connected = True
+        return self.device_connected
+
+    def detach_session(self):
+        session = dict((attr, getattr(self, attr)) for attr in self.SESSION_ATTRIBUTES)
+        self.container = None
+        self.device_mounted = False
+        return session
+
+    def disconnect_idevice(self):
+        self._log_location()
+        self.container = None
+        self.device_connected = False
+        self.device_mounted = False
+
+    def dismount_ios_media_folder(self):
+        self.disconnect_idevice()
+
+    def get_device_info(self):
+        self.device_info = self._afc_get_device_info()
+        return self.device_info
+
+    def get_device_list(self):
+        return [self.udid]
+
+    def get_preferences(self, requested_items=None):
+        self._round_trip('get_preferences')
+        return {'DeviceName': self.device_name,
+                'ProductType': 'iPad2,5',
+                'ProductVersion': '7.0',
+                'UniqueDeviceID': self.udid}
+
+    def mount_ios_app(self, app_name=None, app_id=None):
+        self._handshake('mount_ios_app')
+        app_id = app_id or app_name
+        self.device_mounted = False
+        if self.installed_apps is None or app_id in self.installed_apps:
+            self.container = os.path.join(self.root, 'Apps', app_id)
+            if not os.path.isdir(self.container):
+                os.makedirs(self.container)
+            self.device_mounted = True
+        self._log_location("{0} mounted: {1}".format(app_id, self.device_mounted))
+        return self.device_mounted
+
+    def mount_ios_media_folder(self):
+        self._handshake('mount_ios_media_folder')
+        self.container = os.path.join(self.root, 'Media')
+        if not os.path.isdir(self.container):
+            os.makedirs(self.container)
+        self.device_mounted = True
+
+    # ~~~ File operations ~~~
+    def copy_from_idevice(self, src, dst, chunk_size=None):
+        self._log_location("{0}".format(repr(src)))
+        chunk_size = chunk_size or self.transfer_chunk_size
+        local = self._local_path(src)
+        if not os.path.isfile(local):
+            self._round_trip('copy_from_idevice')
+            self._log(" could not open file")
+            raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(src)))
+        self.calls['copy_from_idevice'] += 1
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        with open(local, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                self._transfer(n)
+                if not n:
+                    break
+                dst.write(view[:n])
+        dst.close()
+        mtime = os.path.getmtime(local)
+        os.utime(dst.name, (mtime, mtime))
+
+    def copy_to_idevice(self, src, dst, chunk_size=None):
+        self._log_location("src:{0} dst:{1}".format(repr(src), repr(dst)))
+        chunk_size = chunk_size or self.transfer_chunk_size
+        local = self._local_path(dst)
+        if not os.path.isdir(os.path.dirname(local)):
+            self._round_trip('copy_to_idevice')
+            self._log(" could not create copy")
+            raise libiMobileDeviceIOException("could not open file {0} for writing".format(repr(dst)))
+        self.calls['copy_to_idevice'] += 1
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        with open(src, 'rb') as f, open(local, 'wb') as out:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                self._transfer(n)
+                out.write(view[:n])
+
+    def exists(self, path, silent=False):
+        return self.stat(path)
+
+    def get_folder_size(self, path):
+        self._log_location(path)
+        total = int(self.stat(path).get('st_size', 0))
+        for dirpath, dirnames, filenames in os.walk(self._local_path(path)):
+            for name in dirnames + filenames:
+                self._round_trip('get_folder_size')
+                total += os.path.getsize(os.path.join(dirpath, name))
+        return total
+
+    def listdir(self, path, get_stats=True):
+        self._round_trip('listdir')
+        local = self._local_path(path)
+        ans = {}
+        if not os.path.isdir(local):
+            self._log(" ERROR: AFC_E_OBJECT_NOT_FOUND directory: {0}".format(repr(path)))
+            return ans
+        for name in os.listdir(local):
+            if name.startswith('.'):
+                continue
+            ans[name] = self._stat('/'.join([path.rstrip('/'), name])) if get_stats else {}
+            if get_stats:
+                self._round_trip('stat')
+        return ans
+
+    def mkdir(self, path):
+        self._round_trip('mkdir')
+        local = self._local_path(path)
+        if not os.path.isdir(local):
+            os.mkdir(local)
+
+    def open_file(self, path):
+        self._round_trip('open_file')
+        local = self._local_path(path)
+        if not os.path.isfile(local):
+            raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(path)))
+        return FakeAFCFile(self, path, local)
+
+    def read(self, path, mode='r'):
+        self._round_trip('read')
+        local = self._local_path(path)
+        if not os.path.isfile(local):
+            self._log(" could not open file")
+            raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(path)))
+        with open(local, 'rb') as f:
+            data = f.read()
+        self._transfer(len(data))
+        return bytearray(data) if 'b' in mode else data
+
+    def read_range(self, path, offset, length):
+        self._round_trip('read_range')
+        local = self._local_path(path)
+        if not os.path.isfile(local):
+            raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(path)))
+        with open(local, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        self._transfer(len(data))
+        return data
+
+    def remove(self, path):
+        '''
+        Return True if path was removed, as the glue does
+        '''
+        self._round_trip('remove')
+        local = self._local_path(path)
+        try:
+            if os.path.isdir(local):
+                os.rmdir(local)
+            else:
+                os.remove(local)
+        except OSError as e:
+            self._log(" ERROR: {0} path:{1}".format(e, repr(path)))
+            return False
+        return True
+
+    def rename(self, from_name, to_name):
+        self._round_trip('rename')
+        os.rename(self._local_path(from_name), self._local_path(to_name))
+
+    def stat(self, path):
+        '''
+        Same shape as the glue: sizes as strings, times as floats, {} if missing
+        '''
+        self._round_trip('stat')
+        return self._stat(path)
+
+    def stat_many(self, paths):
+        '''
+        One pipelined round trip for all paths
+        '''
+        self._round_trip('stat_many')
+        return dict((path, self._stat(path)) for path in paths)
+
+    def write(self, content, destination, mode='w'):
+        self._round_trip('write')
+        local = self._local_path(destination)
+        if not os.path.isdir(os.path.dirname(local)):
+            raise libiMobileDeviceIOException("could not open file for writing")
+        with open(local, 'wb') as f:
+            f.write(content if 'b' in mode else content.encode('utf-8'))
+        self._transfer(len(content))
+
+    # ~~~ Helpers ~~~
+    def _afc_get_device_info(self):
+        '''
+        Same shape as the glue: {'Model', 'FSTotalBytes', 'FSFreeBytes', 'FSBlockSize'}
+        '''
+        self._round_trip('get_device_info')
+        st = os.statvfs(self.root) if hasattr(os, 'statvfs') else None
+        return {'Model': 'iPad2,5',
+                'FSTotalBytes': str(st.f_blocks * st.f_frsize) if st else '0',
+                'FSFreeBytes': str(st.f_bavail * st.f_frsize) if st else '0',
+                'FSBlockSize': '4096'}
+
+    def _handshake(self, name):
+        self.handshakes += 1
+        self._round_trip(name)
+
+    def _local_path(self, path):
+        if self.container is None:
+            raise libiMobileDeviceException("no container mounted")
+        return os.path.join(self.container, *[p for p in path.split('/') if p])
+
+    def _log(self, msg=None):
+        if self.verbose:
+            print(msg or '')
+
+    def _log_location(self, *args):
+        if self.verbose:
+            print("{0}:{1}({2})".format(self.__class__.__name__,
+                sys._getframe(1).f_code.co_name, args[0] if args else ''))
+
+    def _round_trip(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _stat(self, path):
+        local = self._local_path(path)
+        try:
+            st = os.stat(local)
+        except OSError:
+            return {}
+        return {'st_size': str(st.st_size),
+                'st_blocks': str(getattr(st, 'st_blocks', 0)),
+                'st_nlink': str(st.st_nlink),
+                'st_ifmt': 'S_IFDIR' if os.path.isdir(local) else 'S_IFREG',
+                'st_mtime': st.st_mtime,
+                'st_birthtime': st.st_ctime}
+
+    def _transfer(self, nbytes):
+        '''
+        One AFC round trip carrying nbytes
+        '''
+        self.bytes_transferred += nbytes
+        if self.latency:
+            time.sleep(self.latency)
+        self.link.transfer(nbytes)
+
+
+class TransferBenchmark(object):
+    '''
+    Time each fake glue API, report ops/s and MB/s, save results as JSON
+    '''
+    APP_ID = 'com.example.benchmark'
+
+    def __init__(self):
+        self._init_parser()
+
+    def _init_parser(self):
+        parser = argparse.ArgumentParser(description="Benchmark the fake libiMobileDevice glue")
+        parser.add_argument('-c', '--compare', default=None, help='earlier results JSON to compare against')
+        parser.add_argument('-f', '--file_size', default=4, type=float, help='MB per file for copy benchmarks (default 4)')
+        parser.add_argument('-l', '--latency', default=0.002, type=float, help='seconds per AFC round trip (default 0.002)')
+        parser.add_argument('-n', '--ops', default=100, type=int, help='operations per API (default 100)')
+        parser.add_argument('-o', '--output', default='afc_benchmark.json', help='results JSON (default afc_benchmark.json)')
+        parser.add_argument('-p', '--pool_sizes', default='1,2,3,4,6,8', help='client counts for the pool scaling curve (default 1,2,3,4,6,8)')
+        parser.add_argument('-r', '--root', default=None, help='folder for the simulated device (default temp folder)')
+        parser.add_argument('-t', '--label', default='', help='label stored with the results, e.g. plugin version')
+        parser.add_argument('-v', '--verbose', default=False, action='store_true', help='log every glue call')
+        parser.add_argument('-w', '--bandwidth', default=20, type=float, help='MB/s transfer rate, 0 for unthrottled (default 20)')
+        self.args = parser.parse_args()
+
+    def run(self):
+        args = self.args
+        root = args.root or tempfile.mkdtemp(prefix='fake_idevice_')
+        self.ios = libiMobileDevice(root=root, latency=args.latency,
+            bandwidth=int(args.bandwidth * 1024 * 1024), verbose=args.verbose)
+        self.ios.mount_ios_app(app_id=self.APP_ID)
+        self.ios.mkdir('/bench')
+
+        file_size = int(args.file_size * 1024 * 1024)
+        local = tempfile.NamedTemporaryFile(delete=False)
+        local.write(os.urandom(file_size))
+        local.close()
+        self.ios.copy_to_idevice(local.name, '/bench/large.bin')
+        self.ios.write(os.urandom(4096), '/bench/small.bin', mode='wb')
+        for i in range(50):
+            self.ios.write('x', '/bench/item_%03d.txt' % i)
+
+        n = args.ops
+        copies = max(1, n // 20)
+        results = OrderedDict()
+        try:
+            results['stat'] = self._time(n, lambda i: self.ios.stat('/bench/small.bin'))
+            results['stat_many'] = self._time(n, lambda i: self.ios.stat_many(
+                ['/bench/item_%03d.txt' % j for j in range(50)]))
+            results['exists'] = self._time(n, lambda i: self.ios.exists('/bench/missing.bin'))
+            results['listdir'] = self._time(n, lambda i: self.ios.listdir('/bench'))
+            results['read'] = self._time(n, lambda i: self.ios.read('/bench/small.bin', mode='rb'))
+            results['read_range'] = self._time(n, lambda i: self.ios.read_range('/bench/large.bin', i * 65536 % file_size, 65536))
+            results['write'] = self._time(n, lambda i: self.ios.write(bytearray(4096), '/bench/w_%d.bin' % i, mode='wb'))
+            results['rename'] = self._time(n, lambda i: self.ios.rename('/bench/w_%d.bin' % i, '/bench/r_%d.bin' % i))
+            results['remove'] = self._time(n, lambda i: self.ios.remove('/bench/r_%d.bin' % i))
+            results['mkdir'] = self._time(n, lambda i: self.ios.mkdir('/bench/d_%d' % i))
+            results['copy_to_idevice'] = self._time(copies, lambda i: self.ios.copy_to_idevice(local.name, '/bench/c_%d.bin' % i))
+            results['copy_from_idevice'] = self._time(copies, lambda i: self._copy_from('/bench/large.bin'))
+            results['mount_ios_app'] = self._time(n, lambda i: self.ios.mount_ios_app(app_id=self.APP_ID))
+            scaling = self._pool_scaling([int(c) for c in args.pool_sizes.split(',')], n)
+        finally:
+            os.remove(local.name)
+            if not args.root:
+                shutil.rmtree(root, ignore_errors=True)
+
+        report = OrderedDict([
+            ('label', args.label),
+            ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('platform', platform.platform()),
+            ('python', platform.python_version()),
+            ('latency', args.latency),
+            ('bandwidth_mb', args.bandwidth),
+            ('file_size_mb', args.file_size),
+            ('results', results),
+            ('pool_scaling', scaling)])
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        previous = None
+        if args.compare:
+            with open(args.compare) as f:
+                previous = json.load(f).get('results', {})
+        self._report(results, previous)
+        self._report_scaling(scaling)
+        print("results saved to {0}".format(args.output))
+
+    def _copy_from(self, path):
+        out = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            self.ios.copy_from_idevice(path, out)
+        finally:
+            os.remove(out.name)
+
+    def _pool_scaling(self, sizes, ops):
+        '''
+        Time ops 256 KB book copies spread over 1..N cloned clients, as
+        AFCClientPool.map() does. Speedup is relative to one client
+        '''
+        local = tempfile.NamedTemporaryFile(delete=False)
+        local.write(os.urandom(256 * 1024))
+        local.close()
+        curve = []
+        try:
+            for size in sizes:
+                clients = []
+                for c in range(size):
+                    ios = self.ios.clone()
+                    ios.mount_ios_app(app_id=self.APP_ID)
+                    clients.append(ios)
+                jobs = list(range(ops))
+                lock = threading.Lock()
+
+                def _run(ios):
+                    while True:
+                        with lock:
+                            if not jobs:
+                                return
+                            i = jobs.pop()
+                        ios.copy_to_idevice(local.name, '/bench/p_%d.bin' % i)
+
+                start = time.time()
+                threads = [threading.Thread(target=_run, args=(client,)) for client in clients]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.time() - start
+                nbytes = sum(client.bytes_transferred for client in clients)
+                curve.append(OrderedDict([
+                    ('clients', size),
+                    ('seconds', round(elapsed, 4)),
+                    ('ops_per_sec', ops / elapsed if elapsed else 0.0),
+                    ('mb_per_sec', nbytes / elapsed / (1024 * 1024) if elapsed else 0.0),
+                    ('speedup', (curve[0]['seconds'] / elapsed) if curve and elapsed else 1.0)]))
+        finally:
+            os.remove(local.name)
+        return curve
+
+    def _report(self, results, previous=None):
+        print("{0:<20} {1:>8} {2:>12} {3:>10}{4}".format('api', 'ops', 'ops/s', 'MB/s',
+            " {0:>10}".format('vs prev') if previous else ''))
+        for api, r in results.items():
+            line = "{0:<20} {1:>8} {2:>12.1f} {3:>10.2f}".format(api, r['ops'], r['ops_per_sec'], r['mb_per_sec'])
+            if previous and api in previous and previous[api]['ops_per_sec']:
+                line += " {0:>9.2f}x".format(r['ops_per_sec'] / previous[api]['ops_per_sec'])
+            print(line)
+
+    def _report_scaling(self, curve):
+        print("{0:<20} {1:>8} {2:>12} {3:>10} {4:>10}".format('pool clients', '', 'ops/s', 'MB/s', 'speedup'))
+        for point in curve:
+            print("{0:<20} {1:>8} {2:>12.1f} {3:>10.2f} {4:>9.2f}x".format(point['clients'], '',
+                point['ops_per_sec'], point['mb_per_sec'], point['speedup']))
+
+    def _time(self, ops, func):
+        '''
+        Run func(i) ops times, return timings and throughput
+        '''
+        transferred = self.ios.bytes_transferred
+        start = time.time()
+        for i in range(ops):
+            func(i)
+        elapsed = time.time() - start
+        nbytes = self.ios.bytes_transferred - transferred
+        return OrderedDict([
+            ('ops', ops),
+            ('seconds', round(elapsed, 4)),
+            ('ops_per_sec', ops / elapsed if elapsed else 0.0),
+            ('bytes', nbytes),
+            ('mb_per_sec', nbytes / elapsed / (1024 * 1024) if elapsed else 0.0)])
+
+
+def main():
+    TransferBenchmark().run()
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ from calibre import fit_image
 from calibre.devices.idevice.parse_xml import XmlPropertyListParser
 from calibre.utils.zipfile import ZipFile
 
-from calibre_plugins.ios_reader_apps import Book, BookList
+from calibre_plugins.ios_reader_apps import AFCSessionManager, Book, BookList
 
 NSTimeIntervalSince1970 = 978307200.0
 
@@ -25,6 +25,10 @@ def books(self, oncard=None, end_session=True):
     @return: A BookList.
 
     '''
+    def _book_path(asset_url):
+        path = asset_url[asset_url.find('Media/') + len('Media'):-1]
+        return path.replace('%20', ' ')
+
     if oncard:
         return BookList()
 
@@ -39,157 +43,154 @@ def books(self, oncard=None, end_session=True):
     db_profile = self._localize_database_path(self.books_subpath)
     con = sqlite3.connect(db_profile['path'])
 
-    # Mount the Media folder
-    self.ios.mount_ios_media_folder()
-
-    # Get Books.plist so we can find the covers
-    books_plist = {}
-
-    if True:
-        raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Sync/Books.plist'))['Books']
-        for book in raw_plist:
-            if not 'Path' in book:
-                print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
-                #print(book)
-                #print
-                continue
-
-            if 'Cover Path' in book:
-                    books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', book['Path'], book['Cover Path']]))
-            else:
-                books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
-
-        # Process any outliers
-        raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Books.plist'))['Books']
-        for book in raw_plist:
-            if not 'Path' in book:
-                print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
-                #print(book)
-                #print
-                continue
-
-            # Don't overwrite existing cover_paths
-            if not '/'.join(['/Books', book['Path']]) in books_plist:
-                if 'Cover Path' in book and not ['/'.join(['/Books', book['Path']])] in book_plist:
+    # Hold the Media folder for the scan
+    with self.afc_sessions.session(AFCSessionManager.MEDIA):
+        # Get Books.plist so we can find the covers
+        books_plist = {}
+
+        if True:
+            raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Sync/Books.plist'))['Books']
+            for book in raw_plist:
+                if not 'Path' in book:
+                    print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
+                    #print(book)
+                    #print
+                    continue
+
+                if 'Cover Path' in book:
                         books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', book['Path'], book['Cover Path']]))
                 else:
                     books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
 
-        raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Purchases/Purchases.plist'))['Books']
-        for book in raw_plist:
-            if not 'Path' in book:
-                print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
-                print(book)
-                print
-                continue
+            # Process any outliers
+            raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Books.plist'))['Books']
+            for book in raw_plist:
+                if not 'Path' in book:
+                    print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
+                    #print(book)
+                    #print
+                    continue
+
+                # Don't overwrite existing cover_paths
+                if not '/'.join(['/Books', book['Path']]) in books_plist:
+                    if 'Cover Path' in book and not ['/'.join(['/Books', book['Path']])] in book_plist:
+                            books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', book['Path'], book['Cover Path']]))
+                    else:
+                        books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
+
+            raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Purchases/Purchases.plist'))['Books']
+            for book in raw_plist:
+                if not 'Path' in book:
+                    print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
+                    print(book)
+                    print
+                    continue
+
+                # Don't overwrite existing cover_paths
+                if not '/'.join(['/Books', book['Path']]) in books_plist:
+                    if 'Cover Path' in book:
+                            books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books/Purchases', book['Path'], book['Cover Path']]))
+                    else:
+                        books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
+
+        else:
+            raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Books.plist'))['Books']
+            for book in raw_plist:
+                if not 'Path' in book:
+                    print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
+                    print(book)
+                    print
+                    continue
+
+                if 'Cover Path' in book:
+                        books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', book['Path'], book['Cover Path']]))
+                else:
+                    books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
+
+            raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Purchases/Purchases.plist'))['Books']
+            for book in raw_plist:
+                if not 'Path' in book:
+                    print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
+                    print(book)
+                    print
+                    continue
 
-            # Don't overwrite existing cover_paths
-            if not '/'.join(['/Books', book['Path']]) in books_plist:
                 if 'Cover Path' in book:
                         books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books/Purchases', book['Path'], book['Cover Path']]))
                 else:
                     books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
 
-    else:
-        raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Books.plist'))['Books']
-        for book in raw_plist:
-            if not 'Path' in book:
-                print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
-                print(book)
-                print
-                continue
-
-            if 'Cover Path' in book:
-                    books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', book['Path'], book['Cover Path']]))
-            else:
-                books_plist['/'.join(['/Books', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
-
-        raw_plist = XmlPropertyListParser().parse(self.ios.read('/Books/Purchases/Purchases.plist'))['Books']
-        for book in raw_plist:
-            if not 'Path' in book:
-                print(" No 'Path' element found for '%s' by '%s'" % (book['Name'], book['Artist']))
-                print(book)
-                print
-                continue
-
-            if 'Cover Path' in book:
-                    books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books/Purchases', book['Path'], book['Cover Path']]))
-            else:
-                books_plist['/'.join(['/Books/Purchases', book['Path']])] = unicode('/'.join(['/Books', 'Sync', 'Artwork', book['Persistent ID']]))
-
-    print(books_plist)
+        print(books_plist)
+
+        with con:
+            con.row_factory = sqlite3.Row
+            # Build a collection map
+            collections_map = {}
+
+            # Get the books
+            cur = con.cursor()
+            #cur.execute("ATTACH DATABASE '{0}' as 'ASSETS'".format(assets_profile['path'])
+
+            cur.execute('''SELECT ZASSETURL,
+                                  ZBOOKAUTHOR,
+                                  ZSORTAUTHOR,
+                                  ZBOOKTITLE,
+                                  ZSORTTITLE,
+                                  ZDATABASEKEY,
+                                  ZDATEADDED
+                           FROM ZBKBOOKINFO
+                           WHERE ZASSETURL LIKE 'file://localhost%' AND
+                                 ZASSETURL LIKE '%.epub/'
+                        ''')
+            rows = cur.fetchall()
+            book_count = len(rows)
+
+            # Folder sizes are reused while a book folder's mtime is unchanged
+            folder_index = self._load_folder_index()
+            book_paths = [_book_path(row[b'ZASSETURL']) for row in rows]
+            folder_stats = self._stat_many(book_paths)
+            refreshed = {}
+
+            for i, row in enumerate(rows):
+                book_id = row[b'ZDATABASEKEY']
+
+                # Get the collection assignments
+                collections = []
+
+                # Get the primary metadata
+                this_book = Book(row[b'ZBOOKTITLE'], row[b'ZBOOKAUTHOR'])
+                this_book.path = book_paths[i]
+                timestamp = int(row[b'ZDATEADDED']) + NSTimeIntervalSince1970
+                this_book.datetime = datetime.fromtimestamp(timestamp).timetuple()
+                this_book.device_collections = collections
+                this_book.uuid = None
+                this_book.thumbnail = self._generate_thumbnail(this_book, books_plist[this_book.path])
+
+                # Retrieve folder size from the index, or compute it if the folder changed
+                mtime = (folder_stats.get(this_book.path) or {}).get('st_mtime')
+                cached = folder_index.get(this_book.path)
+                if cached and mtime is not None and cached[0] == mtime:
+                    this_book.size = cached[1]
+                else:
+                    self._log_diagnostic("computing folder size for '%s'" % this_book.path)
+                    this_book.size = self.ios.get_folder_size(this_book.path)
+                    refreshed[this_book.path] = (mtime, this_book.size)
 
-    with con:
-        con.row_factory = sqlite3.Row
-        # Build a collection map
-        collections_map = {}
-
-        # Get the books
-        cur = con.cursor()
-        #cur.execute("ATTACH DATABASE '{0}' as 'ASSETS'".format(assets_profile['path'])
-
-        cur.execute('''SELECT ZASSETURL,
-                              ZBOOKAUTHOR,
-                              ZSORTAUTHOR,
-                              ZBOOKTITLE,
-                              ZSORTTITLE,
-                              ZDATABASEKEY,
-                              ZDATEADDED
-                       FROM ZBKBOOKINFO
-                       WHERE ZASSETURL LIKE 'file://localhost%' AND
-                             ZASSETURL LIKE '%.epub/'
-                    ''')
-        rows = cur.fetchall()
-        book_count = len(rows)
-        for i, row in enumerate(rows):
-            book_id = row[b'ZDATABASEKEY']
-
-            # Get the collection assignments
-            collections = []
-
-            # Get the primary metadata
-            this_book = Book(row[b'ZBOOKTITLE'], row[b'ZBOOKAUTHOR'])
-            original_path = row[b'ZASSETURL']
-            path = original_path[original_path.find('Media/') + len('Media'):-1]
-            this_book.path = path.replace('%20', ' ')
-            timestamp = int(row[b'ZDATEADDED']) + NSTimeIntervalSince1970
-            this_book.datetime = datetime.fromtimestamp(timestamp).timetuple()
-            this_book.device_collections = collections
-            this_book.uuid = None
-            this_book.thumbnail = self._generate_thumbnail(this_book, books_plist[this_book.path])
-
-            # Retrieve folder size from cache or compute and cache
-            try:
-                zfr = ZipFile(self.folder_archive_path)
-                file_size = zfr.read(this_book.path)
-                this_book.size = int(file_size)
-                self._log_diagnostic("returning folder size from cache")
-            except:
-                self._log_diagnostic("opening folder cache for appending")
-                zfw = ZipFile(self.folder_archive_path, mode='a')
-                stats = self.ios.stat(this_book.path)
-                this_book.size = self.ios.get_folder_size(this_book.path)
-                zfw.writestr(this_book.path, str(this_book.size))
-                zfw.close()
-            finally:
-                zfr.close()
-
-            booklist.add_book(this_book, False)
-
-            if self.report_progress is not None:
-                self.report_progress(float((i + 1)*100 / book_count)/100,
-                    '%(num)d of %(tot)d' % dict(num=i + 1, tot=book_count))
-
-            cached_books[this_book.path] = {
-                'title': this_book.title,
-                'author': this_book.author,
-                'authors': this_book.author.split(' & '),
-                'uuid': this_book.uuid
-                }
-        cur.close()
-
-    # Close the connection
-    self.ios.dismount_ios_media_folder()
+                booklist.add_book(this_book, False)
+
+                if self.report_progress is not None:
+                    self.report_progress(float((i + 1)*100 / book_count)/100,
+                        '%(num)d of %(tot)d' % dict(num=i + 1, tot=book_count))
+
+                cached_books[this_book.path] = {
+                    'title': this_book.title,
+                    'author': this_book.author,
+                    'authors': this_book.author.split(' & '),
+                    'uuid': this_book.uuid
+                    }
+            cur.close()
+
+        self._save_folder_index(refreshed, book_paths)
 
     if self.report_progress is not None:
         self.report_progress(1.0, _('finished'))
@@ -296,16 +297,65 @@ def _initialize_overlay(self):
     self.assets_subpath = '/Media/Books/Sync/Database/OutstandingAssets_4.sqlite'
     self.books_subpath = '/Documents/BKLibrary_database/iBooks_*.sqlite'
 
-    # Confirm/create folder size archive
+    # Confirm/create folder size index
     if not os.path.exists(self.cache_dir):
         self._log_diagnostic("creating folder cache at '%s'" % self.cache_dir)
         os.makedirs(self.cache_dir)
 
-    self.folder_archive_path = os.path.join(self.cache_dir, "folders.zip")
-    if not os.path.exists(self.folder_archive_path):
-        self._log_diagnostic("creating folder cache")
-        zfw = ZipFile(self.folder_archive_path, mode='w', compression=0)
-        zfw.writestr("%s Folder Size Archive" % self.name, '')
-        zfw.close()
-    else:
-        self._log_diagnostic("existing folder cache at '%s'" % self.folder_archive_path)
+    # Superseded by the per-device folder size index
+    for legacy in ["folders.zip", "folder_sizes.db"]:
+        legacy_path = os.path.join(self.cache_dir, legacy)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+def _folder_index_path(self):
+    '''
+    Return the path of the connected device's folder size index, creating it as needed.
+    Each device has its own index, so pruning one device's deleted books
+    leaves other devices' sizes intact
+    '''
+    udid = (self.device_profile or {}).get('UniqueDeviceID', 0)
+    path = os.path.join(self.cache_dir, "folder_sizes_%s.db" % udid)
+    if not os.path.exists(path):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        con = sqlite3.connect(path)
+        with con:
+            con.execute('''CREATE TABLE IF NOT EXISTS folder_sizes
+                            (path TEXT PRIMARY KEY,
+                             mtime REAL,
+                             size INTEGER)''')
+        con.close()
+        self._log_diagnostic("folder size index at '%s'" % path)
+    return path
+
+def _load_folder_index(self):
+    '''
+    Return {path: (mtime, size)} from the folder size index.
+    A folder's mtime changes only when its own entries are added, removed or
+    renamed, not when a file in a nested folder is rewritten in place, so a
+    size may be stale until the book folder itself changes
+    '''
+    con = sqlite3.connect(self._folder_index_path())
+    index = dict((row[0], (row[1], row[2])) for row in
+                 con.execute('SELECT path, mtime, size FROM folder_sizes'))
+    con.close()
+    self._log_diagnostic("%d folder sizes indexed" % len(index))
+    return index
+
+def _save_folder_index(self, refreshed, current_paths):
+    '''
+    Store refreshed {path: (mtime, size)}, drop folders no longer on the device
+    '''
+    con = sqlite3.connect(self._folder_index_path())
+    with con:
+        con.executemany('''INSERT OR REPLACE INTO folder_sizes (path, mtime, size)
+                           VALUES (?, ?, ?)''',
+                        [(path, mtime, size) for path, (mtime, size) in refreshed.items()
+                         if mtime is not None])
+        current_paths = set(current_paths)
+        stale = [row[0] for row in con.execute('SELECT path FROM folder_sizes')
+                 if row[0] not in current_paths]
+        con.executemany('DELETE FROM folder_sizes WHERE path = ?', [(path,) for path in stale])
+    con.close()
+    self._log_diagnostic("folder sizes refreshed: %d removed: %d" % (len(refreshed), len(stale)))
@@ -3,7 +3,7 @@
 
 '''
 Test suite for libiMobileDevice
-    usage: calibre-debug lib_test.py -- [-h] [-b] [-d] [-f] [-i] [-l] [-m] [-v]
+    usage: calibre-debug lib_test.py -- [-h] [-b] [-d] [-f] [-i] [-l] [-m] [-s] [-t] [-v]
 
 Use this code to test changes to the libimobiledevice glue code, which is distributed
 as part of the calibre executable. By default, the test suite uses the glue code
@@ -95,6 +95,69 @@ class TestSuite(object, Logger):
                     return repr(self.value)
 
 
+            class AFCFile(object):
+                '''
+                Read-only, seekable file-like object over an open AFC handle,
+                returned by libiMobileDevice.open_file().
+                Bytes are read from the device as requested, so ZipFile and the
+                metadata readers can consume large files without loading them whole
+                '''
+                def __init__(self, lib, path, handle, size):
+                    self.closed = False
+                    self.handle = handle
+                    self.lib = lib
+                    self.name = path
+                    self.size = size
+                    self._pos = 0
+
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *args):
+                    self.close()
+
+                def close(self):
+                    if not self.closed:
+                        self.lib._afc_file_close(self.handle)
+                        self.closed = True
+
+                def read(self, n=-1):
+                    if n is None or n < 0:
+                        n = self.size - self._pos
+                    n = max(0, min(n, self.size - self._pos))
+                    if not n:
+                        return b''
+                    buf = bytearray(n)
+                    return bytes(buf[:self.readinto(buf)])
+
+                def readinto(self, b):
+                    '''
+                    Fill bytearray b from the current position, return bytes read
+                    '''
+                    size = min(len(b), self.size - self._pos)
+                    total = 0
+                    while total < size:
+                        n = self.lib._afc_file_read_into(self.handle, b, size - total, total)
+                        if n <= 0:
+                            break
+                        total += n
+                    self._pos += total
+                    return total
+
+                def seek(self, offset, whence=os.SEEK_SET):
+                    if whence == os.SEEK_CUR:
+                        offset += self._pos
+                    elif whence == os.SEEK_END:
+                        offset += self.size
+                    offset = max(0, offset)
+                    if offset != self._pos:
+                        self.lib._afc_file_seek(self.handle, offset)
+                        self._pos = offset
+
+                def tell(self):
+                    return self._pos
+
+
             class AFC_CLIENT_T(Structure):
                 '''
                 http://www.libimobiledevice.org/docs/html/structafc__client__private.html
@@ -234,6 +297,12 @@ class TestSuite(object, Logger):
                 # Location reporting template
                 LOCATION_TEMPLATE = "{cls}:{func}({arg1}) {arg2}"
 
+                # Client state saved by detach_session(), restored by attach_session()
+                SESSION_ATTRIBUTES = ('afc', 'control', 'device', 'device_mounted', 'house_arrest')
+
+                # Default size of the buffer used by copy_to_idevice(), copy_from_idevice()
+                TRANSFER_CHUNK_SIZE = 1024 * 1024
+
                 # iDevice udid string
                 UDID_SIZE = 40
 
@@ -256,10 +325,44 @@ class TestSuite(object, Logger):
                     self.house_arrest = None
                     self.installed_apps = None
                     self.instproxy = None
+                    self.transfer_chunk_size = kwargs.get('transfer_chunk_size', self.TRANSFER_CHUNK_SIZE)
 
                     self.load_library()
 
                 # ~~~ Public methods ~~~
+                def attach_session(self, session):
+                    '''
+                    Make a session returned by detach_session() current again.
+                    Any current session must have been detached first
+                    '''
+                    self._log_location()
+                    for attr in self.SESSION_ATTRIBUTES:
+                        setattr(self, attr, session[attr])
+
+                def clone(self):
+                    '''
+                    Return a new, unconnected instance for an additional AFC client
+                    '''
+                    return self.__class__(verbose=self.verbose)
+
+                def close_session(self, session):
+                    '''
+                    Free the AFC, house_arrest and idevice handles of a session returned
+                    by detach_session(). The current session and connection state
+                    (device_connected, device_name) are left untouched
+                    '''
+                    self._log_location()
+                    current = self.detach_session()
+                    self.attach_session(session)
+                    try:
+                        if self.device_mounted:
+                            self._afc_client_free()
+                            if self.house_arrest is not None:
+                                self._house_arrest_client_free()
+                            self._idevice_free()
+                    finally:
+                        self.attach_session(current)
+
                 def connect_idevice(self):
                     '''
                     Convenience method to get iDevice ready to talk
@@ -278,98 +381,98 @@ class TestSuite(object, Logger):
 
                     return self.device_connected
 
-                def copy_to_idevice(self, src, dst):
+                def copy_to_idevice(self, src, dst, chunk_size=None):
                     '''
                     High-level convenience method to copy src from local filesystem to
                     dst on iDevice.
                     Assumed to be a binary file (epub, sqlite, etc)
                     src: file on local filesystem
                     dst: file to be created on iOS filesystem
+                    chunk_size: transfer buffer size, default self.transfer_chunk_size
+                    The file is read into a single preallocated buffer, which AFC
+                    writes from in place
                     '''
                     self._log_location("src:{0} dst:{1}".format(repr(src), repr(dst)))
 
-                    BUFFER_SIZE = 10 * 1024 * 1024
-
+                    chunk_size = chunk_size or self.transfer_chunk_size
                     handle = self._afc_file_open(str(dst), mode='wb')
-                    if handle is not None:
-                        # Get the file size
-                        file_stats = os.stat(src)
-                        file_size = file_stats.st_size
-                        self._log("file_size: {:,} bytes".format(file_size))
-                        if file_size > BUFFER_SIZE:
-                            bytes_remaining = file_size
-                            with open(src, 'rb') as f:
-                                while bytes_remaining:
-                                    if bytes_remaining > BUFFER_SIZE:
-                                        self._log("copying {:,} byte chunk".format(BUFFER_SIZE))
-                                        content = bytearray(f.read(BUFFER_SIZE))
-                                        success = self._afc_file_write(handle, content, mode='wb')
-                                        bytes_remaining -= BUFFER_SIZE
-                                    else:
-                                        self._log("copying final {:,} bytes".format(bytes_remaining))
-                                        content = bytearray(f.read(bytes_remaining))
-                                        success = self._afc_file_write(handle, content, mode='wb')
-                                        bytes_remaining = 0
-                                        self._log(" success: {0}".format(success))
-                        else:
-                            with open(src, 'rb') as f:
-                                content = bytearray(f.read())
-                            handle = self._afc_file_open(str(dst), mode='wb')
-                            if handle is not None:
-                                success = self._afc_file_write(handle, content, mode='wb')
-                                self._log(" success: {0}".format(success))
+                    if handle is None:
+                        self._log(" could not create copy")
+                        raise libiMobileDeviceIOException("could not open file {0} for writing".format(repr(dst)))
 
+                    buf = bytearray(chunk_size)
+                    total = 0
+                    start = time.time()
+                    try:
+                        with open(src, 'rb') as f:
+                            while True:
+                                n = f.readinto(buf)
+                                if not n:
+                                    break
+                                if not self._afc_file_write_from(handle, buf, n):
+                                    self._log_error(" write failed after {0:,} bytes".format(total))
+                                    raise libiMobileDeviceIOException("error writing {0} after {1:,} bytes".format(repr(dst), total))
+                                total += n
+                    finally:
                         self._afc_file_close(handle)
-                    else:
-                        self._log(" could not create copy")
+                    self._log_transfer_rate(total, time.time() - start)
 
-                def copy_from_idevice(self, src, dst):
+                def copy_from_idevice(self, src, dst, chunk_size=None):
                     '''
                     High-level convenience method to copy from src on iDevice to
                     dst on local filesystem.
                     src: path to file on iDevice
                     dst: file object on local filesystem
+                    chunk_size: transfer buffer size, default self.transfer_chunk_size
+                    AFC reads into a single preallocated buffer, which is written to
+                    dst through a memoryview
                     '''
                     self._log_location()
                     self._log("src: {0}".format(repr(src)))
                     self._log("dst: {0}".format(dst.name))
 
-                    BUFFER_SIZE = 10 * 1024 * 1024
-                    data = None
-                    mode = 'rb'
-                    handle = self._afc_file_open(src, mode)
-                    if handle is not None:
-                        file_stats = self._afc_get_file_info(src)
-                        file_size = int(file_stats['st_size'])
-                        self._log("file_size: {:,} bytes".format(file_size))
-                        if file_size > BUFFER_SIZE:
-                            bytes_remaining = file_size
-                            while bytes_remaining:
-                                if bytes_remaining > BUFFER_SIZE:
-                                    self._log("copying {:,} byte chunk".format(BUFFER_SIZE))
-                                    data = self._afc_file_read(handle, BUFFER_SIZE, mode)
-                                    dst.write(data)
-                                    bytes_remaining -= BUFFER_SIZE
-                                else:
-                                    self._log("copying final {:,} bytes".format(bytes_remaining))
-                                    data = self._afc_file_read(handle, bytes_remaining, mode)
-                                    dst.write(data)
-                                    bytes_remaining = 0
-                        else:
-                            self._log("copying {:,} bytes".format(file_size))
-                            data = self._afc_file_read(handle, file_size, mode)
-                            dst.write(data)
+                    chunk_size = chunk_size or self.transfer_chunk_size
+                    handle = self._afc_file_open(src, 'rb')
+                    if handle is None:
+                        self._log(" could not open file")
+                        raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(src)))
 
+                    buf = bytearray(chunk_size)
+                    view = memoryview(buf)
+                    total = 0
+                    start = time.time()
+                    try:
+                        while True:
+                            n = self._afc_file_read_into(handle, buf, chunk_size)
+                            if n < 0:
+                                raise libiMobileDeviceIOException("error reading {0} after {1:,} bytes".format(repr(src), total))
+                            if n == 0:
+                                break
+                            dst.write(view[:n])
+                            total += n
+                    finally:
                         self._afc_file_close(handle)
-                        dst.close()
+                    dst.close()
+                    self._log_transfer_rate(total, time.time() - start)
 
-                        # Update timestamps to match
-                        file_stats = self._afc_get_file_info(src)
-                        os.utime(dst.name, (file_stats['st_mtime'], file_stats['st_mtime']))
+                    # Update timestamps to match
+                    file_stats = self._afc_get_file_info(src)
+                    os.utime(dst.name, (file_stats['st_mtime'], file_stats['st_mtime']))
 
-                    else:
-                        self._log(" could not open file")
-                        raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(src)))
+                def detach_session(self):
+                    '''
+                    Return the current AFC client state and clear it without freeing,
+                    so another container can be mounted while this one stays open.
+                    Free a detached session by attaching it, then disconnecting
+                    '''
+                    self._log_location()
+                    session = dict((attr, getattr(self, attr)) for attr in self.SESSION_ATTRIBUTES)
+                    self.afc = None
+                    self.control = None
+                    self.device = None
+                    self.device_mounted = False
+                    self.house_arrest = None
+                    return session
 
                 def disconnect_idevice(self):
                     '''
@@ -636,11 +739,26 @@ class TestSuite(object, Logger):
                         self._log(e.value)
                         self.dismount_ios_media_folder()
 
+                def open_file(self, path):
+                    '''
+                    Open path on iDevice for streaming, seekable reads.
+                    Returns an AFCFile, which the caller closes
+                    '''
+                    self._log_location(repr(path))
+
+                    handle = self._afc_file_open(path, 'rb')
+                    if handle is None:
+                        self._log(" could not open file")
+                        raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(path)))
+                    file_stats = self._afc_get_file_info(path)
+                    return AFCFile(self, path, handle, int(file_stats['st_size']))
+
                 def read(self, path, mode='r'):
                     '''
                     Convenience method to read from path on iDevice to memory buffer.
                     Use for small files.
-                    For larger files copied to local file, use copy_from_idevice()
+                    For larger files copied to local file, use copy_from_idevice(),
+                    for reading parts of larger files, use open_file()
                     '''
                     self._log_location("{0} mode='{1}'".format(repr(path), mode))
 
@@ -656,6 +774,34 @@ class TestSuite(object, Logger):
 
                     return data
 
+                def read_range(self, path, offset, length):
+                    '''
+                    Read length bytes starting at offset from path on iDevice.
+                    Returns fewer bytes if EOF is reached.
+                    Use to fetch headers and trailers without copying the whole file
+                    '''
+                    self._log_location("{0} offset:{1:,} length:{2:,}".format(repr(path), offset, length))
+
+                    handle = self._afc_file_open(path, 'rb')
+                    if handle is None:
+                        self._log(" could not open file")
+                        raise libiMobileDeviceIOException("could not open file {0} for reading".format(repr(path)))
+
+                    buf = bytearray(length)
+                    total = 0
+                    try:
+                        self._afc_file_seek(handle, offset)
+                        while total < length:
+                            n = self._afc_file_read_into(handle, buf, length - total, total)
+                            if n <= 0:
+                                break
+                            total += n
+                    finally:
+                        self._afc_file_close(handle)
+                    if total < length:
+                        del buf[total:]
+                    return bytes(buf)
+
                 def rename(self, from_name, to_name):
                     '''
                     Renames a file or directory on the device
@@ -678,6 +824,8 @@ class TestSuite(object, Logger):
 
                     client  (afc_client_t) The client to use
                     path    (const char *) The fully-qualified path to delete
+
+                    Return True if path was removed
                     '''
                     self._log_location("{0}".format(repr(path)))
 
@@ -685,6 +833,8 @@ class TestSuite(object, Logger):
 
                     if error:
                         self._log_error(" ERROR: {0} path:{1}".format(self._afc_error(error), repr(path)))
+                        return False
+                    return True
 
                 def stat(self, path):
                     '''
@@ -701,6 +851,18 @@ class TestSuite(object, Logger):
                     self._log_location("{0}".format(repr(path)))
                     return self._afc_get_file_info(path)
 
+                def stat_many(self, paths):
+                    '''
+                    Return {path: file_stats} for paths in one pass, {} for missing
+                    paths. Duplicate paths are fetched once
+                    '''
+                    self._log_location("{0:,} paths".format(len(paths)))
+                    ans = {}
+                    for path in paths:
+                        if path not in ans:
+                            ans[path] = self._afc_get_file_info(path, silent=True)
+                    return ans
+
                 def write(self, content, destination, mode='w'):
                     '''
                     Convenience method to write to path on iDevice
@@ -963,14 +1125,15 @@ class TestSuite(object, Logger):
 
                     if 'b' in mode:
                         data = bytearray(size)
-                        datatype = c_char * size
                         error = self.lib.afc_file_read(byref(self.afc),
                                                        handle,
-                                                       byref(datatype.from_buffer(data)),
+                                                       byref(c_char.from_buffer(data)),
                                                        size,
                                                        byref(bytes_read)) & 0xFFFF
                         if error:
                             self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
+                        if bytes_read.value < size:
+                            del data[bytes_read.value:]
                         return data
                     else:
                         data = create_string_buffer(size)
@@ -979,6 +1142,47 @@ class TestSuite(object, Logger):
                             self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
                         return data.value
 
+                def _afc_file_read_into(self, handle, buf, size, offset=0):
+                    '''
+                    Read up to size bytes from handle into bytearray buf at offset,
+                    without intermediate copies.
+                    Return the number of bytes read, or -1 on error
+                    '''
+                    bytes_read = c_uint(0)
+                    error = self.lib.afc_file_read(byref(self.afc),
+                                                   handle,
+                                                   byref(c_char.from_buffer(buf, offset)),
+                                                   size,
+                                                   byref(bytes_read)) & 0xFFFF
+                    if error:
+                        self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
+                        return -1
+                    return bytes_read.value
+
+                def _afc_file_seek(self, handle, offset, whence=os.SEEK_SET):
+                    '''
+                    Seek to a given position in a pre-opened file
+
+                    Args:
+                     client:  (AFC_CLIENT_T) The client to use
+                     handle:  (uint64_t) File handle of a previously opened file
+                     offset:  (int64_t) Seek offset
+                     whence:  (int) Seeking direction, one of SEEK_SET, SEEK_CUR, or SEEK_END
+
+                    Result:
+                     error:   (afc_error_t) AFC_E_SUCCESS (0) on success or AFC_E_* error value
+
+                    '''
+                    self._log_location("handle:{0} offset:{1:,} whence:{2}".format(handle.value, offset, whence))
+
+                    error = self.lib.afc_file_seek(byref(self.afc),
+                                                   handle,
+                                                   c_longlong(offset),
+                                                   c_int(whence)) & 0xFFFF
+                    if error:
+                        self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
+                        raise libiMobileDeviceIOException("afc_file_seek failed: {0}".format(self._afc_error(error)))
+
                 def _afc_file_write(self, handle, content, mode='w'):
                     '''
                     Writes a given number of bytes to a file
@@ -1000,24 +1204,34 @@ class TestSuite(object, Logger):
                     '''
                     self._log_location("handle:{0} mode='{1}'".format(handle.value, mode))
 
-                    bytes_written = c_uint(0)
-
                     if 'b' in mode:
                         # Content already contained in a bytearray()
                         data = content
-                        datatype = c_char * len(content)
                     else:
                         data = bytearray(content, 'utf-8')
-                        datatype = c_char * len(content)
 
-                    error = self.lib.afc_file_write(byref(self.afc),
-                                                    handle,
-                                                    byref(datatype.from_buffer(data)),
-                                                    len(content),
-                                                    byref(bytes_written)) & 0xFFFF
-                    if error:
-                        self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
-                        return False
+                    return self._afc_file_write_from(handle, data, len(data))
+
+                def _afc_file_write_from(self, handle, buf, size):
+                    '''
+                    Write the first size bytes of bytearray buf to handle in place,
+                    continuing after partial writes.
+                    Return True on success
+                    '''
+                    offset = 0
+                    while offset < size:
+                        bytes_written = c_uint(0)
+                        error = self.lib.afc_file_write(byref(self.afc),
+                                                        handle,
+                                                        byref(c_char.from_buffer(buf, offset)),
+                                                        size - offset,
+                                                        byref(bytes_written)) & 0xFFFF
+                        if error:
+                            self._log_error(" ERROR: {0} handle:{1}".format(self._afc_error(error), handle))
+                            return False
+                        if not bytes_written.value:
+                            return False
+                        offset += bytes_written.value
                     return True
 
                 def _afc_get_device_info(self):
@@ -1947,6 +2161,13 @@ class TestSuite(object, Logger):
                     else:
                         debug_print()
 
+                def _log_transfer_rate(self, total, elapsed):
+                    '''
+                    Report bytes transferred and throughput
+                    '''
+                    rate = total / elapsed / (1024 * 1024) if elapsed else 0
+                    self._log(" {0:,} bytes in {1:.3f}s ({2:.2f} MB/s)".format(total, elapsed, rate))
+
                 def _log_error(self, *args):
                     '''
                     Print error message with location regardless of self.verbose
@@ -1988,6 +2209,7 @@ class TestSuite(object, Logger):
         parser.add_argument('-l', '--large_send', default=False, action='store_true', help='send large file to Marvin Library/calibre.mm')
         parser.add_argument('-m', '--marvin', default=False, action='store_true', help='display Marvin /Documents')
         parser.add_argument('-s', '--stats', default=False, action='store_true', help='show stats for Library/calibre.mm')
+        parser.add_argument('-t', '--transfer_rate', default=False, action='store_true', help='benchmark MB/s of chunked vs legacy transfers to Library/calibre.mm')
         parser.add_argument('-v', '--verbose', default=False, action='store_true', help='display libiMobileDevice debug info')
         self.args = parser.parse_args()
 
@@ -2041,6 +2263,8 @@ class TestSuite(object, Logger):
                 self.test_large_send()
             if self.args.stats:
                 self.test_stats()
+            if self.args.transfer_rate:
+                self.test_transfer_rate()
 
         self.end_test_suite()
 
@@ -2225,6 +2449,70 @@ class TestSuite(object, Logger):
         for k, v in ans.iteritems():
             self._log(" {0}: {1}".format(k, v))
 
+    def test_transfer_rate(self):
+        '''
+        Benchmark MB/s of the chunked transfer engine against the legacy
+        bytearray(f.read()) copy, in both directions, across chunk sizes
+        '''
+        from calibre.ptempfile import TemporaryFile
+        app_name = "Marvin for iOS"
+        app_id = "com.appstafarian.MarvinIP"
+        self._log("\n{:-^120}".format(" Benchmarking transfers to '%s' " % app_name))
+        self.lib.connect_idevice()
+        self.lib.mount_ios_app(app_id=app_id)
+
+        folder = '/Library/calibre.mm'
+        dst = '/'.join([folder, 'transfer_test.bin'])
+        file_sizes = [256 * 1024, 4 * 1024 * 1024, 32 * 1024 * 1024]
+        chunk_sizes = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 10 * 1024 * 1024]
+
+        def legacy_send(src):
+            with open(src, 'rb') as f:
+                content = bytearray(f.read())
+            handle = self.lib._afc_file_open(dst, mode='wb')
+            self.lib._afc_file_write(handle, content, mode='wb')
+            self.lib._afc_file_close(handle)
+
+        def legacy_receive(size):
+            handle = self.lib._afc_file_open(dst, mode='rb')
+            content = self.lib._afc_file_read(handle, size, 'rb')
+            self.lib._afc_file_close(handle)
+            return content
+
+        def rate(size, elapsed):
+            return size / elapsed / (1024 * 1024) if elapsed else 0
+
+        self._log("{0:>12} {1:>12} {2:>12} {3:>12}".format('file size', 'chunk', 'send MB/s', 'recv MB/s'))
+        for size in file_sizes:
+            with TemporaryFile() as temp:
+                with open(temp, 'wb') as f:
+                    f.write(os.urandom(size))
+
+                start = time.time()
+                legacy_send(temp)
+                sent = time.time() - start
+                start = time.time()
+                legacy_receive(size)
+                received = time.time() - start
+                self._log("{0:>12,} {1:>12} {2:>12.2f} {3:>12.2f}".format(
+                    size, 'legacy', rate(size, sent), rate(size, received)))
+
+                for chunk_size in chunk_sizes:
+                    start = time.time()
+                    self.lib.copy_to_idevice(temp, dst, chunk_size=chunk_size)
+                    sent = time.time() - start
+                    start = time.time()
+                    with open(temp + '.rcv', 'wb') as out:
+                        self.lib.copy_from_idevice(dst, out, chunk_size=chunk_size)
+                    received = time.time() - start
+                    os.remove(temp + '.rcv')
+                    self._log("{0:>12,} {1:>12,} {2:>12.2f} {3:>12.2f}".format(
+                        size, chunk_size, rate(size, sent), rate(size, received)))
+
+        self._log("removing test file")
+        self.lib.remove(dst)
+        self.lib.disconnect_idevice()
+
 def main():
     ts = TestSuite()
     ts.run_test_suite()
@@ -13,12 +13,14 @@ Source for this plugin is available as a Github repository at
 https://github.com/Philantrop/calibre-apple-reader-applications,
 which also includes an overview of the communication protocol in README.md
 """
-import base64, cStringIO, datetime, hashlib, imp, mechanize, os, platform, re, sqlite3, sys, tempfile, time
+import base64, binascii, cStringIO, datetime, hashlib, imp, json, marshal, mechanize, os, platform, re, sqlite3, sys, tempfile, time
 
-from collections import namedtuple
-from inspect import getmembers, isfunction
+from collections import defaultdict, namedtuple
+from contextlib import closing, contextmanager
+from functools import wraps
+from inspect import isfunction
 from PIL import Image as PILImage
-from threading import Thread
+from threading import Event, Lock, RLock, Thread, Timer
 from types import MethodType
 
 from calibre import browser, fit_image
@@ -158,6 +160,286 @@ class Logger():
         pass
 
 
+class AFCClientPool():
+    '''
+    Extra AFC clients mounted on one container, so independent transfers,
+    stats and removals run concurrently rather than queueing on driver.ios.
+    Each client is a new glue instance from driver._new_ios_client() and
+    costs one handshake. Clients are opened on first use, up to size.
+    map() runs func(ios, item) for each item across the clients and returns
+    (item, result, error) tuples in item order. error is a formatted
+    traceback, or None.
+    With size 1, or if no extra client can be mounted, map() runs on
+    driver.ios under driver.ios_lock
+    '''
+    def __init__(self, driver, container, size=1):
+        self.clients = []
+        self.container = container
+        self.driver = driver
+        self.size = max(1, int(size))
+
+    def close(self):
+        for ios in self.clients:
+            if self.container == AFCSessionManager.MEDIA:
+                ios.dismount_ios_media_folder()
+            else:
+                ios.disconnect_idevice()
+        self.clients = []
+
+    def map(self, func, items):
+        import Queue
+        items = list(items)
+        if self.size > 1 and len(items) > 1:
+            self._open(min(self.size, len(items)))
+        if len(self.clients) < 2 or len(items) < 2:
+            with self.driver.ios_lock:
+                return [self._call(func, self.driver.ios, item) for item in items]
+
+        results = [None] * len(items)
+        jobs = Queue.Queue()
+        for i, item in enumerate(items):
+            jobs.put((i, item))
+
+        def _run(ios):
+            while True:
+                try:
+                    i, item = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._call(func, ios, item)
+
+        threads = []
+        for n, ios in enumerate(self.clients[:len(items)]):
+            t = Thread(target=_run, args=(ios,), name="afc client %d" % (n + 1))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    def _call(self, func, ios, item):
+        try:
+            return (item, func(ios, item), None)
+        except Exception:
+            import traceback
+            return (item, None, traceback.format_exc())
+
+    def _open(self, count):
+        while len(self.clients) < count:
+            ios = self.driver._new_ios_client()
+            if self.container == AFCSessionManager.MEDIA:
+                ios.mount_ios_media_folder()
+                mounted = ios.device_mounted
+            else:
+                mounted = ios.mount_ios_app(app_id=self.container)
+            if not mounted:
+                self.driver._log_location("unable to mount client %d on '%s'" %
+                    (len(self.clients) + 1, self.container))
+                break
+            self.clients.append(ios)
+
+
+class AFCSessionManager():
+    '''
+    Keep the AFC clients for the media folder and app containers mounted
+    between operations, so each container costs one lockdown handshake per
+    connection rather than one per operation.
+    acquire() and release() are refcounted, session() wraps them for scoped use.
+    The most recently acquired container is the active client on driver.ios.
+    If the glue supports detach_session()/attach_session()/close_session(),
+    other containers are parked and swapped back in without a handshake,
+    otherwise they are remounted when next needed.
+    Released containers are torn down after idle_timeout seconds, all
+    containers by close_all() on eject. reconnect() scopes a device
+    (re)connect, keeping the containers still held.
+    pool() returns an AFCClientPool of pool_size clients for a container,
+    closed with the other sessions
+    '''
+    MEDIA = '/Media'
+
+    def __init__(self, driver, idle_timeout=60, pool_size=1):
+        self.active = None
+        self.driver = driver
+        self.handshakes = 0
+        self.idle_timeout = idle_timeout
+        self.parked = {}
+        self.pool_size = pool_size
+        self.pools = {}
+        self.refs = defaultdict(int)
+        self._acquired = {}
+        self._released = {}
+        self._timer = None
+
+    def acquire(self, container):
+        '''
+        Make container (MEDIA or an app_id) the active AFC client, mounting
+        it if needed. Return True if mounted
+        '''
+        with self.driver.ios_lock:
+            if not self._activate(container):
+                return False
+            self.refs[container] += 1
+            self._acquired[container] = time.time()
+            return True
+
+    def close_all(self):
+        '''
+        Tear down every container, releasing all references
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+        with self.driver.ios_lock:
+            for container in list(self.parked) + [self.active]:
+                if container is not None:
+                    self._close(container)
+            self.refs.clear()
+            self._acquired.clear()
+            self._released.clear()
+
+    def pool(self, container):
+        '''
+        Return the AFCClientPool for container, created on first use
+        '''
+        if container not in self.pools:
+            self.pools[container] = AFCClientPool(self.driver, container, self.pool_size)
+        return self.pools[container]
+
+    @contextmanager
+    def reconnect(self):
+        '''
+        Scope for a device (re)connect on driver.ios. Unreferenced containers are
+        closed. Held containers keep their references: the active one is parked
+        (or dismounted if the glue cannot park) while the scope runs, and the
+        most recently acquired held container is made active again afterwards
+        '''
+        with self.driver.ios_lock:
+            for container in list(self.parked) + [self.active]:
+                if container is not None and not self.refs[container]:
+                    self._close(container)
+            if self.active is not None:
+                if self._can_park():
+                    self.parked[self.active] = self.driver.ios.detach_session()
+                else:
+                    self._dismount(self.active)
+                self.active = None
+            try:
+                yield
+            finally:
+                held = [c for c in self.refs if self.refs[c]]
+                if held:
+                    self._activate(max(held, key=lambda c: self._acquired[c]))
+
+    def release(self, container):
+        '''
+        Drop a reference to container. Once unreferenced, reactivate the most
+        recently acquired container still held, and start the idle timer
+        '''
+        with self.driver.ios_lock:
+            self.refs[container] = max(0, self.refs[container] - 1)
+            if self.refs[container]:
+                return
+            self._released[container] = time.time()
+            held = [c for c in self.refs if self.refs[c]]
+            if held:
+                self._activate(max(held, key=lambda c: self._acquired[c]))
+            self._schedule_idle_check()
+
+    @contextmanager
+    def session(self, container):
+        '''
+        Scoped acquire()/release(). Yields True if container is mounted
+        '''
+        mounted = self.acquire(container)
+        try:
+            yield mounted
+        finally:
+            if mounted:
+                self.release(container)
+
+    def _activate(self, container):
+        if container == self.active:
+            return True
+        ios = self.driver.ios
+        if self.active is not None:
+            if self._can_park():
+                self.parked[self.active] = ios.detach_session()
+            else:
+                self._dismount(self.active)
+            self.active = None
+
+        if container in self.parked:
+            ios.attach_session(self.parked.pop(container))
+            self.active = container
+            return True
+
+        if container == self.MEDIA:
+            ios.mount_ios_media_folder()
+            mounted = ios.device_mounted
+        else:
+            mounted = ios.mount_ios_app(app_id=container)
+        self.handshakes += 1
+        self.driver._log_location("'%s' mounted: %s handshakes: %d" %
+            (container, mounted, self.handshakes))
+        if mounted:
+            self.active = container
+        return mounted
+
+    def _can_park(self):
+        ios = self.driver.ios
+        return (hasattr(ios, 'detach_session') and
+                hasattr(ios, 'attach_session') and
+                hasattr(ios, 'close_session'))
+
+    def _close(self, container):
+        ios = self.driver.ios
+        if container == self.active:
+            self._dismount(container)
+            self.active = None
+        elif container in self.parked:
+            # Free only the parked session's clients, not the device connection
+            ios.close_session(self.parked.pop(container))
+        self.refs.pop(container, None)
+        self._released.pop(container, None)
+
+    def _close_idle(self):
+        '''
+        Timer callback: tear down containers unreferenced for idle_timeout.
+        If the driver is performing I/O, try again later
+        '''
+        self._timer = None
+        if not self.driver.ios_lock.acquire(False):
+            self._schedule_idle_check()
+            return
+        try:
+            now = time.time()
+            for container, released in self._released.items():
+                if (not self.refs[container] and
+                    now - released >= self.idle_timeout):
+                    self.driver._log_location("closing idle '%s'" % container)
+                    self._close(container)
+            if self._released:
+                self._schedule_idle_check()
+        finally:
+            self.driver.ios_lock.release()
+
+    def _dismount(self, container):
+        if container == self.MEDIA:
+            self.driver.ios.dismount_ios_media_folder()
+        else:
+            self.driver.ios.disconnect_idevice()
+
+    def _schedule_idle_check(self):
+        if self._timer is None and self.idle_timeout:
+            self._timer = Timer(self.idle_timeout, self._close_idle)
+            self._timer.daemon = True
+            self._timer.start()
+
+
 class Book(Metadata):
     '''
     A simple class describing a book
@@ -399,42 +681,207 @@ class BookList(CollectionsBookList, Logger):
     """
 
 
+class CachedBookIndex():
+    '''
+    Hash indexes over the books cached in calibre_metadata.sqlite, used by the
+    Kindle and GoodReader books() to reconcile the Documents folder:
+     filenames: set of cached filenames
+     by_basename: basename -> [filename, ...]
+     by_identity: (size, birthtime) -> [filename, ...]
+    '''
+    def __init__(self, rows=()):
+        self.filenames = set()
+        self.by_basename = defaultdict(list)
+        self.by_identity = defaultdict(list)
+        self._identities = {}
+        for filename, size, dateadded in rows:
+            self.add(filename, size, dateadded)
+
+    def __contains__(self, filename):
+        return filename in self.filenames
+
+    def __iter__(self):
+        return iter(self.filenames)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def add(self, filename, size, dateadded):
+        self._insert(filename, self._identity(size, dateadded))
+
+    def discard(self, filename):
+        if filename in self.filenames:
+            self.filenames.discard(filename)
+            self.by_basename[filename.rpartition('/')[2]].remove(filename)
+            identity = self._identities.pop(filename)
+            if identity is not None:
+                self.by_identity[identity].remove(filename)
+
+    def find_moved(self, path, stats, installed):
+        '''
+        Return the cached filename of a book no longer in installed which
+        matches path by (size, birthtime), else by basename, or None
+        '''
+        identity = self._identity(stats.get('st_size'), stats.get('st_birthtime'))
+        candidates = []
+        if identity is not None:
+            candidates.extend(self.by_identity.get(identity, []))
+        candidates.extend(self.by_basename.get(path.rpartition('/')[2], []))
+        for cb in candidates:
+            if cb not in installed:
+                return cb
+        return None
+
+    def move(self, old_filename, new_filename):
+        identity = self._identities[old_filename]
+        self.discard(old_filename)
+        self._insert(new_filename, identity)
+
+    def _insert(self, filename, identity):
+        self.filenames.add(filename)
+        self.by_basename[filename.rpartition('/')[2]].append(filename)
+        self._identities[filename] = identity
+        if identity is not None:
+            self.by_identity[identity].append(filename)
+
+    @staticmethod
+    def _identity(size, birthtime):
+        '''
+        Key matching a file across moves and renames: (st_size, int(st_birthtime))
+        '''
+        try:
+            return (int(size), int(float(birthtime)))
+        except (TypeError, ValueError):
+            return None
+
+
+class CommandFuture():
+    '''
+    Handle to a device command executing in the background.
+    Modeled on concurrent.futures.Future: poll with done(), block with wait()
+    or result(). progress is a float 0.0 - 1.0 updated as the reader app reports.
+    timed_out is set if the reader app stops reporting.
+    '''
+    def __init__(self, command_name):
+        self.command_name = command_name
+        self.progress = 0.0
+        self.timed_out = False
+        self._callbacks = []
+        self._done = Event()
+        self._exception = None
+        self._lock = Lock()
+        self._result = None
+
+    def add_done_callback(self, fn):
+        '''
+        fn(future) is called from the monitoring thread upon completion,
+        or immediately if the command has already completed
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        '''
+        Return the command result, re-raising any exception from the monitor
+        '''
+        if not self.wait(timeout):
+            return None
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def wait(self, timeout=None):
+        '''
+        Return True if the command completed within timeout
+        '''
+        return self._done.wait(timeout)
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._set_done()
+
+    def _set_result(self, result):
+        self._result = result
+        self.progress = 1.0
+        self._set_done()
+
+    def _set_done(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
 class CompileUI():
     '''
     Compile Qt Creator .ui files at runtime
+    Compilation is deferred until the config dialog first needs the forms.
+    forms_index.json in resources_path maps each form to its mtime, windowTitle
+    and compiled module name, so unchanged forms are neither parsed nor compiled
     '''
+    INDEX_NAME = 'forms_index.json'
+
     def __init__(self, parent):
-        self.compiled_forms = {}
+        self.compiled_forms = None
         self.help_file = None
         self._log = parent._log
         self._log_location = parent._log_location
         self.parent = parent
         self.verbose = parent.verbose
-        self.compiled_forms = self.compile_ui()
+        self.index_path = os.path.join(parent.resources_path, self.INDEX_NAME)
 
     def compile_ui(self):
+        '''
+        Return {window_title: compiled module name}, compiling forms on first call
+        '''
         pat = re.compile(r'''(['"]):/images/([^'"]+)\1''')
         def sub(match):
             ans = 'I(%s%s%s)'%(match.group(1), match.group(2), match.group(1))
             return ans
 
+        if self.compiled_forms is not None:
+            return self.compiled_forms
+
         # >>> Entry point
         self._log_location()
 
+        index = self._load_index()
+        updated = {}
         compiled_forms = {}
+        compiled = 0
         self._find_forms()
 
         # Cribbed from gui2.__init__:build_forms()
         for form in self.forms:
+            mtime = os.stat(form).st_mtime
+            compiled_form = self._form_to_compiled_form(form)
+            entry = index.get(form)
+            if (entry is not None and
+                entry.get('mtime') == mtime and
+                os.path.exists(compiled_form)):
+                updated[form] = entry
+                compiled_forms[entry['window_title']] = entry['module']
+                continue
+
             with open(form) as form_file:
                 soup = BeautifulStoneSoup(form_file.read())
                 property = soup.find('property',attrs={'name' : 'windowTitle'})
                 string = property.find('string')
                 window_title = string.renderContents()
 
-            compiled_form = self._form_to_compiled_form(form)
             if (not os.path.exists(compiled_form) or
-                os.stat(form).st_mtime > os.stat(compiled_form).st_mtime):
+                mtime > os.stat(compiled_form).st_mtime):
 
                 if not os.path.exists(compiled_form):
                     if self.verbose:
@@ -453,8 +900,18 @@ class CompileUI():
                 dat = pat.sub(sub, dat)
                 with open(compiled_form, 'wb') as cf:
                     cf.write(dat)
-
-            compiled_forms[window_title] = compiled_form.rpartition(os.sep)[2].partition('.')[0]
+                compiled += 1
+
+            module = compiled_form.rpartition(os.sep)[2].partition('.')[0]
+            updated[form] = {'mtime': mtime,
+                             'window_title': window_title,
+                             'module': module}
+            compiled_forms[window_title] = module
+
+        if updated != index:
+            self._save_index(updated)
+        self._log(" %d forms, %d compiled" % (len(updated), compiled))
+        self.compiled_forms = compiled_forms
         return compiled_forms
 
     def _find_forms(self):
@@ -469,6 +926,24 @@ class CompileUI():
         compiled_form = form.rpartition('.')[0]+'_ui.py'
         return compiled_form
 
+    def _load_index(self):
+        index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'rb') as f:
+                    index = json.load(f)
+            except:
+                self._log("unable to read '%s'" % self.index_path)
+                index = {}
+        return index
+
+    def _save_index(self, index):
+        try:
+            with open(self.index_path, 'wb') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+        except:
+            self._log("unable to write '%s'" % self.index_path)
+
 
 class DatabaseMalformedException(Exception):
     ''' '''
@@ -480,6 +955,60 @@ class DatabaseNotFoundException(Exception):
     pass
 
 
+# Immutable view of device presence published by DevicePresenceMonitor
+PresenceSnapshot = namedtuple('PresenceSnapshot',
+    'app_installed connected device_name udid timestamp')
+
+
+class DevicePresenceMonitor(Thread):
+    '''
+    Run the driver's presence probe off calibre's device-scan thread.
+    probe() returns a PresenceSnapshot, or None if the device could not be
+    probed (busy). The latest snapshot is published as self.snapshot, which
+    is replaced, never mutated, so readers need no locking.
+    Probes are serialized with driver I/O through driver.ios_lock
+    '''
+    def __init__(self, driver, probe, interval=1.0):
+        Thread.__init__(self, name="%s presence monitor" % driver.ios_reader_app)
+        self.daemon = True
+        self.driver = driver
+        self.interval = interval
+        self.probe = probe
+        self.snapshot = PresenceSnapshot(app_installed=False, connected=False,
+            device_name=None, udid=0, timestamp=0.0)
+        self._stop_event = Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.refresh()
+            self._stop_event.wait(self.interval)
+
+    def refresh(self):
+        '''
+        Probe once, skipping the probe if the driver is performing I/O
+        '''
+        if not self.driver.ios_lock.acquire(False):
+            return
+        try:
+            snapshot = self.probe()
+        except Exception:
+            import traceback
+            self.driver._log_location()
+            self.driver._log(traceback.format_exc())
+            snapshot = None
+        finally:
+            self.driver.ios_lock.release()
+
+        if snapshot is not None:
+            if snapshot[:4] != self.snapshot[:4]:
+                self.driver._log_location("connected: %s -> %s" %
+                    (self.snapshot.connected, snapshot.connected))
+            self.snapshot = snapshot
+
+    def stop(self):
+        self._stop_event.set()
+
+
 class DriverBase(DeviceConfig, DevicePlugin):
 
     # Specified at runtime in settings()
@@ -490,6 +1019,8 @@ class DriverBase(DeviceConfig, DevicePlugin):
         See devices.usbms.deviceconfig:DeviceConfig()
         '''
         self._log_location()
+        # Forms must be compiled before config.py imports main_ui
+        self.compiled_ui.compile_ui()
         from calibre_plugins.ios_reader_apps.config import ConfigWidget
         applist = READER_APP_ALIASES.keys()
         if islinux and 'iBooks' in applist:
@@ -575,7 +1106,12 @@ class iOSReaderApp(DriverBase, Logger):
     gui_name = 'iOS reader applications'
     icon = None
     name = 'iOS reader applications'
+    # Compiled code keyed by overlay source
+    overlay_code = {}
+    # Per-app overlay load time and cache tier, reported in diagnostics
+    overlay_load_times = {}
     overlays_loaded = False
+    presence_monitor = None
     supported_platforms = ['linux', 'osx', 'windows']
     temp_dir = None
     verbose = None
@@ -685,6 +1221,11 @@ class iOSReaderApp(DriverBase, Logger):
     PRODUCT_ID = list(_PRODUCT_ID)
     BCD = list(_BCD)
 
+    # Hashed fingerprints for is_usb_connected(), which is called ~1x/second
+    USB_VENDOR_IDS = frozenset(VENDOR_ID)
+    USB_PRODUCT_IDS = frozenset(_PRODUCT_ID)
+    USB_BCDS = frozenset(_BCD)
+
     @property
     def archive_path(self):
         return os.path.join(self.cache_dir, "thumbs.zip")
@@ -715,12 +1256,14 @@ class iOSReaderApp(DriverBase, Logger):
 
         # If reader app specified, check for installation, reconfigure
         if self.ios_reader_app:
-            self.app_id = self._get_connected_device_info()
-            if self.app_id is not None and not self.overlays_loaded:
-                # Device connected, app installed
-                self._log("performing late overlay binding")
-                self._class_reconfigure()
-                self.overlays_loaded = True
+            # Serialized with DevicePresenceMonitor and overlay I/O
+            with self.ios_lock:
+                self.app_id = self._get_connected_device_info()
+                if self.app_id is not None and not self.overlays_loaded:
+                    # Device connected, app installed
+                    self._log("performing late overlay binding")
+                    self._class_reconfigure()
+                    self.overlays_loaded = True
         else:
             if self.ios_reader_app is not None:
                 self._log_location("Preferred iOS reader app '%s' not installed" % self.ios_reader_app)
@@ -801,94 +1344,11 @@ class iOSReaderApp(DriverBase, Logger):
 
         self.resources_path = os.path.join(config_dir, 'plugins', "%s_resources" % self.name.replace(' ', '_'))
 
-        # ~~~~~~~~~ Copy the icon files to our resource directory ~~~~~~~~~
-        icons = []
-        with ZipFile(self.plugin_path, 'r') as zf:
-            for candidate in zf.namelist():
-                if candidate.endswith('/'):
-                    continue
-                if candidate.startswith('icons/'):
-                    icons.append(candidate)
-        ir = self.load_resources(icons)
-        for icon in icons:
-            if not icon in ir:
-                continue
-            fs = os.path.join(self.resources_path, icon)
-            if not os.path.exists(fs):
-                if not os.path.exists(os.path.dirname(fs)):
-                    os.makedirs(os.path.dirname(fs))
-                with open (fs, 'wb') as f:
-                    f.write(ir[icon])
-            else:
-                # Is the icon file current?
-                update_needed = False
-                with open(fs, 'rb') as f:
-                    if f.read() != ir[icon]:
-                        update_needed = True
-                    if update_needed:
-                        with open(fs, 'wb') as f:
-                            f.write(ir[icon])
-
-        # ~~~~~~~~~ Copy the widget files to our resource directory ~~~~~~~~~
-        widgets = []
-        with ZipFile(self.plugin_path, 'r') as zf:
-            for candidate in zf.namelist():
-                # Qt UI files
-                if candidate.startswith('widgets/') and candidate.endswith('.ui'):
-                    widgets.append(candidate)
-                # Corresponding class definitions
-                if candidate.startswith('widgets/') and candidate.endswith('.py'):
-                    widgets.append(candidate)
-        wr = self.load_resources(widgets)
-        for widget in widgets:
-            if not widget in wr:
-                continue
-            fs = os.path.join(self.resources_path, widget)
-            if not os.path.exists(fs):
-                # If the file doesn't exist in the resources dir, add it
-                if not os.path.exists(os.path.dirname(fs)):
-                    os.makedirs(os.path.dirname(fs))
-                with open (fs, 'wb') as f:
-                    f.write(wr[widget])
-            else:
-                # Is the .ui file current?
-                update_needed = False
-                with open(fs, 'r') as f:
-                    if f.read() != wr[widget]:
-                        update_needed = True
-                if update_needed:
-                    with open (fs, 'wb') as f:
-                        f.write(wr[widget])
-
-        # ~~~~~~~~~ Copy the help files to our resource directory ~~~~~~~~~
-        help_files = []
-        with ZipFile(self.plugin_path, 'r') as zf:
-            for candidate in zf.namelist():
-                if candidate.startswith('help/') and candidate.endswith('.html'):
-                    help_files.append(candidate)
-        hrs = self.load_resources(help_files)
-        for hf in help_files:
-            if not hf in hrs:
-                continue
-            fs = os.path.join(self.resources_path, hf)
-            if not os.path.exists(fs):
-                # If the file doesn't exist in the resources dir, add it
-                if not os.path.exists(os.path.dirname(fs)):
-                    os.makedirs(os.path.dirname(fs))
-                with open (fs, 'wb') as f:
-                    f.write(hrs[hf])
-            else:
-                # Is the help file current?
-                update_needed = False
-                with open(fs, 'r') as f:
-                    if f.read() != hrs[hf]:
-                        update_needed = True
-                if update_needed:
-                    with open (fs, 'wb') as f:
-                        f.write(hrs[hf])
-
-        # Compile .ui files as needed
-        cui = CompileUI(self)
+        # ~~~~~~~~~ Copy the icon, widget and help files to our resource directory ~~~~~~~~~
+        self._sync_resources()
+
+        # .ui files are compiled when the config dialog is first opened
+        self.compiled_ui = CompileUI(self)
 
         # Init the prefs file as needed
         self._init_prefs()
@@ -898,6 +1358,12 @@ class iOSReaderApp(DriverBase, Logger):
 
         # Init libiMobileDevice
         self.ios = libiMobileDevice(verbose=self.prefs.get('debug_libimobiledevice', False))
+        # Serializes self.ios between driver methods and DevicePresenceMonitor
+        self.ios_lock = RLock()
+        # Keeps media and app containers mounted between operations
+        self.afc_sessions = AFCSessionManager(self,
+            idle_timeout=self.prefs.get('afc_idle_timeout', 60),
+            pool_size=self.prefs.get('afc_pool_size', 1))
 
         # Confirm the installation of the preferred reader app
         self.app_id = None
@@ -955,7 +1421,7 @@ class iOSReaderApp(DriverBase, Logger):
                     self._class_reconfigure()
                     self.overlays_loaded = True
                     # Unique to Windows - need to connect to app folder before continuing
-                    self.ios_connection['app_installed'] = self.ios.mount_ios_app(app_id=self.app_id)
+                    self.ios_connection['app_installed'] = self.afc_sessions.acquire(self.app_id)
                     self.ios_connection['device_name'] = self.ios.device_name
             else:
                 self._log("device connected, but no reader app selected")
@@ -1035,7 +1501,7 @@ class iOSReaderApp(DriverBase, Logger):
 
     def shutdown(self):
         self._log_location()
-        self.ios.disconnect_idevice()
+        self.afc_sessions.close_all()
 
     def stop_plugin(self):
         self._log_location()
@@ -1148,10 +1614,10 @@ class iOSReaderApp(DriverBase, Logger):
             self._log("returning thumb from cover cache")
             return thumb_data
 
-        # Get the cover from the book
+        # Get the cover from the book, reading only the members it needs
         try:
-            stream = cStringIO.StringIO(self.ios.read(book.path, mode='rb'))
-            mi = get_metadata(stream)
+            with self._open_remote_file(book.path) as stream:
+                mi = get_metadata(stream)
             if mi.cover_data is not None:
                 img_data = cStringIO.StringIO(mi.cover_data[1])
         except:
@@ -1198,54 +1664,57 @@ class iOSReaderApp(DriverBase, Logger):
         If more than one alias available, refer to JSON file for preferred alias
         '''
         self._log_location()
-        device_list = self.ios.get_device_list()
-        if device_list is None:
-            raise libiMobileDeviceException("No connected iDevices")
-        app_id = None
-        try:
-            if len(device_list):
-                if len(device_list) == 1:
-                    connected = self.ios.connect_idevice()
-                    if not connected:
-                        raise libiMobileDeviceException("Unable to connect to iDevice. "
-                                                        "If you are updating, disconnect your iDevice first.")
-                    preferences = self.ios.get_preferences()
-                    self.ios.disconnect_idevice()
-
-                    # Get the device info
-                    self.ios.mount_ios_media_folder()
-                    device_info = self.ios._afc_get_device_info()
-                    self.ios.dismount_ios_media_folder()
-                    device_info.pop('Model')
-                    self.device_profile = dict(preferences.items() + device_info.items())
-
-                    # Use development_app_id if development mode
-                    if self.prefs.get('development_mode', False):
-                        app_id = self.prefs.get('development_app_id', None)
-                    if not app_id:
-                        if self.ios_reader_app in READER_APP_ALIASES:
-
-                            # Find the first installed app (iPad version takes precedence)
-                            for _app_id in READER_APP_ALIASES[self.ios_reader_app]:
-                                self._log("mounting '%s'" % _app_id)
-                                if self.ios.mount_ios_app(app_id=_app_id):
-                                    app_id = _app_id
-                                    self.ios.disconnect_idevice()
-                                    break
-                        else:
-                            self._log("'{}' is not a valid preferred_reader_app selection".format(self.ios_reader_app))
+        with self.ios_lock:
+            device_list = self.ios.get_device_list()
+            if device_list is None:
+                raise libiMobileDeviceException("No connected iDevices")
+            app_id = None
+            try:
+                if len(device_list):
+                    if len(device_list) == 1:
+                        # Containers still held by the overlays survive the (re)connect
+                        with self.afc_sessions.reconnect():
+                            connected = self.ios.connect_idevice()
+                            if not connected:
+                                raise libiMobileDeviceException("Unable to connect to iDevice. "
+                                                                "If you are updating, disconnect your iDevice first.")
+                            preferences = self.ios.get_preferences()
+                            self.ios.disconnect_idevice()
+
+                        # Get the device info
+                        with self.afc_sessions.session(AFCSessionManager.MEDIA):
+                            device_info = self.ios._afc_get_device_info()
+                        device_info.pop('Model')
+                        self.device_profile = dict(preferences.items() + device_info.items())
+
+                        # Use development_app_id if development mode
+                        if self.prefs.get('development_mode', False):
+                            app_id = self.prefs.get('development_app_id', None)
+                        if not app_id:
+                            if self.ios_reader_app in READER_APP_ALIASES:
+
+                                # Find the first installed app (iPad version takes precedence)
+                                for _app_id in READER_APP_ALIASES[self.ios_reader_app]:
+                                    # The installed app stays mounted for can_handle()
+                                    self._log("mounting '%s'" % _app_id)
+                                    if self.afc_sessions.acquire(_app_id):
+                                        app_id = _app_id
+                                        self.afc_sessions.release(_app_id)
+                                        break
+                            else:
+                                self._log("'{}' is not a valid preferred_reader_app selection".format(self.ios_reader_app))
+                    else:
+                        self._log("Too many connected iDevices")
                 else:
-                    self._log("Too many connected iDevices")
-            else:
-                self._log("No connected iDevices")
-        except:
-            import traceback
-            traceback.print_exc()
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            self._log_location("ERROR: {0}".format(
-                traceback.format_exception_only(exc_type, exc_value)[0].strip()))
-            raise InitialConnectionError("Unable to connect to iDevice")
-        return app_id
+                    self._log("No connected iDevices")
+            except:
+                import traceback
+                traceback.print_exc()
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self._log_location("ERROR: {0}".format(
+                    traceback.format_exception_only(exc_type, exc_value)[0].strip()))
+                raise InitialConnectionError("Unable to connect to iDevice")
+            return app_id
 
     def _init_prefs(self):
         '''
@@ -1274,33 +1743,93 @@ class iOSReaderApp(DriverBase, Logger):
         '''
         pass
 
+    def _get_overlay_code(self, overlay_source):
+        '''
+        Return (code, tier) for overlay_source, compiling at most once per
+        plugin version and source CRC32/size, as recorded in the plugin zip.
+        Code objects are held in iOSReaderApp.overlay_code for the life of the
+        process, as a reinstalled plugin takes effect only after a restart, and
+        marshaled to resources_path/overlay_cache/<name>.<version>.<crc>.<size>.code,
+        prefixed by the interpreter's magic number. The plugin zip is opened only
+        to validate the disk cache. tier is 'memory', 'disk' or 'compiled'
+        '''
+        if overlay_source in iOSReaderApp.overlay_code:
+            return iOSReaderApp.overlay_code[overlay_source], 'memory'
+
+        version = "%d.%d.%d.%d.%d" % self.version
+        try:
+            with ZipFile(self.plugin_path, 'r') as zf:
+                zi = zf.getinfo(overlay_source)
+            crc, size = zi.CRC, zi.file_size
+        except:
+            source = get_resources(overlay_source)
+            crc, size = binascii.crc32(source), len(source)
+        stamp = "%s.%08x.%d" % (version, crc & 0xffffffff, size)
+
+        cache_dir = os.path.join(self.resources_path, 'overlay_cache')
+        basename = overlay_source.rpartition('/')[2].rpartition('.')[0]
+        cached = os.path.join(cache_dir, '%s.%s.code' % (basename, stamp))
+        magic = imp.get_magic()
+
+        code = None
+        tier = 'disk'
+        if os.path.exists(cached):
+            try:
+                with open(cached, 'rb') as f:
+                    if f.read(len(magic)) == magic:
+                        code = marshal.loads(f.read())
+            except:
+                self._log("unable to read '%s'" % cached)
+                code = None
+
+        if code is None:
+            tier = 'compiled'
+            # dont_inherit: overlays must not pick up this module's __future__ flags
+            code = compile(get_resources(overlay_source), overlay_source, 'exec', 0, True)
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                # Remove code cached for previous versions of the source
+                for fn in os.listdir(cache_dir):
+                    if fn.startswith(basename + '.') and fn != os.path.basename(cached):
+                        os.remove(os.path.join(cache_dir, fn))
+                with open(cached, 'wb') as f:
+                    f.write(magic)
+                    f.write(marshal.dumps(code))
+            except:
+                self._log("unable to write '%s'" % cached)
+
+        iOSReaderApp.overlay_code[overlay_source] = code
+        return code, tier
+
     def _load_reader_app_overlays(self, cls_name):
         '''
         Load reader app overlay methods from resource file from
         readers/<name>_overlays.py
         '''
         self._log_location("'%s'" % cls_name)
+        start_time = time.time()
 
-        # Store the raw source to a temp file, import it
+        # Compile or fetch the cached code, execute it in a private namespace
         if cls_name == "development_mode":
             do = self.prefs.get('development_overlay', None)
             self._log("loading development_overlay %s" % repr(do))
-            overlay = imp.load_source("temporary_overlay_methods", do)
+            with open(do, 'rb') as f:
+                code = compile(f.read(), do, 'exec', 0, True)
+            tier = 'compiled'
         else:
             # Special-case GoodReader4 to use the same overlay as GoodReader
             if cls_name == "GoodReader 4":
                 cls_name = "GoodReader"
             overlay_source = 'readers/%s_overlays.py' % cls_name
-            basename = re.sub('readers/', '', overlay_source)
-            tmp_file = os.path.join(self.temp_dir, basename)
-            with open(tmp_file, 'w') as tf:
-                tf.write(get_resources(overlay_source))
-            overlay = imp.load_source("temporary_overlay_methods", tmp_file)
-            os.remove(tmp_file)
+            code, tier = self._get_overlay_code(overlay_source)
+        overlay = {'__name__': str('temporary_overlay_methods'),
+                   '__builtins__': __builtins__}
+        exec code in overlay
 
         # Extend iOSReaderApp with the functions defined in the overlay
         # [(<name>, <function>), (<name>, <function>)...]
-        overlays = [f for f in getmembers(overlay) if isfunction(f[1])]
+        overlays = [m for m in sorted(overlay.items()) if isfunction(m[1])]
         self._log("loading %d overlays" % len(overlays))
         for method in overlays:
             self._log("adding overlay '%s()'" % method[0])
@@ -1308,63 +1837,62 @@ class iOSReaderApp(DriverBase, Logger):
 
         del overlay
 
+        elapsed = time.time() - start_time
+        iOSReaderApp.overlay_load_times[cls_name] = {'seconds': elapsed, 'tier': tier}
+        self._log("overlays loaded from %s in %.1f ms" % (tier, elapsed * 1000))
+
     def _localize_database_path(self, remote_db_path):
         '''
         Copy remote_db_path from iOS to local storage as needed
         '''
         self._log_location("app_id: '%s' remote_db_path: '%s'" % (self.app_id, remote_db_path))
 
-        using_media_folder = False
         # Is the db in the Media folder or an app sandbox?
+        container = self.app_id
         if remote_db_path.startswith('/Media'):
-            using_media_folder = True
-            self.ios.mount_ios_media_folder()
+            container = AFCSessionManager.MEDIA
             remote_db_path = remote_db_path[len('/Media'):]
-        else:
-            # Mount app_id
-            self.ios.mount_ios_app(app_id=self.app_id)
 
         local_db_path = None
         db_stats = {}
 
-        if '*' in remote_db_path:
-            # Find matching file based on wildcard
-            f_els = os.path.basename(remote_db_path).split('*')
-            prefix = f_els[0]
-            suffix = f_els[1]
-            files = self.ios.listdir(os.path.dirname(remote_db_path))
-            for f in files:
-                if f.startswith(prefix) and f.endswith(suffix):
-                    remote_db_path = '/'.join([os.path.dirname(remote_db_path),f])
-                    break
-
-        db_stats = self.ios.stat(remote_db_path)
-        if db_stats:
-            path = remote_db_path.split('/')[-1]
-            if iswindows:
-                plen = len(self.temp_dir)
-                path = ''.join(shorten_components_to(245-plen, [path]))
-
-            full_path = os.path.join(self.temp_dir, path)
-            if os.path.exists(full_path):
-                lfs = os.stat(full_path)
-                if (int(db_stats['st_mtime']) == lfs.st_mtime and
-                    int(db_stats['st_size']) == lfs.st_size):
-                    local_db_path = full_path
-
-            if not local_db_path:
-                with open(full_path, 'wb') as out:
-                    self.ios.copy_from_idevice(remote_db_path, out)
-                local_db_path = out.name
-        else:
-            self._log_location("'%s' not found" % remote_db_path)
-            raise DatabaseNotFoundException
-
-        if using_media_folder:
-            self.ios.dismount_ios_media_folder()
-        else:
-            # Dismount ios
-            self.ios.disconnect_idevice()
+        with self.afc_sessions.session(container) as mounted:
+            if not mounted:
+                self._log_location("unable to mount '%s'" % container)
+                raise DatabaseNotFoundException("'%s' not mounted" % container)
+
+            if '*' in remote_db_path:
+                # Find matching file based on wildcard
+                f_els = os.path.basename(remote_db_path).split('*')
+                prefix = f_els[0]
+                suffix = f_els[1]
+                files = self.ios.listdir(os.path.dirname(remote_db_path))
+                for f in files:
+                    if f.startswith(prefix) and f.endswith(suffix):
+                        remote_db_path = '/'.join([os.path.dirname(remote_db_path),f])
+                        break
+
+            db_stats = self.ios.stat(remote_db_path)
+            if db_stats:
+                path = remote_db_path.split('/')[-1]
+                if iswindows:
+                    plen = len(self.temp_dir)
+                    path = ''.join(shorten_components_to(245-plen, [path]))
+
+                full_path = os.path.join(self.temp_dir, path)
+                if os.path.exists(full_path):
+                    lfs = os.stat(full_path)
+                    if (int(db_stats['st_mtime']) == lfs.st_mtime and
+                        int(db_stats['st_size']) == lfs.st_size):
+                        local_db_path = full_path
+
+                if not local_db_path:
+                    with open(full_path, 'wb') as out:
+                        self.ios.copy_from_idevice(remote_db_path, out)
+                    local_db_path = out.name
+            else:
+                self._log_location("'%s' not found" % remote_db_path)
+                raise DatabaseNotFoundException
 
         return {'path': local_db_path, 'stats': db_stats}
 
@@ -1377,6 +1905,104 @@ class iOSReaderApp(DriverBase, Logger):
         ans = str.replace("\"", "\"\"")
         return "\"" + ans + "\""
 
+    def _new_ios_client(self):
+        '''
+        Return an unmounted glue instance for AFCClientPool
+        '''
+        if hasattr(self.ios, 'clone'):
+            return self.ios.clone()
+        return libiMobileDevice(verbose=self.prefs.get('debug_libimobiledevice', False))
+
+    def _open_remote_file(self, path, size=None):
+        '''
+        Return a seekable, closeable read stream over path on the iDevice.
+        Prefers the streaming AFC reader, then range reads; older glue falls
+        back to reading the whole file into memory
+        '''
+        if hasattr(self.ios, 'open_file'):
+            return self.ios.open_file(path)
+        if hasattr(self.ios, 'read_range'):
+            if size is None:
+                size = self.ios.stat(path)['st_size']
+            return RemoteRangeFile(self.ios, path, size)
+        return closing(cStringIO.StringIO(self.ios.read(path, mode='rb')))
+
+    def _stat_many(self, paths):
+        '''
+        Return {path: stats} for paths, {} for missing paths, in one
+        ios.stat_many() pass where the glue supports it
+        '''
+        if hasattr(self.ios, 'stat_many'):
+            return self.ios.stat_many(paths)
+        return dict((path, self.ios.stat(path)) for path in paths)
+
+    def _sync_resources(self):
+        '''
+        Extract icons, widgets and help files from the plugin zip to resources_path.
+        resources_manifest.json records the plugin version, the zip's size and
+        mtime, and the CRC32 of every extracted file. If the zip is unchanged and
+        every file is present, nothing is opened. Otherwise the zip is read once,
+        and only files whose CRC32 differs from the manifest, or whose copy is
+        missing or resized, are rewritten
+        '''
+        def _is_resource(name):
+            if name.endswith('/'):
+                return False
+            return (name.startswith('icons/') or
+                    (name.startswith('widgets/') and name.endswith(('.ui', '.py'))) or
+                    (name.startswith('help/') and name.endswith('.html')))
+
+        def _is_current(name, size):
+            fs = os.path.join(self.resources_path, name)
+            return os.path.exists(fs) and os.path.getsize(fs) == size
+
+        manifest_path = os.path.join(self.resources_path, 'resources_manifest.json')
+        version = "%d.%d.%d.%d.%d" % self.version
+        zs = os.stat(self.plugin_path)
+
+        manifest = {}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'rb') as f:
+                    manifest = json.load(f)
+            except:
+                self._log("unable to read '%s'" % manifest_path)
+                manifest = {}
+
+        files = manifest.get('files', {})
+        if (manifest.get('version') == version and
+            manifest.get('plugin_size') == zs.st_size and
+            manifest.get('plugin_mtime') == zs.st_mtime and
+            all(_is_current(name, files[name]['size']) for name in files)):
+            self._log("resources current (%d files)" % len(files))
+            return
+
+        updated = {}
+        written = 0
+        with ZipFile(self.plugin_path, 'r') as zf:
+            for zi in zf.infolist():
+                if not _is_resource(zi.filename):
+                    continue
+                name = zi.filename
+                updated[name] = {'crc': zi.CRC, 'size': zi.file_size}
+                if files.get(name, {}).get('crc') == zi.CRC and _is_current(name, zi.file_size):
+                    continue
+                fs = os.path.join(self.resources_path, name)
+                if not os.path.exists(os.path.dirname(fs)):
+                    os.makedirs(os.path.dirname(fs))
+                with open(fs, 'wb') as f:
+                    f.write(zf.read(name))
+                written += 1
+
+        if not os.path.exists(self.resources_path):
+            os.makedirs(self.resources_path)
+        with open(manifest_path, 'wb') as f:
+            json.dump({'version': version,
+                       'plugin_size': zs.st_size,
+                       'plugin_mtime': zs.st_mtime,
+                       'files': updated}, f, indent=2, sort_keys=True)
+        self._log("resources synced: %d of %d files written" % (written, len(updated)))
+
     def _log_metrics(self, metrics={}):
         '''
         Post logging event
@@ -1407,6 +2033,520 @@ class iOSReaderApp(DriverBase, Logger):
                 self._log("Plugin logger unreachable: {0}".format(e))
 
 
+class LazyStatDict(dict):
+    '''
+    Directory listing whose per-entry stats are fetched on first access.
+    Names come from one ios.listdir(path, get_stats=False) round trip, so
+    membership tests and iteration cost nothing further. prefetch() fetches
+    the stats of many entries in one ios.stat_many() pass where the glue
+    supports it. Missing entries' stats are {}
+    '''
+    def __init__(self, ios, path, names=None):
+        if names is None:
+            names = ios.listdir(path, get_stats=False)
+        dict.__init__(self, dict.fromkeys(names))
+        self.ios = ios
+        self.path = path
+
+    def __getitem__(self, name):
+        stats = dict.__getitem__(self, name)
+        if stats is None:
+            stats = self.ios.stat(self._path(name))
+            dict.__setitem__(self, name, stats)
+        return stats
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+    def itervalues(self):
+        for name in self:
+            yield self[name]
+
+    def prefetch(self, names=None):
+        '''
+        Fetch the stats of names (default all entries) not yet fetched
+        '''
+        pending = [name for name in (self.keys() if names is None else names)
+                   if name in self and dict.__getitem__(self, name) is None]
+        if not pending:
+            return
+        if hasattr(self.ios, 'stat_many'):
+            found = self.ios.stat_many([self._path(name) for name in pending])
+            for name in pending:
+                dict.__setitem__(self, name, found.get(self._path(name)) or {})
+        else:
+            for name in pending:
+                self[name]
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def _path(self, name):
+        return '/'.join([self.path.rstrip('/'), name])
+
+
+class MetadataWorkerPool():
+    '''
+    Run a driver's metadata extractor on worker threads, so parsing and
+    thumbnail generation for one book overlap the USB transfer of the next.
+    submit() blocks once 2 * workers jobs are waiting, which bounds the
+    number of localized files on disk.
+    completed() returns the finished (key, result, error) tuples, waiting for
+    at least one if block is True. drain() waits for the remainder.
+    error is a formatted traceback, or None
+    '''
+    def __init__(self, func, workers=None, name='metadata worker'):
+        import Queue
+        if not workers:
+            import multiprocessing
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 2
+        self.func = func
+        self.outstanding = 0
+        self.workers = max(1, int(workers))
+        self._jobs = Queue.Queue(maxsize=self.workers * 2)
+        self._results = Queue.Queue()
+        self._threads = []
+        for i in range(self.workers):
+            t = Thread(target=self._run, name="%s %d" % (name, i + 1))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def completed(self, block=False):
+        import Queue
+        ans = []
+        if block and self.outstanding:
+            ans.append(self._results.get())
+        while True:
+            try:
+                ans.append(self._results.get_nowait())
+            except Queue.Empty:
+                break
+        self.outstanding -= len(ans)
+        return ans
+
+    def drain(self):
+        ans = []
+        while self.outstanding:
+            ans.append(self._results.get())
+            self.outstanding -= 1
+        return ans
+
+    def shutdown(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def submit(self, key, *args):
+        self.outstanding += 1
+        self._jobs.put((key, args))
+
+    def _run(self):
+        import traceback
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            key, args = job
+            try:
+                self._results.put((key, self.func(*args), None))
+            except Exception:
+                self._results.put((key, None, traceback.format_exc()))
+
+
+class PDFInfoReader():
+    '''
+    Extract /Title and /Author from a PDF's Info dictionary, reading only the
+    trailer, the cross-reference sections and the objects involved.
+    stream is any seekable file-like object, typically a RemoteRangeFile.
+    metadata() returns None if the file uses features not handled here
+    (encryption, Info in an object stream, unsupported xref filters), in
+    which case the caller should fall back to calibre's full PDF reader.
+    '''
+    TAIL_SIZE = 4096
+    OBJECT_CHUNK = 4096
+    MAX_SECTIONS = 32
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.stream.seek(0, 2)
+        self.size = self.stream.tell()
+        self.sections = []
+
+    def metadata(self):
+        '''
+        Return a MetaInformation object populated with title and authors, or None
+        '''
+        from calibre.ebooks.metadata import string_to_authors
+        try:
+            info = self.info()
+        except Exception:
+            info = None
+        if info is None:
+            return None
+        title = info.get('Title') or _('Unknown')
+        author = info.get('Author')
+        authors = string_to_authors(author) if author else [_('Unknown')]
+        return MetaInformation(title, authors)
+
+    def info(self):
+        '''
+        Return {'Title': unicode, 'Author': unicode} from the Info dictionary,
+        {} if the document has no Info dictionary, or None if unsupported
+        '''
+        tail_offset = max(0, self.size - self.TAIL_SIZE)
+        tail = self._read(tail_offset, self.TAIL_SIZE)
+        i = tail.rfind(b'startxref')
+        if i < 0:
+            return None
+        mo = re.match(br'startxref\s+(\d+)', tail[i:])
+        if not mo:
+            return None
+
+        info_ref = None
+        offset = int(mo.group(1))
+        while offset is not None and len(self.sections) < self.MAX_SECTIONS:
+            trailer = self._load_section(offset)
+            if trailer is None:
+                return None
+            if re.search(br'/Encrypt\b', trailer):
+                return None
+            if info_ref is None:
+                mo = re.search(br'/Info\s+(\d+)\s+(\d+)\s+R', trailer)
+                if mo:
+                    info_ref = int(mo.group(1))
+            mo = re.search(br'/Prev\s+(\d+)', trailer)
+            offset = int(mo.group(1)) if mo else None
+
+        if info_ref is None:
+            return {}
+        body = self._object_body(info_ref)
+        if body is None:
+            return None
+
+        ans = {}
+        for key in ['Title', 'Author']:
+            value = self._dict_value(body, key)
+            if value is not None:
+                ans[key] = value
+        return ans
+
+    def _decode_text(self, raw):
+        if raw.startswith(b'\xfe\xff'):
+            return raw[2:].decode('utf-16-be', 'replace')
+        if raw.startswith(b'\xff\xfe'):
+            return raw[2:].decode('utf-16-le', 'replace')
+        if raw.startswith(b'\xef\xbb\xbf'):
+            return raw[3:].decode('utf-8', 'replace')
+        return raw.decode('latin-1')
+
+    def _dict_value(self, body, key):
+        '''
+        Return the text value of /key in the dictionary at the start of body,
+        following an indirect reference if necessary
+        '''
+        mo = re.search(br'/' + key.encode('ascii') + br'(?=[\s(<\[/])\s*', body)
+        if not mo:
+            return None
+        pos = mo.end()
+        ref = re.match(br'(\d+)\s+(\d+)\s+R', body[pos:])
+        if ref:
+            target = self._object_body(int(ref.group(1)))
+            if target is None:
+                return None
+            body, pos = target, len(target) - len(target.lstrip())
+        raw = self._parse_string(body, pos)
+        if raw is None:
+            return None
+        return self._decode_text(raw).strip()
+
+    def _load_section(self, offset):
+        '''
+        Parse the cross-reference section at offset, return its trailer dictionary
+        '''
+        head = self._read(offset, 64)
+        if head.startswith(b'xref'):
+            pos = offset + 4
+            subsections = []
+            while True:
+                head = self._read(pos, 64)
+                mo = re.match(br'\s*(\d+)\s+(\d+)[ \t]*(?:\r\n|\r|\n)', head)
+                if not mo:
+                    break
+                start, count = int(mo.group(1)), int(mo.group(2))
+                subsections.append((start, count, pos + mo.end()))
+                pos += mo.end() + count * 20
+            chunk = self._read(pos, self.OBJECT_CHUNK)
+            i = chunk.find(b'trailer')
+            if i < 0:
+                return None
+            self.sections.append(('table', subsections))
+            return chunk[i:].split(b'startxref')[0]
+
+        # Cross-reference stream (PDF 1.5+)
+        dictionary, stream_offset = self._object_at(offset)
+        if dictionary is None or not re.search(br'/Type\s*/XRef', dictionary):
+            return None
+        entries = self._parse_xref_stream(dictionary, stream_offset)
+        if entries is None:
+            return None
+        self.sections.append(('stream', entries))
+        return dictionary
+
+    def _lookup(self, objnum):
+        '''
+        Return the file offset of objnum, or None if free, compressed or unknown
+        '''
+        for kind, data in self.sections:
+            if kind == 'table':
+                for start, count, table_offset in data:
+                    if start <= objnum < start + count:
+                        entry = self._read(table_offset + (objnum - start) * 20, 20)
+                        mo = re.match(br'(\d{10}) (\d{5}) ([nf])', entry)
+                        if not mo:
+                            return None
+                        if mo.group(3) == b'f':
+                            return None
+                        return int(mo.group(1))
+            else:
+                if objnum in data:
+                    kind, field2 = data[objnum]
+                    return field2 if kind == 1 else None
+        return None
+
+    def _object_at(self, offset):
+        '''
+        Return (dictionary bytes, offset of stream data or None) for the object at offset
+        '''
+        chunk = self._read(offset, self.OBJECT_CHUNK)
+        i = chunk.find(b'obj')
+        j = chunk.find(b'<<', i)
+        if i < 0 or j < 0:
+            return None, None
+        end = self._match_dict(chunk, j)
+        while end is None and len(chunk) < 16 * self.OBJECT_CHUNK and \
+                offset + len(chunk) < self.size:
+            chunk += self._read(offset + len(chunk), self.OBJECT_CHUNK)
+            end = self._match_dict(chunk, j)
+        if end is None:
+            return None, None
+        dictionary = chunk[j:end]
+        mo = re.match(br'\s*stream(?:\r\n|\n|\r)', chunk[end:end + 16])
+        stream_offset = offset + end + mo.end() if mo else None
+        return dictionary, stream_offset
+
+    def _object_body(self, objnum):
+        '''
+        Return the body of objnum, bounded by its closing '>>' if it is a
+        dictionary, otherwise by 'endobj'
+        '''
+        offset = self._lookup(objnum)
+        if offset is None:
+            return None
+        chunk = self._read(offset, self.OBJECT_CHUNK)
+        i = chunk.find(b'obj')
+        if i < 0:
+            return None
+        body = chunk[i + 3:].lstrip()
+        if body.startswith(b'<<'):
+            return self._object_at(offset)[0]
+        return body.split(b'endobj')[0]
+
+    def _match_dict(self, data, start):
+        '''
+        Return the offset following the '>>' closing the dictionary opened at start
+        '''
+        depth = 0
+        i = start
+        n = len(data)
+        while i < n:
+            c = data[i:i + 1]
+            if c == b'(':
+                end = self._skip_string(data, i)
+                if end is None:
+                    return None
+                i = end
+                continue
+            if data[i:i + 2] == b'<<':
+                depth += 1
+                i += 2
+                continue
+            if data[i:i + 2] == b'>>':
+                depth -= 1
+                i += 2
+                if depth == 0:
+                    return i
+                continue
+            i += 1
+        return None
+
+    def _parse_string(self, data, pos):
+        '''
+        Return the raw bytes of the literal or hex string at data[pos]
+        '''
+        if data[pos:pos + 1] == b'(':
+            out = []
+            depth = 0
+            i = pos
+            while i < len(data):
+                c = data[i:i + 1]
+                if c == b'\\':
+                    nxt = data[i + 1:i + 2]
+                    if nxt and nxt in b'nrtbf':
+                        out.append({b'n': b'\n', b'r': b'\r', b't': b'\t',
+                                    b'b': b'\b', b'f': b'\f'}[nxt])
+                        i += 2
+                    elif nxt and nxt in b'01234567':
+                        mo = re.match(br'[0-7]{1,3}', data[i + 1:i + 4])
+                        out.append(chr(int(mo.group(0), 8) & 0xff))
+                        i += 1 + len(mo.group(0))
+                    elif nxt in (b'\r', b'\n'):
+                        i += 2
+                        if nxt == b'\r' and data[i:i + 1] == b'\n':
+                            i += 1
+                    else:
+                        out.append(nxt)
+                        i += 2
+                    continue
+                if c == b'(':
+                    depth += 1
+                    if depth > 1:
+                        out.append(c)
+                elif c == b')':
+                    depth -= 1
+                    if depth == 0:
+                        return b''.join(out)
+                    out.append(c)
+                else:
+                    out.append(c)
+                i += 1
+            return None
+        if data[pos:pos + 1] == b'<':
+            end = data.find(b'>', pos)
+            if end < 0:
+                return None
+            hexdigits = re.sub(br'\s', b'', data[pos + 1:end])
+            if len(hexdigits) % 2:
+                hexdigits += b'0'
+            return binascii.unhexlify(hexdigits)
+        return None
+
+    def _parse_xref_stream(self, dictionary, stream_offset):
+        '''
+        Return {objnum: (type, field2)} from a FlateDecode cross-reference stream
+        '''
+        import zlib
+
+        mo = re.search(br'/Length\s+(\d+)(?!\s+\d+\s+R)', dictionary)
+        w = re.search(br'/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]', dictionary)
+        size = re.search(br'/Size\s+(\d+)', dictionary)
+        if stream_offset is None or not (mo and w and size):
+            return None
+        filters = re.search(br'/Filter\s*(\[[^\]]*\]|/\w+)', dictionary)
+        raw = self._read(stream_offset, int(mo.group(1)))
+        if filters:
+            if filters.group(1).strip(b'[] ') != b'/FlateDecode':
+                return None
+            raw = zlib.decompress(raw)
+
+        widths = [int(x) for x in w.groups()]
+        row_size = sum(widths)
+        predictor = re.search(br'/Predictor\s+(\d+)', dictionary)
+        if predictor and int(predictor.group(1)) >= 10:
+            columns = re.search(br'/Columns\s+(\d+)', dictionary)
+            columns = int(columns.group(1)) if columns else 1
+            raw = self._unpredict_png(raw, columns)
+            if raw is None:
+                return None
+
+        index = re.search(br'/Index\s*\[([\d\s]+)\]', dictionary)
+        if index:
+            values = [int(x) for x in index.group(1).split()]
+            ranges = zip(values[0::2], values[1::2])
+        else:
+            ranges = [(0, int(size.group(1)))]
+
+        entries = {}
+        pos = 0
+        for start, count in ranges:
+            for objnum in xrange(start, start + count):
+                row = bytearray(raw[pos:pos + row_size])
+                pos += row_size
+                fields = []
+                j = 0
+                for width in widths:
+                    value = 0
+                    for b in row[j:j + width]:
+                        value = (value << 8) + b
+                    fields.append(value)
+                    j += width
+                kind = fields[0] if widths[0] else 1
+                if objnum not in entries:
+                    entries[objnum] = (kind, fields[1])
+        return entries
+
+    def _read(self, offset, length):
+        self.stream.seek(offset)
+        return self.stream.read(length)
+
+    def _skip_string(self, data, start):
+        depth = 0
+        i = start
+        while i < len(data):
+            c = data[i:i + 1]
+            if c == b'\\':
+                i += 2
+                continue
+            if c == b'(':
+                depth += 1
+            elif c == b')':
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+        return None
+
+    def _unpredict_png(self, data, columns):
+        '''
+        Reverse PNG None/Sub/Up row predictors
+        '''
+        data = bytearray(data)
+        rows = []
+        previous = bytearray(columns)
+        for r in xrange(0, len(data), columns + 1):
+            filter_type = data[r]
+            row = data[r + 1:r + 1 + columns]
+            if filter_type == 1:
+                for k in xrange(1, len(row)):
+                    row[k] = (row[k] + row[k - 1]) & 0xff
+            elif filter_type == 2:
+                for k in xrange(len(row)):
+                    row[k] = (row[k] + previous[k]) & 0xff
+            elif filter_type != 0:
+                return None
+            rows.append(bytes(row))
+            previous = row
+        return b''.join(rows)
+
+
 class PluginMetricsLogger(Thread, Logger):
     '''
     Post an event to the logging server
@@ -1461,6 +2601,110 @@ class ReaderAppSignals(QObject):
     # _wait_for_command_completion() for typical usage.
     reader_app_status_changed = pyqtSignal(dict)
 
+    # These signals are emitted while a command submitted with
+    # Marvin_overlays:submit_command() is executing.
+    # payload: {'cmd': command_name, 'progress': float}
+    reader_app_command_progress = pyqtSignal(dict)
+    # payload: {'cmd': command_name, 'code': str, 'messages': list, 'error': unicode|None}
+    reader_app_command_completed = pyqtSignal(dict)
+
+
+class RemoteRangeFile():
+    '''
+    Read-only, seekable file-like view of a file on the iDevice.
+    Bytes are fetched on demand in block_size ranges and cached, so parsers
+    reading headers and trailers transfer only what they touch.
+    Ranges are read through one ios.open_file() stream where the glue supports
+    it, else with ios.read_range().
+    If lock is supplied, each device read is made while holding it
+    '''
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, ios, path, size, block_size=None, lock=None):
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.bytes_fetched = 0
+        self.closed = False
+        self.ios = ios
+        self.lock = lock
+        self.name = path.rpartition('/')[2]
+        self.path = path
+        self.size = int(size)
+        self._blocks = {}
+        self._pos = 0
+        self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._blocks = {}
+        if self._stream is not None:
+            if self.lock is not None:
+                with self.lock:
+                    self._stream.close()
+            else:
+                self._stream.close()
+            self._stream = None
+        self.closed = True
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self._pos
+        n = max(0, min(n, self.size - self._pos))
+        if not n:
+            return b''
+        first = self._pos // self.block_size
+        last = (self._pos + n - 1) // self.block_size
+        self._fetch(first, last)
+        data = b''.join([self._blocks[b] for b in xrange(first, last + 1)])
+        start = self._pos - first * self.block_size
+        self._pos += n
+        return data[start:start + n]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def _fetch(self, first, last):
+        '''
+        Fetch missing blocks first..last, coalescing adjacent blocks into one read
+        '''
+        run_start = None
+        for b in xrange(first, last + 2):
+            missing = b <= last and b not in self._blocks
+            if missing and run_start is None:
+                run_start = b
+            elif not missing and run_start is not None:
+                offset = run_start * self.block_size
+                length = min(b * self.block_size, self.size) - offset
+                if self.lock is not None:
+                    with self.lock:
+                        data = self._read_range(offset, length)
+                else:
+                    data = self._read_range(offset, length)
+                self.bytes_fetched += len(data)
+                for k in xrange(run_start, b):
+                    i = (k - run_start) * self.block_size
+                    self._blocks[k] = data[i:i + self.block_size]
+                run_start = None
+
+    def _read_range(self, offset, length):
+        if hasattr(self.ios, 'open_file'):
+            if self._stream is None:
+                self._stream = self.ios.open_file(self.path)
+            self._stream.seek(offset)
+            return self._stream.read(length)
+        return self.ios.read_range(self.path, offset, length)
+
 
 '''     Helper functions   '''
 def from_json(obj):
@@ -1524,6 +2768,19 @@ def parse_date(date_string):
     return parse(date_string, ignoretz=True)
 
 
+def serialized_io(func):
+    '''
+    Decorator for overlay methods performing device I/O.
+    Holds the driver's ios_lock so DevicePresenceMonitor does not probe the
+    device mid-operation
+    '''
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.ios_lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 def set_cc_mapping(cc_name, field=None, combobox=None):
     '''
     Store element to cc_name in prefs:cc_mappings
@@ -320,6 +320,9 @@ class ConfigWidget(QWidget, Ui_Dialog):
             formatted = "{0:02d}:{1:02d}".format(int(elapsed['mins']), int(elapsed['secs']))
             device_profile['load_time'] = formatted
 
+        def _add_overlay_load_times():
+            device_profile['overlay_load_times'] = getattr(self.parent, 'overlay_load_times', {})
+
         def _add_iOSRA_version():
             device_profile['iOSRA_version'] = "{0}.{1}.{2}".format(*self.parent.version)
 
@@ -518,6 +521,9 @@ class ConfigWidget(QWidget, Ui_Dialog):
                 ' device books: {device_books}\n'
                 ' initialization time: {load_time}\n'
                 )
+            for app, d in sorted(device_profile['overlay_load_times'].iteritems()):
+                TEMPLATE += " {0} overlays: {1:.1f} ms ({2})\n".format(
+                    app, d['seconds'] * 1000, d['tier'])
             return TEMPLATE.format(**args)
 
         def _format_system_info():
@@ -559,6 +565,7 @@ class ConfigWidget(QWidget, Ui_Dialog):
         _add_installed_plugins()
         _add_device_book_count()
         _add_load_time()
+        _add_overlay_load_times()
         _add_library_profile()
         _add_device_info()
         _add_available_space()
@@ -7,15 +7,16 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2013, Gregory Riker'
 
-import base64, cStringIO, os, sqlite3, subprocess, time, re
+import base64, cStringIO, hashlib, json, os, sqlite3, subprocess, time, re
 from datetime import datetime
 
 from calibre.constants import islinux, isosx, iswindows
 from calibre.devices.usbms.books import BookList
 from calibre.utils.zipfile import ZipFile
 
-from calibre_plugins.ios_reader_apps import (Book, iOSReaderApp,
-    KINDLE_ENABLED_FORMATS, KINDLE_SUPPORTED_FORMATS)
+from calibre_plugins.ios_reader_apps import (Book, CachedBookIndex, iOSReaderApp,
+    KINDLE_ENABLED_FORMATS, KINDLE_SUPPORTED_FORMATS, LazyStatDict,
+    MetadataWorkerPool, RemoteRangeFile)
 
 if True:
     '''
@@ -62,6 +63,8 @@ if True:
         self.path_template = '{0}-{1}.{2}'
         self.local_metadata = None
         self.remote_metadata = '/Library/calibre_metadata.sqlite'
+        self.metadata_dirty = False
+        self.METADATA_SCHEMA_VERSION = 2
 
 
     def add_books_to_metadata(self, locations, metadata, booklists):
@@ -106,122 +109,167 @@ if True:
                 con.row_factory = sqlite3.Row
                 cur = con.cursor()
 
-                # Get the last saved set of installed filenames from the db
+                # Load the last saved metadata from the db in one pass, index the filenames
                 cur.execute('''SELECT
-                                filename
+                                authors,
+                                author_sort,
+                                dateadded,
+                                filename,
+                                size,
+                                thumb_data,
+                                title,
+                                title_sort,
+                                uuid
                                FROM metadata
                             ''')
-                rows = cur.fetchall()
-                cached_books = [row[b'filename'] for row in rows]
-                #cached_books = [self._quote_sqlite_identifier(row[b'filename']) for row in rows]
+                cached_rows = dict((row[b'filename'], row) for row in cur.fetchall())
+                cached_books = CachedBookIndex(
+                    (fn, row[b'size'], row[b'dateadded']) for fn, row in cached_rows.iteritems())
                 if self.prefs.get('development_mode', False):
                     self._log("~~~ cached_books: ~~~")
                     for b in sorted(cached_books):
                         self._log("%s %s" % (b, repr(b)))
 
-                # Get the currently installed filenames from the documents folder
-                installed_books = self._get_nested_folder_contents(self.documents_folder)
+                # Get the currently installed filenames and stats from the documents folder
+                installed_books = self._get_nested_folder_contents(self.documents_folder, 'documents')
+                ib = set(installed_books)
                 if self.prefs.get('development_mode', False):
                     self._log("~~~ installed_books: ~~~")
                     for b in sorted(installed_books):
                         self._log("%s %s" % (b, repr(b)))
 
-                moved_books = []
-                for i, book in enumerate(installed_books):
-                    book_moved = False
-                    if book in cached_books:
-                        # Retrieve the cached metadata
-                        this_book = self._get_cached_metadata(cur, book)
-                        booklist.add_book(this_book, False)
-                    else:
-                        # Check to see if a known book has been moved
-                        for cb in cached_books:
-                            if cb.rpartition('/')[2] == book.rpartition('/')[2]:
-                                # Retrieve the cached metadata with the new location
-                                self._log("%s moved to %s" % (repr(cb), repr(book)))
-                                this_book = self._get_cached_metadata(cur, cb)
-                                this_book.path = book
-                                booklist.add_book(this_book, False)
-                                # Update metadata with new location
-                                cur.execute('''
-                                            UPDATE metadata
-                                            SET filename = {0}
-                                            WHERE filename = {1}
-                                            '''.format(self._quote_sqlite_identifier(book),
-                                                       self._quote_sqlite_identifier(cb)))
-                                con.commit()
-                                book_moved = True
-                                moved_books.append(cb)
-                                break
-                        if book_moved:
-                            continue
-
-                        # Make a local copy of the book, get the stats
-                        remote_path = '/'.join([self.documents_folder, book])
-                        stats = self.ios.stat(remote_path)
-                        local_path = self._localize_mobi('/'.join([self.documents_folder, book]))
-                        book_stats = {'path': local_path, 'stats': stats}
-                        try:
-                            this_book = self._get_metadata(book, book_stats)
-                            os.remove(local_path)
-                        except:
-                            import traceback
-                            traceback.print_exc()
+                def _commit_rows(rows):
+                    # Add a batch of new books to calibre_metadata db
+                    cur.executemany('''
+                                    INSERT OR REPLACE INTO metadata
+                                     (authors,
+                                      author_sort,
+                                      basename,
+                                      dateadded,
+                                      filename,
+                                      size,
+                                      thumb_data,
+                                      title,
+                                      title_sort,
+                                      uuid)
+                                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+                    con.commit()
+                    del rows[:]
+
+                def _collect(results):
+                    for book, this_book, error in results:
+                        if error is not None:
+                            self._log(error)
                             self._log("ERROR reading metadata from %s" % book)
-                            os.remove(local_path)
                             continue
-
                         booklist.add_book(this_book, False)
-                        cached_books.append(book)
-                        # Add to calibre_metadata db
-                        cur.execute('''
-                                        INSERT OR REPLACE INTO metadata
-                                         (authors,
-                                          author_sort,
-                                          dateadded,
-                                          filename,
-                                          size,
-                                          thumb_data,
-                                          title,
-                                          title_sort,
-                                          uuid)
-                                        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                                        (unicode('; '.join(this_book.authors)),
+                        cached_books.add(book, this_book.size, this_book.dateadded)
+                        new_rows.append((unicode('; '.join(this_book.authors)),
                                          unicode(this_book.author_sort),
+                                         this_book.path.rpartition('/')[2],
                                          this_book.dateadded,
                                          this_book.path,
                                          this_book.size,
-                                         this_book.thumb_data,
+                                         sqlite3.Binary(this_book.thumbnail) if this_book.thumbnail else None,
                                          unicode(this_book.title),
                                          unicode(this_book.title_sort),
-                                         this_book.uuid)
-                                        )
+                                         this_book.uuid))
+                    if len(new_rows) >= batch_size:
+                        _commit_rows(new_rows)
+                    return len(results)
+
+                def _report(done):
                     if self.report_progress is not None:
-                        self.report_progress(float((i + 1)*100 / len(installed_books))/100,
-                            '%(num)d of %(tot)d' % dict(num=i + 1, tot=len(installed_books)))
+                        self.report_progress(float(done*100 / len(installed_books))/100,
+                            '%(num)d of %(tot)d' % dict(num=done, tot=len(installed_books)))
+
+                batch_size = self.prefs.get('metadata_batch_size', 50)
+                done = 0
+                moved_rows = []
+                new_books = []
+                new_rows = []
+                supported_formats = [f.lower() for f in KINDLE_SUPPORTED_FORMATS]
+                for book in installed_books:
+                    if book in cached_books:
+                        # Retrieve the cached metadata
+                        this_book = self._get_cached_metadata(cur, book, cached_rows)
+                        booklist.add_book(this_book, False)
+                    else:
+                        # Check to see if a known book has been moved or renamed
+                        cb = cached_books.find_moved(book, installed_books[book], ib)
+                        if cb is not None:
+                            # Retrieve the cached metadata with the new location
+                            self._log("%s moved to %s" % (repr(cb), repr(book)))
+                            this_book = self._get_cached_metadata(cur, cb, cached_rows)
+                            this_book.path = book
+                            booklist.add_book(this_book, False)
+                            moved_rows.append((book, book.rpartition('/')[2], cb))
+                            cached_books.move(cb, book)
+
+                        # Skip files we can't read before transferring anything
+                        elif book.rpartition('.')[2].lower() not in supported_formats:
+                            self._log("skipping unsupported format: %s" % repr(book))
+                        else:
+                            new_books.append(book)
+                            continue
+                    done += 1
+                    _report(done)
+
+                # Update metadata with new locations
+                if moved_rows:
+                    cur.executemany('''UPDATE metadata
+                                       SET filename = ?,
+                                           basename = ?
+                                       WHERE filename = ?
+                                    ''', moved_rows)
+                    con.commit()
+
+                # Parse new books on worker threads while the next one transfers.
+                # MOBI headers are read in place, PDFs need a local copy to render the cover
+                if new_books:
+                    self._log("extracting metadata from %d new books" % len(new_books))
+                    with MetadataWorkerPool(self._extract_metadata,
+                                            workers=self.prefs.get('metadata_workers', 0)) as pool:
+                        for book in new_books:
+                            stats = installed_books[book]
+                            remote_path = '/'.join([self.documents_folder, book])
+                            local_path = None
+                            if book.lower().endswith('.mobi') and hasattr(self.ios, 'read_range'):
+                                stream = RemoteRangeFile(self.ios, remote_path, stats['st_size'],
+                                                         lock=self.ios_lock)
+                            else:
+                                with self.ios_lock:
+                                    local_path = self._localize_mobi(remote_path)
+                                stream = open(local_path, 'rb')
+                            pool.submit(book, book, {'path': local_path, 'stats': stats, 'stream': stream})
+                            done += _collect(pool.completed())
+                            _report(done)
+                        done += _collect(pool.drain())
+                        _report(done)
+                    if new_rows:
+                        _commit_rows(new_rows)
 
                 # Remove orphans (books no longer in Kindle) from db
-                ib = set(installed_books)
-                mb = set(moved_books)
-                orphans = [x for x in cached_books if x not in ib and x not in mb]
+                orphans = cached_books.filenames - ib
 
                 if orphans:
-                    for book in orphans:
-                        # Remove from db, update device copy
-                        self._log("Removing orphan %s from metadata" % self._quote_sqlite_identifier(book))
-                        cur.execute('''DELETE FROM metadata
-                                       WHERE filename = {0}
-                                    '''.format(self._quote_sqlite_identifier(book)))
-                    con.execute('''VACUUM''')
-
-                # Copy the updated db to the iDevice
-                self._log("updating remote_metadata")
-                self.ios.copy_to_idevice(str(self.local_metadata), str(self.remote_metadata))
+                    self._log("Removing %d orphans from metadata" % len(orphans))
+                    if self.prefs.get('development_mode', False):
+                        for book in sorted(orphans):
+                            self._log(" %s" % repr(book))
+                    cur.executemany('''DELETE FROM metadata
+                                       WHERE filename = ?
+                                    ''', [(book,) for book in orphans])
+
+                self._track_metadata_changes(con)
+
+            # Copy the updated db to the iDevice if anything changed
+            self._push_metadata()
 
             if self.report_progress is not None:
                 self.report_progress(1.0, 'finished')
 
-            self.cached_books = cached_books
+            self.cached_books = sorted(cached_books)
             self.load_time = time.time() - start_time
 
             metrics = {'book_count': len(booklist),
@@ -304,7 +352,7 @@ if True:
             if not self.ios_connection['app_installed']:
                 if self.DEBUG_CAN_HANDLE:
                     self._log("2. App installed, attempting connection")
-                self.ios_connection['app_installed'] = self.ios.mount_ios_app(app_id=self.app_id)
+                self.ios_connection['app_installed'] = self.afc_sessions.acquire(self.app_id)
                 self.ios_connection['device_name'] = self.ios.device_name
                 if self.DEBUG_CAN_HANDLE:
                     self._log("2a. self.ios_connection: %s" % _show_current_connection())
@@ -326,14 +374,14 @@ if True:
         elif len(connected_ios_devices) == 0:
             self._log_location("no connected devices")
             self._reset_ios_connection()
-            self.ios.disconnect_idevice()
+            self.afc_sessions.close_all()
 
         elif len(connected_ios_devices) > 1:
             self._log_location()
             self._log("%d iDevices detected. Driver supports a single connected iDevice." %
                                 len(connected_ios_devices))
             self._reset_ios_connection()
-            self.ios.disconnect_idevice()
+            self.afc_sessions.close_all()
 
         # 4. show connection
         if self.DEBUG_CAN_HANDLE:
@@ -360,30 +408,33 @@ if True:
         if self.prefs.get('development_mode', False):
             self._log("cached_books: %s" % self.cached_books)
 
-        file_count = float(len(paths))
-
-        for i, path in enumerate(paths):
-            self._log("removing %s" % repr(path))
-            ios_path = '/'.join([self.documents_folder, path])
-            self.ios.remove(ios_path)
+        # Issue the removals across the AFC client pool, then update the db once
+        self._log("removing %d books" % len(paths))
+        if self.prefs.get('development_mode', False):
+            self._log("removing %s" % repr(paths))
+        removed = []
+        for path, result, error in self.afc_sessions.pool(self.app_id).map(
+                lambda ios, path: ios.remove('/'.join([self.documents_folder, path])), paths):
+            # Glue without a remove() result returns None
+            if error or result is False:
+                # Leave the book in the db, it is still on the device
+                self._log("error removing '%s'\n%s" % (path, error or ''))
+            else:
+                removed.append(path)
 
         # Update the db
         con = sqlite3.connect(self.local_metadata)
         con.row_factory = sqlite3.Row
         cur = con.cursor()
         with con:
-            for book in paths:
-                # Remove from db, update device copy
-                self._log("Removing %s from local_metadata" % self._quote_sqlite_identifier(book))
-                with con:
-                    cur.execute('''DELETE FROM metadata
-                                   WHERE filename = {0}
-                                '''.format(self._quote_sqlite_identifier(book)))
-            con.execute('''VACUUM''')
-
-        # Copy the updated db to the iDevice
-        self._log("updating remote_metadata")
-        self.ios.copy_to_idevice(str(self.local_metadata), str(self.remote_metadata))
+            self._log("Removing %d books from local_metadata" % len(removed))
+            cur.executemany('''DELETE FROM metadata
+                               WHERE filename = ?
+                            ''', [(book,) for book in removed])
+
+        # sync_booklists() follows, push the updated db then
+        self._track_metadata_changes(con)
+        self._push_metadata(defer=True)
 
     def eject(self):
         '''
@@ -395,6 +446,11 @@ if True:
         # If busy in critical IO operation, wait for completion before returning
         while self.busy:
             time.sleep(0.10)
+
+        # Push any deferred metadata changes
+        if self.metadata_dirty:
+            self._push_metadata()
+        self.afc_sessions.close_all()
         self.ejected = True
 
     def get_file(self, path, outfile, end_session=True):
@@ -443,34 +499,14 @@ if True:
                 self.ejected = False
             return False, None
 
-        vendors_on_system = set([x[0] for x in devices_on_system])
-        vendors = self.VENDOR_ID if hasattr(self.VENDOR_ID, '__len__') else [self.VENDOR_ID]
-        if hasattr(self.VENDOR_ID, 'keys'):
-            products = []
-            for ven in self.VENDOR_ID:
-                products.extend(self.VENDOR_ID[ven].keys())
-        else:
-            products = self.PRODUCT_ID if hasattr(self.PRODUCT_ID, '__len__') else [self.PRODUCT_ID]
-
-        for vid in vendors:
-            if vid in vendors_on_system:
-                for dev in devices_on_system:
-                    cvid, pid, bcd = dev[:3]
-                    if cvid == vid:
-                        if pid in products:
-                            if hasattr(self.VENDOR_ID, 'keys'):
-                                try:
-                                    cbcd = self.VENDOR_ID[vid][pid]
-                                except KeyError:
-                                    # Vendor vid does not have product pid, pid
-                                    # exists for some other vendor in this
-                                    # device
-                                    continue
-                            else:
-                                cbcd = self.BCD
-                            if self.test_bcd(bcd, cbcd):
-                                if self.can_handle(dev, debug=debug):
-                                    return True, dev
+        # Match against the fingerprint sets built once in iOSReaderApp
+        for dev in devices_on_system:
+            cvid, pid, bcd = dev[:3]
+            if (cvid in self.USB_VENDOR_IDS and
+                    pid in self.USB_PRODUCT_IDS and
+                    bcd in self.USB_BCDS):
+                if self.can_handle(dev, debug=debug):
+                    return True, dev
 
         return False, None
 
@@ -562,13 +598,13 @@ if True:
         from calibre import sanitize_file_name
         from calibre.ptempfile import PersistentTemporaryDirectory
 
-        self._log_location()
-        tdir = PersistentTemporaryDirectory('_prep_gr')
-        ans = []
-        for path in paths:
-            if not self.ios.exists('/'.join([self.documents_folder, path])):
-                ans.append((path, 'File not found', 'File not found'))
-                continue
+        def _fetch(ios, path):
+            '''
+            Copy path to tdir on one AFC client, return ans entry
+            '''
+            remote_path = '/'.join([self.documents_folder, path])
+            if not ios.exists(remote_path):
+                return (path, 'File not found', 'File not found')
 
             base = tdir
             if iswindows:
@@ -582,13 +618,19 @@ if True:
             out_path = os.path.normpath(os.path.join(base, sanitize_file_name(dest)))
             with open(out_path, 'wb') as out:
                 try:
-                    self.get_file(path, out)
+                    ios.copy_from_idevice(remote_path, out)
                 except Exception as e:
                     import traceback
-                    ans.append((dest, e, traceback.format_exc()))
-                else:
-                    ans.append(out.name)
+                    return (dest, e, traceback.format_exc())
+            return out.name
+
+        self._log_location()
+        tdir = PersistentTemporaryDirectory('_prep_gr')
 
+        # Fetch concurrently across the AFC client pool
+        ans = []
+        for path, result, error in self.afc_sessions.pool(self.app_id).map(_fetch, paths):
+            ans.append(result if error is None else (path, error, error))
         return ans
 
     def remove_books_from_metadata(self, paths, booklists):
@@ -638,41 +680,47 @@ if True:
             if not booklist:
                 continue
 
-            # Update db title/author from booklist title/author
+            # Diff booklist title/author against the db, then update in one pass
             con = sqlite3.connect(self.local_metadata)
             with con:
                 con.row_factory = sqlite3.Row
                 cur = con.cursor()
-                for book in booklist:
-                    cur.execute('''SELECT
-                                    authors,
-                                    filename,
-                                    title
-                                   FROM metadata
-                                   WHERE filename = {0}
-                                '''.format(self._quote_sqlite_identifier(book.path)))
-                    cached_book = cur.fetchone()
-                    if cached_book:
-                        if (book.title != cached_book[b'title'] or
-                            book.authors != [cached_book[b'authors']]):
-                            self._log("updating metadata for %s" % repr(book.path))
-                            cur.execute('''UPDATE metadata
-                                           SET authors = "{0}",
-                                               author_sort = "{1}",
-                                               title = "{2}",
-                                               title_sort = "{3}"
-                                           WHERE filename = {4}
-                                        '''.format(self._escape_delimiters('; '.join(book.authors)),
-                                                   self._escape_delimiters(author_to_author_sort(book.authors[0])),
-                                                   self._escape_delimiters(book.title),
-                                                   self._escape_delimiters(title_sort(book.title)),
-                                                   self._quote_sqlite_identifier(book.path)))
+                cur.execute('''SELECT
+                                authors,
+                                filename,
+                                title
+                               FROM metadata
+                            ''')
+                cached_rows = dict((row[b'filename'], row) for row in cur.fetchall())
 
+                updates = []
+                for book in booklist:
+                    cached_book = cached_rows.get(book.path)
+                    if cached_book is None:
+                        continue
+                    authors = '; '.join(book.authors)
+                    if (book.title != cached_book[b'title'] or
+                        authors != cached_book[b'authors']):
+                        self._log("updating metadata for %s" % repr(book.path))
+                        updates.append((unicode(authors),
+                                        unicode(author_to_author_sort(book.authors[0])),
+                                        unicode(book.title),
+                                        unicode(title_sort(book.title)),
+                                        book.path))
+
+                if updates:
+                    cur.executemany('''UPDATE metadata
+                                       SET authors = ?,
+                                           author_sort = ?,
+                                           title = ?,
+                                           title_sort = ?
+                                       WHERE filename = ?
+                                    ''', updates)
                 con.commit()
+            self._track_metadata_changes(con)
 
-            # Copy the updated db to the iDevice
-            self._log("updating remote_metadata")
-            self.ios.copy_to_idevice(str(self.local_metadata), str(self.remote_metadata))
+        # Copy the updated db to the iDevice once for all booklists
+        self._push_metadata()
 
     def upload_books(self, files, names, on_card=None, end_session=True, metadata=None):
         '''
@@ -696,52 +744,67 @@ if True:
         '''
         from calibre.ebooks.metadata.pdf import get_metadata
 
+        # Render covers on worker threads, keeping them ahead of the transfers.
+        # Transfers stay serial, the db is updated in one transaction at the end
         new_booklist = []
-        con = sqlite3.connect(self.local_metadata)
-        with con:
-            cur = con.cursor()
-
+        rows = []
+        thumbs = {}
+        with MetadataWorkerPool(self._cover_to_thumb,
+                                workers=self.prefs.get('metadata_workers', 0),
+                                name='cover worker') as pool:
+            lookahead = pool.workers * 2
+            submitted = 0
             for (i, fpath) in enumerate(files):
-                format = fpath.rpartition('.')[2].lower()
-                thumb = self._cover_to_thumb(metadata[i])
-                this_book = self._create_new_book(fpath, metadata[i], thumb)
-                new_booklist.append(this_book)
+                while submitted < min(len(files), i + lookahead):
+                    pool.submit(submitted, metadata[submitted])
+                    submitted += 1
+
+                this_book = self._create_new_book(fpath, metadata[i], None)
                 destination = '/'.join([self.documents_folder, this_book.path])
                 self.ios.copy_to_idevice(str(fpath), destination)
 
-                # Add to calibre_metadata db
-                cur.execute('''
-                                INSERT OR REPLACE INTO metadata
-                                 (authors,
-                                  author_sort,
-                                  dateadded,
-                                  filename,
-                                  size,
-                                  thumb_data,
-                                  title,
-                                  title_sort,
-                                  uuid)
-                                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                                (unicode('; '.join(this_book.authors)),
-                                 unicode(this_book.author_sort),
-                                 this_book.dateadded,
-                                 this_book.path,
-                                 this_book.size,
-                                 this_book.thumb_data,
-                                 unicode(this_book.title),
-                                 unicode(this_book.title_sort),
-                                 this_book.uuid)
-                                )
+                while i not in thumbs:
+                    for key, thumb, error in pool.completed(block=True):
+                        if error is not None:
+                            self._log(error)
+                        thumbs[key] = thumb
+                this_book.thumbnail = thumbs.pop(i)
+                new_booklist.append(this_book)
+                rows.append((unicode('; '.join(this_book.authors)),
+                             unicode(this_book.author_sort),
+                             this_book.path.rpartition('/')[2],
+                             this_book.dateadded,
+                             this_book.path,
+                             this_book.size,
+                             sqlite3.Binary(this_book.thumbnail) if this_book.thumbnail else None,
+                             unicode(this_book.title),
+                             unicode(this_book.title_sort),
+                             this_book.uuid))
+
                 if self.report_progress is not None:
                     self.report_progress(float((i + 1)*100 / len(files))/100,
                         '%(num)d of %(tot)d' % dict(num=i + 1, tot=len(files)))
 
-            cur.close()
-            con.commit()
-
-        # Copy the updated db to the iDevice
-        self._log("updating remote_metadata")
-        self.ios.copy_to_idevice(str(self.local_metadata), str(self.remote_metadata))
+        # Add to calibre_metadata db
+        con = sqlite3.connect(self.local_metadata)
+        with con:
+            con.executemany('''
+                            INSERT OR REPLACE INTO metadata
+                             (authors,
+                              author_sort,
+                              basename,
+                              dateadded,
+                              filename,
+                              size,
+                              thumb_data,
+                              title,
+                              title_sort,
+                              uuid)
+                            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        self._track_metadata_changes(con)
+
+        # sync_booklists() follows, push the updated db then
+        self._push_metadata(defer=True)
 
         if self.report_progress is not None:
             self.report_progress(1.0, 'finished')
@@ -749,6 +812,21 @@ if True:
         return (new_booklist, [], [])
 
     # ~~~~~~~~~~~~~~~~~~~~ Helpers ~~~~~~~~~~~~~~~~~~~~
+    def _compact_metadata(self):
+        '''
+        Return up to metadata_vacuum_pages free pages of local_metadata to the
+        filesystem. Deletes leave free pages behind rather than rewriting the db,
+        this reclaims them in bounded steps before the db is pushed
+        '''
+        con = sqlite3.connect(self.local_metadata)
+        free_pages = con.execute('''PRAGMA freelist_count''').fetchone()[0]
+        if free_pages:
+            pages = int(self.prefs.get('metadata_vacuum_pages', 512))
+            self._log_location("reclaiming {0} of {1} free pages".format(
+                min(pages, free_pages), free_pages))
+            con.execute('''PRAGMA incremental_vacuum({0})'''.format(pages)).fetchall()
+        con.close()
+
     def _cover_to_thumb(self, metadata):
         '''
         Generate a cover thumb in base64 encoding
@@ -796,6 +874,34 @@ if True:
             self._log("ERROR: no cover available for '%s'" % metadata.title)
         return thumb
 
+    def _create_metadata_table(self, conn):
+        '''
+        Create the current metadata schema in conn.
+        Thumbs are stored as JPEG bytes in the last column so that scans not
+        reading them stop short of their overflow pages. basename and uuid are
+        indexed for move detection and lookups.
+        auto_vacuum only applies here to a new db, see _enable_incremental_vacuum()
+        '''
+        conn.execute('''PRAGMA auto_vacuum=INCREMENTAL''')
+        conn.execute('''
+                     CREATE TABLE IF NOT EXISTS metadata
+                         (
+                         authors TEXT,
+                         author_sort TEXT,
+                         basename TEXT,
+                         dateadded INTEGER,
+                         filename TEXT UNIQUE,
+                         size INTEGER,
+                         title TEXT,
+                         title_sort TEXT,
+                         uuid TEXT,
+                         thumb_data BLOB
+                         )
+                     ''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS metadata_basename ON metadata(basename)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS metadata_uuid ON metadata(uuid)''')
+        conn.execute('''PRAGMA user_version={0}'''.format(self.METADATA_SCHEMA_VERSION))
+
     def _create_new_book(self, fpath, metadata, thumb):
         '''
         '''
@@ -809,8 +915,7 @@ if True:
         this_book.datetime = datetime.fromtimestamp(this_book.dateadded).timetuple()
         this_book.path = self.path_template.format(metadata.title, metadata.authors[0], format)
         this_book.size = os.path.getsize(fpath)
-        this_book.thumbnail = self._cover_to_thumb(metadata)
-        this_book.thumb_data = base64.b64encode(this_book.thumbnail)
+        this_book.thumbnail = thumb
         this_book.title_sort = metadata.title_sort
         this_book.uuid = metadata.uuid
 
@@ -821,39 +926,58 @@ if True:
             self._log("title_sort: %s" % this_book.title_sort)
         return this_book
 
-    def _escape_delimiters(self, s):
+    def _enable_incremental_vacuum(self, conn):
         '''
-        Switch double quotes to single quotes, escape single quotes, return as unicode
+        Switch an existing db to auto_vacuum=INCREMENTAL, which requires a VACUUM.
+        Return True if the db was rewritten
         '''
-        #self._log_location(repr(s))
-        s = s.replace("'", "\'")
-        s = s.replace('"', '\'')
-        return unicode(s)
+        if conn.execute('''PRAGMA auto_vacuum''').fetchone()[0] == 2:
+            return False
+        self._log_location("enabling incremental vacuum")
+        conn.execute('''PRAGMA auto_vacuum=INCREMENTAL''')
+        conn.execute('''VACUUM''')
+        return True
 
-    def _get_cached_metadata(self, cur, book):
+    def _extract_metadata(self, book, book_stats):
+        '''
+        MetadataWorkerPool job: return _get_metadata(), then release book_stats['stream']
+        and any local copy
+        '''
+        try:
+            return self._get_metadata(book, book_stats)
+        finally:
+            book_stats['stream'].close()
+            if book_stats['path']:
+                os.remove(book_stats['path'])
+
+    def _get_cached_metadata(self, cur, book, cached_rows=None):
         '''
         Return a populated Book object from a cached book's metadata
-        format(self._quote_sqlite_identifier(book)))
+        cached_rows: {filename: row} preloaded by books(), falling back to a
+        single-row query for books not in the map
         '''
-        self._log_location(book)
-
-        cur.execute('''
-                        SELECT
-                         authors,
-                         author_sort,
-                         dateadded,
-                         filename,
-                         size,
-                         thumb_data,
-                         title,
-                         title_sort,
-                         uuid
-                        FROM metadata
-                        WHERE filename={0}
-                    '''.format(self._quote_sqlite_identifier(book))
-                   )
-
-        cached_book = cur.fetchone()
+        cached_book = None
+        if cached_rows is not None:
+            cached_book = cached_rows.get(book)
+
+        if cached_book is None:
+            self._log_location(book)
+            cur.execute('''
+                            SELECT
+                             authors,
+                             author_sort,
+                             dateadded,
+                             filename,
+                             size,
+                             thumb_data,
+                             title,
+                             title_sort,
+                             uuid
+                            FROM metadata
+                            WHERE filename = ?
+                        ''', (book,))
+            cached_book = cur.fetchone()
+
         if cached_book:
             #self._log(cached_book.keys())
 
@@ -863,7 +987,7 @@ if True:
             this_book.path = cached_book[b'filename']
             this_book.size = cached_book[b'size']
             if cached_book[b'thumb_data']:
-                this_book.thumbnail = base64.b64decode(cached_book[b'thumb_data'])
+                this_book.thumbnail = bytes(cached_book[b'thumb_data'])
             else:
                 this_book.thumbnail = None
             this_book.title_sort = cached_book[b'title_sort']
@@ -897,19 +1021,16 @@ if True:
         '''
         from calibre.ebooks.metadata import author_to_author_sort, authors_to_string, title_sort
         self._log_location(repr(book))
-        format = book.rsplit('.')[1].lower()
+        format = book.rpartition('.')[2].lower()
+        stream = book_stats['stream']
         if format == 'mobi':
             from calibre.ebooks.metadata.mobi import get_metadata as get_mobi_metadata
-            path = os.path.join(self.temp_dir, book_stats['path'])
-            with open(path, 'rb') as f:
-                stream = cStringIO.StringIO(f.read())
             mi = get_mobi_metadata(stream)
+            if isinstance(stream, RemoteRangeFile):
+                self._log("fetched {0:,} of {1:,} bytes".format(stream.bytes_fetched, stream.size))
 
         elif format == 'pdf':
             from calibre.ebooks.metadata.pdf import get_metadata as get_pdf_metadata
-            path = os.path.join(self.temp_dir, book_stats['path'])
-            with open(path, 'rb') as f:
-                stream = cStringIO.StringIO(f.read())
             mi = get_pdf_metadata(stream)
 
         else:
@@ -933,37 +1054,72 @@ if True:
         this_book.path = book
         this_book.size = int(book_stats['stats']['st_size'])
         this_book.thumbnail = self._get_kindle_thumb(mi.cover_data[1])
-        if this_book.thumbnail:
-            this_book.thumb_data = base64.b64encode(this_book.thumbnail)
-        else:
-            this_book.thumb_data = None
         this_book.title_sort = title_sort(mi.title)
         this_book.uuid = None
 
         return this_book
 
-    def _get_nested_folder_contents(self, top_folder):
+    def _get_nested_folder_contents(self, top_folder, snapshot_name=None):
         '''
         Walk the contents of documents folder iteratively to get all nested files
+        Return {relative path: stats} from the folder listings
+        If snapshot_name is given, each folder's mtime and children are saved per
+        device, and folders whose mtime is unchanged on the next walk are not
+        re-listed. Files changed in place without touching their folder keep
+        their previous stats
         '''
-        def _get_nested_files(folder, stats, file_list):
-            files = self.ios.listdir('/'.join([top_folder, folder]))
+        def _walk(folder, folder_stats):
+            path = '/'.join([top_folder, folder]) if folder else top_folder
+            if folder_stats is None:
+                folder_stats = self.ios.stat(path)
+            mtime = folder_stats.get('st_mtime') if folder_stats else None
+            cached = snapshot.get(folder)
+            if cached and mtime is not None and cached['mtime'] == mtime:
+                files, dirs = cached['files'], dict.fromkeys(cached['dirs'])
+                stats['reused'] += 1
+            else:
+                files, dirs = {}, {}
+                listing = LazyStatDict(self.ios, path)
+                listing.prefetch()
+                for f in listing:
+                    if listing[f]['st_ifmt'] == 'S_IFREG':
+                        files[f] = listing[f]
+                    elif listing[f]['st_ifmt'] == 'S_IFDIR':
+                        dirs[f] = listing[f]
+                stats['listed'] += 1
+            updated[folder] = {'mtime': mtime, 'files': files, 'dirs': sorted(dirs)}
+
             for f in files:
-                if files[f]['st_ifmt'] == 'S_IFREG':
-                    file_list.append('/'.join([folder, f]))
-                elif files[f]['st_ifmt'] == 'S_IFDIR':
-                    file_list = _get_nested_files(f, files[f], file_list)
-            return file_list
+                file_list['/'.join([folder, f]) if folder else f] = files[f]
+            for d in dirs:
+                _walk('/'.join([folder, d]) if folder else d, dirs[d])
 
         self._log_location(top_folder)
 
-        file_list = []
-        files = self.ios.listdir(top_folder)
-        for f in files:
-            if files[f]['st_ifmt'] == 'S_IFREG':
-                file_list.append(f)
-            elif files[f]['st_ifmt'] == 'S_IFDIR':
-                file_list = _get_nested_files(f, files[f], file_list)
+        snapshot = {}
+        snapshot_path = None
+        if snapshot_name and self.ios_connection['udid']:
+            snapshot_path = os.path.join(self.cache_dir, "%s_%s.json" % (
+                snapshot_name, self.ios_connection['udid']))
+            if os.path.exists(snapshot_path):
+                try:
+                    with open(snapshot_path, 'rb') as f:
+                        snapshot = json.load(f)
+                except:
+                    self._log("unable to read folder snapshot '%s'" % snapshot_path)
+                    snapshot = {}
+
+        file_list = {}
+        stats = {'listed': 0, 'reused': 0}
+        updated = {}
+        _walk('', None)
+        self._log("folders listed: %d reused: %d" % (stats['listed'], stats['reused']))
+
+        if snapshot_path:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(snapshot_path, 'wb') as f:
+                json.dump(updated, f)
         return file_list
 
     def _localize_database_path(self, remote_db_path):
@@ -990,9 +1146,11 @@ if True:
         if db_stats:
             full_path = _build_local_path()
             if os.path.exists(full_path):
+                # Unpushed local changes are newer than the device copy
                 lfs = os.stat(full_path)
-                if (int(db_stats['st_mtime']) == lfs.st_mtime and
-                    int(db_stats['st_size']) == lfs.st_size):
+                if (self.metadata_dirty or
+                    (int(db_stats['st_mtime']) == lfs.st_mtime and
+                     int(db_stats['st_size']) == lfs.st_size)):
                     local_db_path = full_path
 
             if not local_db_path:
@@ -1004,24 +1162,11 @@ if True:
             self._log("creating local metadata db '%s'" % local_db_path)
             conn = sqlite3.connect(local_db_path)
             conn.row_factory = sqlite3.Row
-            conn.execute('''PRAGMA user_version={0}'''.format(1))
-            conn.executescript('''
-                                CREATE TABLE IF NOT EXISTS metadata
-                                    (
-                                    authors TEXT,
-                                    author_sort TEXT,
-                                    dateadded INTEGER,
-                                    filename TEXT UNIQUE,
-                                    size INTEGER,
-                                    thumb_data BLOB,
-                                    title TEXT,
-                                    title_sort TEXT,
-                                    uuid TEXT
-                                    );
-                                ''')
+            self._create_metadata_table(conn)
             conn.commit()
             conn.close()
 
+        self._upgrade_metadata_schema(local_db_path)
         return {'path': local_db_path, 'stats': db_stats}
 
     def _localize_mobi(self, remote_path):
@@ -1030,8 +1175,11 @@ if True:
         '''
         self._log_location("remote_path: '%s'" % (remote_path))
 
+        # Prefix with a digest of remote_path so same-named books in different
+        # folders don't collide while waiting for a metadata worker
         local_path = None
-        path = remote_path.split('/')[-1]
+        path = '-'.join([hashlib.md5(remote_path.encode('utf-8')).hexdigest()[:8],
+                         remote_path.split('/')[-1]])
         if iswindows:
             from calibre.utils.filenames import shorten_components_to
             plen = len(self.temp_dir)
@@ -1046,6 +1194,30 @@ if True:
 
         return local_path
 
+    def _push_metadata(self, defer=False):
+        '''
+        Copy local_metadata to the iDevice if it has changed since the last push.
+        defer=True leaves a pending push for sync_booklists() or eject(), so the
+        db is copied once per job rather than once per operation
+        '''
+        if not self.metadata_dirty:
+            self._log_location("remote_metadata unchanged")
+            return
+        if defer:
+            self._log_location("deferring remote_metadata update")
+            return
+
+        self._log_location("updating remote_metadata")
+        self._compact_metadata()
+        self.ios.copy_to_idevice(str(self.local_metadata), str(self.remote_metadata))
+        self.metadata_dirty = False
+
+        # Match the local mtime to the device copy so the next books() reuses it
+        db_stats = self.ios.stat(self.remote_metadata)
+        if db_stats:
+            mtime = int(db_stats['st_mtime'])
+            os.utime(self.local_metadata, (mtime, mtime))
+
     def _reset_ios_connection(self,
                               app_installed=False,
                               device_name=None,
@@ -1061,9 +1233,83 @@ if True:
 
             self._log_location(connection_state)
 
+        # Mounted containers belong to the previous device
+        if self.ios_connection['udid'] and self.ios_connection['udid'] != udid:
+            self.afc_sessions.close_all()
+
         self.ios_connection['app_installed'] = app_installed
         self.ios_connection['connected'] = False
         self.ios_connection['device_name'] = device_name
         self.ios_connection['udid'] = udid
 
+        # Unpushed changes can't follow a different device
+        self.metadata_dirty = False
+
+    def _track_metadata_changes(self, con):
+        '''
+        Flag local_metadata for pushing if con modified it
+        '''
+        if con.total_changes:
+            self.metadata_dirty = True
+
+    def _upgrade_metadata_schema(self, local_db_path):
+        '''
+        Migrate local_db_path in place to METADATA_SCHEMA_VERSION.
+        v1 stored base64 thumbs with the columns in alphabetical order, no indexes.
+        The migration runs as a single transaction, so an interrupted upgrade
+        leaves the v1 table intact
+        '''
+        conn = sqlite3.connect(local_db_path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        version = conn.execute('''PRAGMA user_version''').fetchone()[0]
+        if version >= self.METADATA_SCHEMA_VERSION:
+            if self._enable_incremental_vacuum(conn):
+                self.metadata_dirty = True
+            conn.close()
+            return
+
+        self._log_location("upgrading metadata schema v{0} -> v{1}".format(
+            version, self.METADATA_SCHEMA_VERSION))
+        conn.execute('''BEGIN''')
+        try:
+            conn.execute('''ALTER TABLE metadata RENAME TO metadata_v1''')
+            self._create_metadata_table(conn)
+            rows = []
+            for row in conn.execute('''SELECT * FROM metadata_v1'''):
+                try:
+                    thumb = base64.b64decode(row[b'thumb_data']) if row[b'thumb_data'] else None
+                except TypeError:
+                    thumb = None
+                rows.append((row[b'authors'],
+                             row[b'author_sort'],
+                             row[b'filename'].rpartition('/')[2],
+                             row[b'dateadded'],
+                             row[b'filename'],
+                             row[b'size'],
+                             row[b'title'],
+                             row[b'title_sort'],
+                             row[b'uuid'],
+                             sqlite3.Binary(thumb) if thumb else None))
+            conn.executemany('''INSERT INTO metadata
+                                 (authors,
+                                  author_sort,
+                                  basename,
+                                  dateadded,
+                                  filename,
+                                  size,
+                                  title,
+                                  title_sort,
+                                  uuid,
+                                  thumb_data)
+                                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            conn.execute('''DROP TABLE metadata_v1''')
+            conn.execute('''COMMIT''')
+        except:
+            conn.execute('''ROLLBACK''')
+            conn.close()
+            raise
+        self._enable_incremental_vacuum(conn)
+        conn.close()
 
+        # Replace the v1 copy on the iDevice
+        self.metadata_dirty = True
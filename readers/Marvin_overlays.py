@@ -7,6 +7,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 import atexit, base64, copy, cStringIO, hashlib, json, locale, os, posixpath, re, sqlite3, sys, time
 from datetime import datetime
 from lxml import etree, html
+from threading import Event, Thread
 
 from calibre import guess_type
 from calibre.constants import islinux, isosx, iswindows
@@ -21,10 +22,10 @@ from calibre.utils.icu import sort_key
 from calibre.utils.magick.draw import thumbnail
 from calibre.utils.zipfile import ZipFile, ZIP_STORED
 
-from calibre_plugins.ios_reader_apps import (Book, BookList,
-    DatabaseMalformedException, DatabaseNotFoundException, InvalidEpub,
-    iOSReaderApp, ReaderAppSignals,
-    from_json, get_cc_mapping, set_cc_mapping, to_json)
+from calibre_plugins.ios_reader_apps import (Book, BookList, CommandFuture,
+    DatabaseMalformedException, DatabaseNotFoundException, DevicePresenceMonitor,
+    InvalidEpub, iOSReaderApp, LazyStatDict, PresenceSnapshot, ReaderAppSignals,
+    from_json, get_cc_mapping, serialized_io, set_cc_mapping, to_json)
 
 IOS_COMMUNICATION_ERROR_DETAILS = (
     "Calibre is unable to communicate with your iDevice.\n\n" +
@@ -88,6 +89,13 @@ if True:
         </manifest>
         </{0}>'''
 
+        # Capability advertised in connected.xml by Marvin versions accepting
+        # covers staged as separate files rather than base64 inline in the manifest
+        self.COVER_FILES_CAPABILITY = 'coverfiles'
+
+        # Minimum interval in seconds between stats of connected.xml in can_handle()
+        self.CONNECTED_PROBE_INTERVAL = self.prefs.get('connected_probe_interval', 3.0)
+
         self.DEBUG_CAN_HANDLE = self.prefs.get('debug_can_handle', False)
         self.DEVICE_PLUGBOARD_NAME = 'MARVIN'
 
@@ -98,6 +106,12 @@ if True:
 
         # ~~~~~~~~~ Variables ~~~~~~~~~
         self.__busy = False
+        # Set while no command submitted to Marvin is awaiting completion
+        self.__command_idle = Event()
+        self.__command_idle.set()
+        # Cleared while another libiMobileDevice client holds the busy flag
+        self.__io_idle = Event()
+        self.__io_idle.set()
 
         # Initialize the IO components with iOS path separator
         self.staging_folder = '/'.join(['/Library', 'calibre'])
@@ -105,6 +119,7 @@ if True:
         self.booklist_subpath = '/'.join([self.REMOTE_CACHE_FOLDER, 'booklist.db'])
         self.books_subpath = '/Library/mainDb.sqlite'
         self.connected_fs = '/'.join([self.staging_folder, 'connected.xml'])
+        self.connected_probe = {'checked': 0.0, 'connection': None, 'stat_key': None}
         self.flags = {
             'new': 'NEW',
             'read': 'READ',
@@ -119,9 +134,10 @@ if True:
             'udid': 0
             }
         self.local_booklist_db_path = None
+        self.marvin_capabilities = set()
         self.marvin_version = (1,0,0)
-        self.operation_timed_out = False
         self.path_template = '{0}.epub'
+        self.pending_covers = {}
         self.status_fs = '/'.join([self.staging_folder, 'status.xml'])
         self.update_list = []
 
@@ -140,6 +156,9 @@ if True:
         # ~~~~~~~~~ Create a device signal class for Marvin Manager ~~~~~~~~~
         self.marvin_device_signals = ReaderAppSignals()
 
+        # ~~~~~~~~~ Presence monitor starts once can_handle() finds Marvin ~~~~~~~~~
+        self._stop_presence_monitor()
+
         # Hook exit
         atexit.register(self.shutdown)
 
@@ -196,6 +215,7 @@ if True:
         for new_book in locations[0]:
             booklists[0].append(new_book)
 
+    @serialized_io
     def books(self, oncard=None, end_session=True):
         '''
         Return a list of ebooks on the device.
@@ -214,10 +234,10 @@ if True:
             '''
             Given book_hash, retrieve the associated small jpg cover
             '''
-            cover_path = '/'.join([self._cover_subpath(size="small"), '%s.jpg' % book_hash])
+            cover_name = '%s.jpg' % book_hash
             cover_bytes = None
-            stats = self.ios.exists(cover_path, silent=True)
-            if stats:
+            if cover_name in cover_listing:
+                cover_path = '/'.join([cover_listing.path, cover_name])
                 cover_bytes = self.ios.read(cover_path, mode='rb')
             else:
                 if self.prefs.get('development_mode', False):
@@ -339,6 +359,11 @@ if True:
                         self.cached_books = {}
                         raise DatabaseMalformedException("Marvin database is damaged")
 
+                    # One listing each of the covers and /Documents, entries are
+                    # stat'ed only when a book needs its size
+                    cover_listing = LazyStatDict(self.ios, self._cover_subpath(size="small"))
+                    documents = LazyStatDict(self.ios, '/Documents')
+
                     for i in range(book_count):
                         row = cur.fetchone()
                         book_id = row[b'id_']
@@ -379,7 +404,12 @@ if True:
                                 details = IOS_COMMUNICATION_ERROR_DETAILS,
                                 level=UserFeedback.ERROR)
                         """
-                        _file_size = self.ios.stat('/'.join(['/Documents', this_book.path]))
+                        if this_book.path in documents:
+                            _file_size = documents[this_book.path]
+                        elif '/' in this_book.path:
+                            _file_size = self.ios.stat('/'.join(['/Documents', this_book.path]))
+                        else:
+                            _file_size = {}
                         if not _file_size:
                             self._log("*** Error: File listed in mainDb, not found in /Documents: {0} ***".format(this_book.path))
                             continue
@@ -453,6 +483,8 @@ if True:
         serial number)
 
         This gets called ~1x/second while device fingerprint is sensed
+        If the presence monitor is running, return its latest snapshot,
+        otherwise probe synchronously
 
         libiMobileDevice instantiated in initialize()
         self.connected_path is path to Documents/calibre/connected.xml
@@ -469,169 +501,20 @@ if True:
                                  connected:True, app_installed:True
 
         '''
-
-        def _show_current_connection():
-            return("connected:{0:1} ejected:{1:1} app_installed:{2:1}".format(
-                self.ios_connection['connected'],
-                self.ejected,
-                self.ios_connection['app_installed'])
-                )
-
-        # ~~~ Entry point ~~~
-
-        if self.DEBUG_CAN_HANDLE:
-            self._log_location(_show_current_connection())
-
-        # If another libiMobileDevice client is talking, return True
-        if self.__busy:
-            return True
-
-        self.__busy = True
-
-        # 0: If we've already discovered a connected device without Marvin, exit
-        if self.ios_connection['udid'] and self.ios_connection['app_installed'] is False:
-            if self.DEBUG_CAN_HANDLE:
-                self._log("self.ios_connection['udid']: %s" % self.ios_connection['udid'])
-                self._log("self.ios_connection['app_installed']: %s" % self.ios_connection['app_installed'])
-                self._log("0: returning %s" % self.ios_connection['app_installed'])
-            self.__busy = False
-            return self.ios_connection['app_installed']
-
-        # 0. If user ejected, exit
-        if self.ios_connection['udid'] and self.ejected is True:
-            if self.DEBUG_CAN_HANDLE:
-                self._log("'%s' ejected" % self.ios_connection['device_name'])
-            self.__busy = False
-            return False
-
-        # 1: Is there a (single) connected iDevice?
-        if False and self.DEBUG_CAN_HANDLE:
-            self._log("1. self.ios_connection: %s" % _show_current_connection())
-
-        connected_ios_devices = self.ios.get_device_list()
-
-        if len(connected_ios_devices) == 1:
-            '''
-            If we have an existing USB connection, determine state
-             Three possible outcomes:
-              a) connected.xml exists (<state> = 'online')
-              b) connected.xml exists (<state> = 'offline')
-              c) connected.xml does not exist (User not in connection mode)
-            '''
-            if self.ios_connection['connected']:
-                connection_live = False
-                if self.ios.exists(self.connected_fs):
-                    # Parse the connection data for state
-                    connection = etree.fromstring(self.ios.read(self.connected_fs))
-                    connection_state = connection.find('state').text
-                    if connection_state == 'online':
-                        connection_live = True
-                        if self.DEBUG_CAN_HANDLE:
-                            self._log("1a. <state> = online")
-                    else:
-                        connection_live = False
-                        if self.DEBUG_CAN_HANDLE:
-                            self._log("1b. <state> = offline")
-
-                    # Show the connection initiation time
-                    self.connection_timestamp = float(connection.get('timestamp'))
-                    d = datetime.fromtimestamp(self.connection_timestamp)
-                    if self.DEBUG_CAN_HANDLE:
-                        self._log("   connection last refreshed %s" % (d.strftime('%Y-%m-%d %H:%M:%S')))
-
-                else:
-                    if self.DEBUG_CAN_HANDLE:
-                        self._log("1c. user exited connection mode")
-
-                if not connection_live:
-                    # Lost the connection, reset
-                    #self._reset_ios_connection(udid=connected_ios_devices[0])
-                    self.ios_connection['connected'] = False
-
-                if self.DEBUG_CAN_HANDLE:
-                    self._log("1d: returning %s" % connection_live)
-                self.__busy = False
-                return connection_live
-
-            elif self.ios_connection['udid'] != connected_ios_devices[0]:
-                self._reset_ios_connection(udid=connected_ios_devices[0], verbose=self.DEBUG_CAN_HANDLE)
-
-            # 2. Is Marvin installed on this iDevice?
-            if not self.ios_connection['app_installed']:
-                if self.DEBUG_CAN_HANDLE:
-                    self._log("2. Marvin installed, attempting connection")
-                self.ios_connection['app_installed'] = self.ios.mount_ios_app(app_id=self.app_id)
-                self.ios_connection['device_name'] = self.ios.device_name
-                if self.DEBUG_CAN_HANDLE:
-                    self._log("2a. self.ios_connection: %s" % _show_current_connection())
-
-                # If no Marvin, we can't handle, so exit
-                if not self.ios_connection['app_installed']:
-                    if self.DEBUG_CAN_HANDLE:
-                        self._log("2. Marvin not installed")
-                    self.__busy = False
-                    return self.ios_connection['app_installed']
-
-            # 3. Check to see if connected.xml exists in staging folder
+        monitor = self.presence_monitor
+        if monitor is not None:
+            snapshot = monitor.snapshot
             if self.DEBUG_CAN_HANDLE:
-                self._log("3. Looking for calibre connection mode")
-
-            connection_live = False
-            if self.ios.exists(self.connected_fs, silent=True):
-                # Parse the connection data for state
-                connection = etree.fromstring(self.ios.read(self.connected_fs))
-                connection_state = connection.find('state').text
-                if connection_state == 'online':
-                    connection_live = True
-                    if self.DEBUG_CAN_HANDLE:
-                        self._log("3a. <state> = online")
-                else:
-                    connection_live = False
-                    if self.DEBUG_CAN_HANDLE:
-                        self._log("3b. <state> = offline")
-
-                # Show the connection initiation time
-                self.connection_timestamp = float(connection.get('timestamp'))
-                d = datetime.fromtimestamp(self.connection_timestamp)
-                if self.DEBUG_CAN_HANDLE:
-                    self._log("   connection last refreshed %s" % (d.strftime('%Y-%m-%d %H:%M:%S')))
-
-                # Store Marvin version as tuple
-                mv = connection.get('marvin')
-                if mv:
-                    self.marvin_version = self._parse_version(mv)
-                self._log("Marvin version: %s" % (repr(self.marvin_version)))
-
-                self.ios_connection['connected'] = connection_live
-
-            else:
-                self.ios_connection['connected'] = False
-                if self.DEBUG_CAN_HANDLE:
-                    self._log("3d. Marvin not in calibre connection mode")
-
-        elif len(connected_ios_devices) == 0:
-            self._log_location("no connected devices")
-            self._reset_ios_connection()
-            self.ios.disconnect_idevice()
-
-        elif len(connected_ios_devices) > 1:
-            self._log_location()
-            self._log("%d iDevices detected. Driver supports a single connected iDevice." %
-                                len(connected_ios_devices))
-            self._reset_ios_connection()
-            self.ios.disconnect_idevice()
+                self._log_location(snapshot)
+            return snapshot.connected
 
-        # 4. show connection
-        if self.DEBUG_CAN_HANDLE:
-            self._log("4. self.ios_connection: %s" % _show_current_connection())
-
-        self.__busy = False
-
-        # Signal MM if disconnected
-        if not self.ios_connection['connected']:
-            self.marvin_device_signals.reader_app_status_changed.emit({'cmd':'disconnected'})
+        with self.ios_lock:
+            connected = self._probe_presence()
 
-        return self.ios_connection['connected']
+        # Move presence detection off the device-scan thread while Marvin is connected
+        if connected and self.prefs.get('presence_monitor_enabled', True):
+            self._start_presence_monitor()
+        return connected
 
     def can_handle_windows(self, device_info, debug=False):
         '''
@@ -642,6 +525,7 @@ if True:
         #self._log_location("returning %s from can_handle()" % repr(result))
         return result
 
+    @serialized_io
     def delete_books(self, paths, end_session=True, completed=True):
         '''
         Delete books at paths on device.
@@ -699,15 +583,19 @@ if True:
         '''
         self._log_location()
 
+        self._stop_presence_monitor()
+
         # If busy in critical IO operation, wait for completion before returning
-        while self.__busy:
-            time.sleep(0.10)
-            Application.processEvents()
+        IDLE_TIMEOUT = 30.0
+        self._wait_for_event(self.__io_idle, 'device I/O', IDLE_TIMEOUT)
+        self._wait_for_event(self.__command_idle, 'Marvin command', IDLE_TIMEOUT)
+        self.afc_sessions.close_all()
         self.ejected = True
 
     def get_busy_flag(self):
         return self.__busy
 
+    @serialized_io
     def get_file(self, path, outfile, end_session=True):
         '''
         Read the file at path on the device and write it to provided outfile.
@@ -753,34 +641,14 @@ if True:
                 self.ejected = False
             return False, None
 
-        vendors_on_system = set([x[0] for x in devices_on_system])
-        vendors = self.VENDOR_ID if hasattr(self.VENDOR_ID, '__len__') else [self.VENDOR_ID]
-        if hasattr(self.VENDOR_ID, 'keys'):
-            products = []
-            for ven in self.VENDOR_ID:
-                products.extend(self.VENDOR_ID[ven].keys())
-        else:
-            products = self.PRODUCT_ID if hasattr(self.PRODUCT_ID, '__len__') else [self.PRODUCT_ID]
-
-        for vid in vendors:
-            if vid in vendors_on_system:
-                for dev in devices_on_system:
-                    cvid, pid, bcd = dev[:3]
-                    if cvid == vid:
-                        if pid in products:
-                            if hasattr(self.VENDOR_ID, 'keys'):
-                                try:
-                                    cbcd = self.VENDOR_ID[vid][pid]
-                                except KeyError:
-                                    # Vendor vid does not have product pid, pid
-                                    # exists for some other vendor in this
-                                    # device
-                                    continue
-                            else:
-                                cbcd = self.BCD
-                            if self.test_bcd(bcd, cbcd):
-                                if self.can_handle(dev, debug=debug):
-                                    return True, dev
+        # Match against the fingerprint sets built once in iOSReaderApp
+        for dev in devices_on_system:
+            cvid, pid, bcd = dev[:3]
+            if (cvid in self.USB_VENDOR_IDS and
+                    pid in self.USB_PRODUCT_IDS and
+                    bcd in self.USB_BCDS):
+                if self.can_handle(dev, debug=debug):
+                    return True, dev
 
         return False, None
 
@@ -871,6 +739,7 @@ if True:
         self.ios_connection['connected'] = False
         self.marvin_device_signals.reader_app_status_changed.emit({'cmd':'yanked'})
 
+    @serialized_io
     def prepare_addable_books(self, paths):
         '''
         Given a list of paths, returns another list of paths. These paths
@@ -955,6 +824,10 @@ if True:
         Another libiMobileDevice wants to talk to the connected iDevice uninterrupted
         '''
         self.__busy = value
+        if value:
+            self.__io_idle.clear()
+        else:
+            self.__io_idle.set()
 
     def shutdown(self):
         '''
@@ -963,13 +836,45 @@ if True:
         '''
         self._log_location()
         self.eject()
-        self.ios.disconnect_idevice()
 
     def startup(self):
         self._log_location()
         self._dump_installed_plugins()
         self._log("Waiting for calibre connector...")
 
+    def submit_command(self, command_name, command_soup, send_signal=True):
+        '''
+        Stage a command for Marvin and return a CommandFuture without waiting
+        for completion. Progress and completion are delivered through
+        marvin_device_signals.reader_app_command_progress and
+        reader_app_command_completed. can_handle() reports busy until the
+        command completes, so other device I/O should not be issued while
+        the future is pending.
+        Marvin processes one command at a time: a pending command is allowed
+        to complete before the new command is staged.
+        '''
+        COMMAND_TIMEOUT = 60.0
+
+        self._log_location(command_name)
+        while True:
+            if not self._wait_for_event(self.__command_idle, 'Marvin command', COMMAND_TIMEOUT):
+                raise UserFeedback("Marvin is busy with a previous command.",
+                                    details=None, level=UserFeedback.WARN)
+
+            # Claim the idle command slot and stage in one critical section
+            with self.ios_lock:
+                if not self.__command_idle.is_set():
+                    continue
+                self.__command_idle.clear()
+                try:
+                    self._stage_command_file(command_name, command_soup,
+                        show_command=self.prefs.get('development_mode', False))
+                except:
+                    self.__command_idle.set()
+                    raise
+                return self._monitor_command(command_name, send_signal=send_signal)
+
+    @serialized_io
     def sync_booklists(self, booklists, end_session=True):
         '''
         Update metadata on device.
@@ -1254,6 +1159,7 @@ if True:
                 self._log("no metadata changes detected")
         """
 
+    @serialized_io
     def upload_books(self, files, names, on_card=None, end_session=True, metadata=None):
         '''
         Upload a list of books to the device. If a file already
@@ -1278,6 +1184,18 @@ if True:
             2) Marvin's completion of imports (50 - 100%)
         '''
 
+        def _stage(ios, job):
+            '''
+            Copy a queued book to the staging folder, confirming the staged size,
+            as older glue does not raise on a failed or partial write
+            '''
+            fpath, destination = job[0], job[1]
+            ios.copy_to_idevice(fpath, destination)
+            stats = ios.stat(destination)
+            if not stats or int(stats['st_size']) != os.path.getsize(fpath):
+                raise UserFeedback("'%s' was not completely staged" % destination,
+                                    details=None, level=UserFeedback.WARN)
+
         def _upload_subset(start, count, completed=False):
             '''
             Process a subset of books from index to count
@@ -1299,6 +1217,7 @@ if True:
 
             # Process the selected files
             metadata_updates = []
+            staged = []
 
             replaced_covers = 0
             for index, fpath in enumerate(files[start:start + count], start=start):
@@ -1426,9 +1345,9 @@ if True:
                 new_booklist.append(this_book)
 
                 if not metadata_only:
-                    # Copy the book file to the staging folder
+                    # Queue the book file for the staging folder
                     destination = '/'.join([self.staging_folder, book_tag['filename']])
-                    self.ios.copy_to_idevice(str(fpath), str(destination))
+                    staged.append((str(fpath), str(destination), book_tag, this_book, metadata[index]))
                     if target_epub_exists:
                         self.replaced_books.append({'title': metadata[index].title,
                                                     'authors': metadata[index].authors,
@@ -1466,6 +1385,20 @@ if True:
                         '%(num)d of %(tot)d staged' % dict(num=index + 1, tot=file_count))
                 self.current_step += 1
 
+            # Copy the queued books to the staging folder across the AFC client pool
+            if staged:
+                self._log("staging %d books" % len(staged))
+                for job, result, error in self.afc_sessions.pool(self.app_id).map(_stage, staged):
+                    if error:
+                        # Don't ask Marvin to import, or report as added, a book that wasn't staged
+                        fpath, destination, book_tag, this_book, mi = job
+                        self._log("error staging '%s'\n%s" % (destination, error))
+                        book_tag.extract()
+                        new_booklist.remove(this_book)
+                        self.cached_books.pop(this_book.path, None)
+                        self.replaced_books = [b for b in self.replaced_books if b['uuid'] != mi.uuid]
+                        self.failed_books.append({'title': mi.title, 'authors': mi.authors})
+
             manifest_count = len(upload_soup.manifest.findAll(True))
             if manifest_count:
                 # Report replaced_covers
@@ -1531,6 +1464,7 @@ if True:
             booklist_conn.execute('''VACUUM''')
 
         self.active_flags = {}
+        self.failed_books = []
         self.malformed_books = []
         self.metadata_updates = []
         self.skipped_books = []
@@ -1558,7 +1492,7 @@ if True:
         # Update local copy of mainDb
         self._localize_database_path(self.books_subpath)
 
-        if (self.malformed_books or self.skipped_books or
+        if (self.failed_books or self.malformed_books or self.skipped_books or
             self.metadata_updates or self.rejected_books or self.replaced_books):
             self._report_upload_results(len(files))
 
@@ -1657,6 +1591,8 @@ if True:
     def _create_cover_element(self, mi, soup):
         '''
         Return a <cover> element from mi
+        If Marvin accepts cover files, the element references a jpg copied to the
+        staging folder by _stage_command_file(), otherwise the cover is inline base64
         '''
         #self._log_location()
         cover_tag = None
@@ -1670,8 +1606,14 @@ if True:
 
             cover_tag = Tag(soup, 'cover')
             cover_tag['hash'] = cover_hash
-            cover_tag['encoding'] = 'base64'
-            cover_tag.insert(0, base64.b64encode(cover_bytes))
+            if self._use_cover_files():
+                cover_filename = '%s.jpg' % cover_hash
+                cover_tag['encoding'] = 'file'
+                cover_tag['filename'] = cover_filename
+                self.pending_covers[cover_filename] = mi.cover
+            else:
+                cover_tag['encoding'] = 'base64'
+                cover_tag.insert(0, base64.b64encode(cover_bytes))
         return cover_tag
 
     def _create_empty_booklist_db(self):
@@ -2059,6 +2001,47 @@ if True:
         self.local_db_path = local_db_path
         return local_db_path
 
+    def _monitor_command(self, command_name, send_signal=True):
+        '''
+        Start a thread monitoring status.xml for a staged command, return a
+        CommandFuture resolved when Marvin reports completion.
+        Completion is announced through reader_app_command_completed, followed by
+        reader_app_status_changed if send_signal.
+        '''
+        future = CommandFuture(command_name)
+        self.__command_idle.clear()
+
+        def _monitor():
+            result = None
+            error = None
+            try:
+                result = self._poll_command_status(future)
+            except Exception as e:
+                error = e
+            finally:
+                # Mark idle before resolving the future so the next command can be staged
+                self.__command_idle.set()
+
+            payload = {'cmd': command_name, 'code': None, 'messages': [], 'error': None}
+            if error is None:
+                payload.update(result)
+            else:
+                payload['error'] = unicode(error)
+            self.marvin_device_signals.reader_app_command_completed.emit(payload)
+            if send_signal and error is None:
+                # Emit a signal for Marvin Manager
+                self.marvin_device_signals.reader_app_status_changed.emit({'cmd': command_name})
+
+            if error is None:
+                future._set_result(result)
+            else:
+                future._set_exception(error)
+
+        monitor = Thread(target=_monitor, name="Marvin %s monitor" % command_name)
+        monitor.daemon = True
+        monitor.start()
+        return future
+
     def _parse_version(self, marvin_version):
         '''
         Convert version strings of the form '1', '1.0', '1.0.0' to version tuple
@@ -2087,77 +2070,445 @@ if True:
                              resolve_entities=True)[0].strip()
         return etree.fromstring(data, parser=RECOVER_PARSER)
 
-    def _profile_db(self):
+    def _poll_command_status(self, future):
         '''
-        Snapshot key aspects of mainDb
-        {'content_hash': <hash of Titles, Authors>,
-         'cover_size': size of the small covers folder (description?)
-         'Books': <len Books table>,
-         'BookCollections': <len BookCollections>,
-         'Collections': <len Collections> }
+        Monitor status.xml until Marvin reports completion of future.command_name.
+        Runs on the thread started by _monitor_command(), so it must not touch
+        the GUI event loop, or self.ios: status.xml is polled through a client
+        of its own, as driver I/O may resume while the command is pending.
+        Progress is posted to future.progress and reader_app_command_progress,
+        a watchdog timeout to future.timed_out.
+        Return {'code': final_code, 'messages': [msg, ...]}
         '''
+        command_name = future.command_name
+        self._log_location(command_name)
+        self._log("%s: waiting for '%s'" %
+                                     (datetime.now().strftime('%H:%M:%S.%f'),
+                                     self.status_fs))
 
-        profile = {}
-        con = sqlite3.connect(self.local_db_path)
-        with con:
-            con.row_factory = sqlite3.Row
-            cur = con.cursor()
-
-            # Hash the titles and authors
-            m = hashlib.md5()
-            cur.execute('''SELECT Title, Author FROM Books''')
-            rows = cur.fetchall()
-            for row in rows:
-                m.update(row[b'Title'])
-                m.update(row[b'Author'])
-            profile['content_hash'] = m.hexdigest()
+        ios = self._new_ios_client()
+        if not ios.mount_ios_app(app_id=self.app_id):
+            raise UserFeedback("Unable to monitor Marvin command '%s'." % command_name,
+                                details=None, level=UserFeedback.WARN)
+        try:
+            return self._poll_status_xml(ios, future)
+        finally:
+            ios.disconnect_idevice()
 
-            # Save st_size for the small covers folder
-            stats = self.ios.stat(self._cover_subpath(size="small"))
-            profile['covers_size'] = stats.get('st_size', 0)
+    def _poll_status_xml(self, ios, future):
+        '''
+        Polling loop for _poll_command_status(), on the monitor's own client
+        '''
+        import traceback
+        from threading import Timer
 
-            # Get the table sizes
-            for table in ['Books', 'BookCollections', 'Collections']:
-                cur.execute('''SELECT * FROM '{0}' '''.format(table))
-                profile[table] = len(cur.fetchall())
+        command_name = future.command_name
 
-        return profile
+        # Set initial watchdog timer for ACK
+        WATCHDOG_TIMEOUT = 15.0
+        POLLING_DELAY = 1.0
+        watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out, [future])
+        future.timed_out = False
+        watchdog.start()
 
-    def _rehydrate_booklist(self, stored):
-        '''
-        Convert stored JSON to BookList()
-        '''
-        self._log_location()
-        all_iosra_keys = sorted(Book.iosra_standard_keys + Book.iosra_custom_keys)
+        while True:
+            if not ios.exists(self.status_fs, silent=True):
+                # status.xml not created yet
+                if future.timed_out:
+                    ios.remove(self.status_fs)
+                    raise UserFeedback("Marvin operation timed out.",
+                                        details=None, level=UserFeedback.WARN)
+                time.sleep(POLLING_DELAY)
 
-        # title and authors are populated when Book() instantiated
-        for key in ['title', 'authors']:
-            all_iosra_keys.remove(key)
+            else:
+                watchdog.cancel()
 
-        rehydrated = BookList(self)
-        for stored_book in stored:
-            this_book = Book(stored_book['title'], ', '.join(stored_book['authors']))
-            for prop in all_iosra_keys:
-                setattr(this_book, prop, stored_book.get(prop))
-            rehydrated.add_book(this_book, False)
-        return rehydrated
+                self._log("%s: monitoring progress of %s" %
+                                     (datetime.now().strftime('%H:%M:%S.%f'),
+                                      command_name))
 
-    def _remove_existing_copy(self, path, metadata):
-        '''
-        '''
-        pop_list = []
-        for book in self.cached_books:
+                # Start a new watchdog timer per iteration
+                watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out, [future])
+                future.timed_out = False
+                watchdog.start()
 
-            # Ignore books currently being downloaded
-            if 'download_pending' in self.cached_books[book]:
-                continue
+                code = '-1'
+                current_timestamp = 0.0
+                while code == '-1':
+                    try:
+                        if future.timed_out:
+                            ios.remove(self.status_fs)
+                            raise UserFeedback("Marvin operation timed out.",
+                                                details=None, level=UserFeedback.WARN)
 
-            matched = False
-            if self.cached_books[book]['uuid'] == metadata.uuid:
-                matched = True
-                self._log_location("'%s' matched on uuid '%s'" % (metadata.title, metadata.uuid))
-            elif (self.cached_books[book]['title'] == metadata.title and
-                  self.cached_books[book]['authors'] == metadata.authors):
+                        status = etree.fromstring(ios.read(self.status_fs))
+                        code = status.get('code')
+                        timestamp = float(status.get('timestamp'))
+                        if timestamp != current_timestamp:
+                            watchdog.cancel()
+                            current_timestamp = timestamp
+                            d = datetime.now()
+                            progress = float(status.find('progress').text)
+                            self._log("{0}: {1:>2} {2:>3}%".format(
+                                                 d.strftime('%H:%M:%S.%f'),
+                                                 code,
+                                                 "%3.0f" % (progress * 100)))
+
+                            # Report progress
+                            future.progress = progress
+                            self.marvin_device_signals.reader_app_command_progress.emit(
+                                {'cmd': command_name, 'progress': progress})
+
+                            # Reset watchdog timer
+                            watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out, [future])
+                            watchdog.start()
+                        time.sleep(POLLING_DELAY)
+
+                    except:
+                        watchdog.cancel()
+
+                        formatted_lines = traceback.format_exc().splitlines()
+                        current_error = formatted_lines[-1]
+
+                        time.sleep(POLLING_DELAY)
+
+                        self._log("{0}:  retry ({1})".format(
+                            datetime.now().strftime('%H:%M:%S.%f'),
+                            current_error))
+
+                        # Reset watchdog timer
+                        watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out, [future])
+                        watchdog.start()
+
+                # Command completed
+                watchdog.cancel()
+
+                final_code = status.get('code')
+                final_status = None
+                msgs = []
+                if final_code != '0':
+                    if final_code == '-1':
+                        final_status= "in progress"
+                    if final_code == '1':
+                        final_status = "warnings"
+                    if final_code == '2':
+                        final_status = "errors"
+
+                    messages = status.find('messages')
+                    msgs = [msg.text for msg in messages]
+
+                    # Capture the rejected epubs to report
+                    for msg in msgs:
+                        self.rejected_books.append(re.search('\[(.+)\]', msg).group(1))
+
+                    details = "code: %s\n" % final_code
+                    details += '\n'.join(msgs)
+                    self._log(details)
+
+                ios.remove(self.status_fs)
+
+                self._log("%s: '%s' complete" %
+                          (datetime.now().strftime('%H:%M:%S.%f'),
+                           command_name))
+                break
+
+        return {'code': final_code, 'messages': msgs}
+
+    def _presence_snapshot(self):
+        '''
+        Probe callable for DevicePresenceMonitor
+        Return None while another client holds the device or a command is pending
+        '''
+        if self.__busy or not self.__command_idle.is_set():
+            return None
+        connected = self._probe_presence()
+        return PresenceSnapshot(
+            app_installed=self.ios_connection['app_installed'],
+            connected=connected,
+            device_name=self.ios_connection['device_name'],
+            udid=self.ios_connection['udid'],
+            timestamp=time.time())
+
+    def _probe_connected_xml(self):
+        '''
+        Return the state published by Marvin in connected.xml:
+         {'marvin': <version tuple>|None, 'state': 'online'|'offline', 'timestamp': float}
+        or None if connected.xml does not exist.
+        connected.xml is stat'ed at most once per CONNECTED_PROBE_INTERVAL, and
+        only read and parsed when its size or mtime changes.
+        '''
+        probe = self.connected_probe
+        now = time.time()
+        if now - probe['checked'] < self.CONNECTED_PROBE_INTERVAL:
+            return probe['connection']
+        probe['checked'] = now
+
+        stats = self.ios.exists(self.connected_fs, silent=True)
+        if not stats:
+            probe['connection'] = None
+            probe['stat_key'] = None
+            return None
+
+        stat_key = (stats.get('st_size'), stats.get('st_mtime'))
+        if stat_key != probe['stat_key']:
+            connection = etree.fromstring(self.ios.read(self.connected_fs))
+            mv = connection.get('marvin')
+            probe['connection'] = {
+                'capabilities': set(re.split(r'[\s,]+', connection.get('capabilities', '').strip())) - set(['']),
+                'marvin': self._parse_version(mv) if mv else None,
+                'state': connection.find('state').text,
+                'timestamp': float(connection.get('timestamp'))
+                }
+            probe['stat_key'] = stat_key
+            if self.DEBUG_CAN_HANDLE:
+                self._log_location("connected.xml changed: %s" % probe['connection'])
+        return probe['connection']
+
+    def _probe_presence(self):
+        '''
+        Determine device, Marvin installation and connection mode state.
+        See can_handle() for ios_connection states.
+        Called from DevicePresenceMonitor, or from can_handle() if the monitor
+        is disabled
+        '''
+
+        def _show_current_connection():
+            return("connected:{0:1} ejected:{1:1} app_installed:{2:1}".format(
+                self.ios_connection['connected'],
+                self.ejected,
+                self.ios_connection['app_installed'])
+                )
+
+        # ~~~ Entry point ~~~
+
+        if self.DEBUG_CAN_HANDLE:
+            self._log_location(_show_current_connection())
+
+        # If another libiMobileDevice client is talking, or a command is pending, return True
+        if self.__busy or not self.__command_idle.is_set():
+            return True
+
+        self.__busy = True
+        was_connected = self.ios_connection['connected']
+
+        # 0: If we've already discovered a connected device without Marvin, exit
+        if self.ios_connection['udid'] and self.ios_connection['app_installed'] is False:
+            if self.DEBUG_CAN_HANDLE:
+                self._log("self.ios_connection['udid']: %s" % self.ios_connection['udid'])
+                self._log("self.ios_connection['app_installed']: %s" % self.ios_connection['app_installed'])
+                self._log("0: returning %s" % self.ios_connection['app_installed'])
+            self.__busy = False
+            return self.ios_connection['app_installed']
+
+        # 0. If user ejected, exit
+        if self.ios_connection['udid'] and self.ejected is True:
+            if self.DEBUG_CAN_HANDLE:
+                self._log("'%s' ejected" % self.ios_connection['device_name'])
+            self.__busy = False
+            return False
+
+        # 1: Is there a (single) connected iDevice?
+        if False and self.DEBUG_CAN_HANDLE:
+            self._log("1. self.ios_connection: %s" % _show_current_connection())
+
+        connected_ios_devices = self.ios.get_device_list()
+
+        if len(connected_ios_devices) == 1:
+            '''
+            If we have an existing USB connection, determine state
+             Three possible outcomes:
+              a) connected.xml exists (<state> = 'online')
+              b) connected.xml exists (<state> = 'offline')
+              c) connected.xml does not exist (User not in connection mode)
+            '''
+            if self.ios_connection['connected']:
+                connection_live = False
+                connection = self._probe_connected_xml()
+                if connection is not None:
+                    if connection['state'] == 'online':
+                        connection_live = True
+                        if self.DEBUG_CAN_HANDLE:
+                            self._log("1a. <state> = online")
+                    else:
+                        connection_live = False
+                        if self.DEBUG_CAN_HANDLE:
+                            self._log("1b. <state> = offline")
+
+                    # Show the connection initiation time
+                    self.connection_timestamp = connection['timestamp']
+                    d = datetime.fromtimestamp(self.connection_timestamp)
+                    if self.DEBUG_CAN_HANDLE:
+                        self._log("   connection last refreshed %s" % (d.strftime('%Y-%m-%d %H:%M:%S')))
+
+                else:
+                    if self.DEBUG_CAN_HANDLE:
+                        self._log("1c. user exited connection mode")
+
+                if not connection_live:
+                    # Lost the connection, reset
+                    #self._reset_ios_connection(udid=connected_ios_devices[0])
+                    self.ios_connection['connected'] = False
+
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("1d: returning %s" % connection_live)
+                self.__busy = False
+                return connection_live
+
+            elif self.ios_connection['udid'] != connected_ios_devices[0]:
+                self._reset_ios_connection(udid=connected_ios_devices[0], verbose=self.DEBUG_CAN_HANDLE)
+
+            # 2. Is Marvin installed on this iDevice?
+            if not self.ios_connection['app_installed']:
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("2. Marvin installed, attempting connection")
+                self.ios_connection['app_installed'] = self.afc_sessions.acquire(self.app_id)
+                self.ios_connection['device_name'] = self.ios.device_name
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("2a. self.ios_connection: %s" % _show_current_connection())
+
+                # If no Marvin, we can't handle, so exit
+                if not self.ios_connection['app_installed']:
+                    if self.DEBUG_CAN_HANDLE:
+                        self._log("2. Marvin not installed")
+                    self.__busy = False
+                    return self.ios_connection['app_installed']
+
+            # 3. Check to see if connected.xml exists in staging folder
+            if self.DEBUG_CAN_HANDLE:
+                self._log("3. Looking for calibre connection mode")
+
+            connection_live = False
+            connection = self._probe_connected_xml()
+            if connection is not None:
+                if connection['state'] == 'online':
+                    connection_live = True
+                    if self.DEBUG_CAN_HANDLE:
+                        self._log("3a. <state> = online")
+                else:
+                    connection_live = False
+                    if self.DEBUG_CAN_HANDLE:
+                        self._log("3b. <state> = offline")
+
+                # Show the connection initiation time
+                self.connection_timestamp = connection['timestamp']
+                d = datetime.fromtimestamp(self.connection_timestamp)
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("   connection last refreshed %s" % (d.strftime('%Y-%m-%d %H:%M:%S')))
+
+                # Store Marvin version as tuple
+                if connection['marvin']:
+                    self.marvin_version = connection['marvin']
+                self.marvin_capabilities = connection['capabilities']
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("Marvin version: %s" % (repr(self.marvin_version)))
+
+                self.ios_connection['connected'] = connection_live
+
+            else:
+                self.ios_connection['connected'] = False
+                if self.DEBUG_CAN_HANDLE:
+                    self._log("3d. Marvin not in calibre connection mode")
+
+        elif len(connected_ios_devices) == 0:
+            # Tear down once, when the device goes away
+            if self.ios_connection['udid']:
+                self._log_location("no connected devices")
+                self._reset_ios_connection()
+                self.afc_sessions.close_all()
+            self._stop_presence_monitor()
+
+        elif len(connected_ios_devices) > 1:
+            if self.ios_connection['udid']:
+                self._log_location()
+                self._log("%d iDevices detected. Driver supports a single connected iDevice." %
+                                    len(connected_ios_devices))
+                self._reset_ios_connection()
+                self.afc_sessions.close_all()
+            self._stop_presence_monitor()
+
+        # 4. show connection
+        if self.DEBUG_CAN_HANDLE:
+            self._log("4. self.ios_connection: %s" % _show_current_connection())
+
+        self.__busy = False
+
+        # Signal MM on the connected -> disconnected transition
+        if was_connected and not self.ios_connection['connected']:
+            self.marvin_device_signals.reader_app_status_changed.emit({'cmd':'disconnected'})
+
+        return self.ios_connection['connected']
+
+    def _profile_db(self):
+        '''
+        Snapshot key aspects of mainDb
+        {'content_hash': <hash of Titles, Authors>,
+         'cover_size': size of the small covers folder (description?)
+         'Books': <len Books table>,
+         'BookCollections': <len BookCollections>,
+         'Collections': <len Collections> }
+        '''
+
+        profile = {}
+        con = sqlite3.connect(self.local_db_path)
+        with con:
+            con.row_factory = sqlite3.Row
+            cur = con.cursor()
+
+            # Hash the titles and authors
+            m = hashlib.md5()
+            cur.execute('''SELECT Title, Author FROM Books''')
+            rows = cur.fetchall()
+            for row in rows:
+                m.update(row[b'Title'])
+                m.update(row[b'Author'])
+            profile['content_hash'] = m.hexdigest()
+
+            # Save st_size for the small covers folder
+            stats = self.ios.stat(self._cover_subpath(size="small"))
+            profile['covers_size'] = stats.get('st_size', 0)
+
+            # Get the table sizes
+            for table in ['Books', 'BookCollections', 'Collections']:
+                cur.execute('''SELECT * FROM '{0}' '''.format(table))
+                profile[table] = len(cur.fetchall())
+
+        return profile
+
+    def _rehydrate_booklist(self, stored):
+        '''
+        Convert stored JSON to BookList()
+        '''
+        self._log_location()
+        all_iosra_keys = sorted(Book.iosra_standard_keys + Book.iosra_custom_keys)
+
+        # title and authors are populated when Book() instantiated
+        for key in ['title', 'authors']:
+            all_iosra_keys.remove(key)
+
+        rehydrated = BookList(self)
+        for stored_book in stored:
+            this_book = Book(stored_book['title'], ', '.join(stored_book['authors']))
+            for prop in all_iosra_keys:
+                setattr(this_book, prop, stored_book.get(prop))
+            rehydrated.add_book(this_book, False)
+        return rehydrated
+
+    def _remove_existing_copy(self, path, metadata):
+        '''
+        '''
+        pop_list = []
+        for book in self.cached_books:
+
+            # Ignore books currently being downloaded
+            if 'download_pending' in self.cached_books[book]:
+                continue
+
+            matched = False
+            if self.cached_books[book]['uuid'] == metadata.uuid:
+                matched = True
+                self._log_location("'%s' matched on uuid '%s'" % (metadata.title, metadata.uuid))
+            elif (self.cached_books[book]['title'] == metadata.title and
+                  self.cached_books[book]['authors'] == metadata.authors):
                 matched = True
                 self._log_location("'%s' matched on author '%s'" % (metadata.title, metadata.authors))
             if matched:
@@ -2194,7 +2545,8 @@ if True:
         self._log_location("total_sent: %d" % total_sent)
 
         title = "Send to device"
-        total_added = (total_sent - len(self.malformed_books) - len(self.skipped_books) -
+        total_added = (total_sent - len(self.failed_books) -
+                       len(self.malformed_books) - len(self.skipped_books) -
                        len(self.replaced_books) - len(self.metadata_updates) -
                        len(self.rejected_books))
         details = ''
@@ -2202,10 +2554,17 @@ if True:
             details = "{0:,} {1} successfully added to Marvin.\n\n".format(
                 total_added, 'books' if total_added > 1 else 'book')
 
-        if self.malformed_books or self.rejected_books:
+        if self.failed_books or self.malformed_books or self.rejected_books:
             msg = ("Warnings reported while sending to Marvin.\n" +
                             "Click 'Show details' for a summary.\n")
 
+            if self.failed_books:
+                details += u"The following {0} not be copied to the device:\n".format(
+                            'books could' if len(self.failed_books) > 1 else 'book could')
+                for book in self.failed_books:
+                    details += u" - '{0}' by {1}\n".format(book['title'],
+                                                          ', '.join(book['authors']))
+
             if self.malformed_books:
                 details += u"The following malformed {0} not added to Marvin:\n".format(
                             'books were' if len(self.malformed_books) > 1 else 'book was')
@@ -2303,11 +2662,18 @@ if True:
 
             self._log_location(connection_state)
 
+        # Mounted containers belong to the previous device
+        if self.ios_connection['udid'] and self.ios_connection['udid'] != udid:
+            self.afc_sessions.close_all()
+
         self.ios_connection['app_installed'] = app_installed
         self.ios_connection['connected'] = False
         self.ios_connection['device_name'] = device_name
         self.ios_connection['udid'] = udid
 
+        # Force a fresh read of connected.xml
+        self.connected_probe = {'checked': 0.0, 'connection': None, 'stat_key': None}
+
     def _restore_from_snapshot(self):
         '''
         Try to restore booklist.db from last session.
@@ -2663,7 +3029,7 @@ if True:
                     d_tag.insert(0, "(description removed for debug stream)")
                     description.replaceWith(d_tag)
                 # <covers>
-                covers = soup.findAll('cover')
+                covers = soup.findAll('cover', encoding='base64')
                 for cover in covers:
                     cover_tag = Tag(soup, 'cover')
                     cover_tag['encoding'] = cover['encoding']
@@ -2678,6 +3044,14 @@ if True:
         if self.ios.exists(self.status_fs, silent=True):
             self.ios.remove(self.status_fs)
 
+        # Copy cover files referenced by the manifest before the command is visible
+        for cover in command_soup.findAll('cover', encoding='file'):
+            cover_filename = cover['filename']
+            if cover_filename in self.pending_covers:
+                self.ios.copy_to_idevice(str(self.pending_covers[cover_filename]),
+                    b'/'.join([self.staging_folder, str(cover_filename)]))
+        self.pending_covers = {}
+
         tmp = b'/'.join([self.staging_folder, b'%s.tmp' % command_name])
         final = b'/'.join([self.staging_folder, b'%s.xml' % command_name])
 
@@ -2688,6 +3062,29 @@ if True:
 
         self.ios.rename(tmp, final)
 
+    def _start_presence_monitor(self):
+        '''
+        Start DevicePresenceMonitor if it is not already running
+        '''
+        if self.presence_monitor is None:
+            self._log_location()
+            monitor = DevicePresenceMonitor(self, self._presence_snapshot,
+                interval=self.prefs.get('presence_monitor_interval', 1.0))
+            # Seed with the state can_handle() just probed
+            monitor.refresh()
+            self.presence_monitor = monitor
+            monitor.start()
+
+    def _stop_presence_monitor(self):
+        '''
+        Stop DevicePresenceMonitor. Called on eject, or when the device goes away
+        '''
+        monitor = self.presence_monitor
+        if monitor is not None:
+            self._log_location()
+            self.presence_monitor = None
+            monitor.stop()
+
     def _update_epub_metadata(self, fpath, metadata):
         '''
         Apply plugboard metadata transforms to book
@@ -2757,6 +3154,15 @@ if True:
 
         return metadata_x
 
+    def _use_cover_files(self):
+        '''
+        Covers are staged as separate files only if the connected Marvin lists
+        the capability in connected.xml <connection capabilities="...">, unless
+        disabled in prefs. Otherwise covers are sent inline as base64
+        '''
+        return (self.prefs.get('marvin_cover_files', True) and
+                self.COVER_FILES_CAPABILITY in self.marvin_capabilities)
+
     def _validate_dehydrated_booklist(self, booklist, dehydrated):
         '''
         Sanity test to confirm stored version of booklist is legit
@@ -2787,137 +3193,51 @@ if True:
         Wait for Marvin to issue progress reports via status.xml
         Marvin creates status.xml upon receiving command, increments <progress>
         from 0.0 to 1.0 as command progresses.
+        Blocking wrapper around _monitor_command() for driver-initiated commands.
         '''
-        import traceback
-        from threading import Timer
+        POLLING_DELAY = 0.10
 
         self._log_location(command_name)
-        self._log("%s: waiting for '%s'" %
-                                     (datetime.now().strftime('%H:%M:%S.%f'),
-                                     self.status_fs))
-
-        # Set initial watchdog timer for ACK
-        WATCHDOG_TIMEOUT = 15.0
-        POLLING_DELAY = 1.0
-        watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out)
-        self.operation_timed_out = False
-        watchdog.start()
-
-        while True:
-            if not self.ios.exists(self.status_fs, silent=True):
-                # status.xml not created yet
-                if self.operation_timed_out:
-                    self.ios.remove(self.status_fs)
-                    raise UserFeedback("Marvin operation timed out.",
-                                        details=None, level=UserFeedback.WARN)
-                time.sleep(POLLING_DELAY)
-                Application.processEvents()
-
-            else:
-                watchdog.cancel()
-
-                self._log("%s: monitoring progress of %s" %
-                                     (datetime.now().strftime('%H:%M:%S.%f'),
-                                      command_name))
-
-                # Start a new watchdog timer per iteration
-                watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out)
-                self.operation_timed_out = False
-                watchdog.start()
-
-                code = '-1'
-                current_timestamp = 0.0
-                while code == '-1':
-                    try:
-                        if self.operation_timed_out:
-                            self.ios.remove(self.status_fs)
-                            raise UserFeedback("Marvin operation timed out.",
-                                                details=None, level=UserFeedback.WARN)
-
-                        status = etree.fromstring(self.ios.read(self.status_fs))
-                        code = status.get('code')
-                        timestamp = float(status.get('timestamp'))
-                        if timestamp != current_timestamp:
-                            watchdog.cancel()
-                            current_timestamp = timestamp
-                            d = datetime.now()
-                            progress = float(status.find('progress').text)
-                            self._log("{0}: {1:>2} {2:>3}%".format(
-                                                 d.strftime('%H:%M:%S.%f'),
-                                                 code,
-                                                 "%3.0f" % (progress * 100)))
-
-                            # Report progress
-                            if command_complete and self.report_progress is not None:
-                                self.report_progress(0.5 + progress/2, '')
-
-                            # Reset watchdog timer
-                            watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out)
-                            watchdog.start()
-                        time.sleep(POLLING_DELAY)
-                        Application.processEvents()
 
-                    except:
-                        watchdog.cancel()
+        future = self._monitor_command(command_name,
+            send_signal=send_signal and command_complete)
 
-                        formatted_lines = traceback.format_exc().splitlines()
-                        current_error = formatted_lines[-1]
-
-                        time.sleep(POLLING_DELAY)
-                        Application.processEvents()
-
-                        self._log("{0}:  retry ({1})".format(
-                            datetime.now().strftime('%H:%M:%S.%f'),
-                            current_error))
-
-                        # Reset watchdog timer
-                        watchdog = Timer(WATCHDOG_TIMEOUT, self._watchdog_timed_out)
-                        watchdog.start()
-
-                # Command completed
-                watchdog.cancel()
-
-                final_code = status.get('code')
-                final_status = None
-                if final_code != '0':
-                    if final_code == '-1':
-                        final_status= "in progress"
-                    if final_code == '1':
-                        final_status = "warnings"
-                    if final_code == '2':
-                        final_status = "errors"
-
-                    messages = status.find('messages')
-                    msgs = [msg.text for msg in messages]
-
-                    # Capture the rejected epubs to report
-                    for msg in msgs:
-                        self.rejected_books.append(re.search('\[(.+)\]', msg).group(1))
+        reported_progress = None
+        while not future.wait(POLLING_DELAY):
+            # Report progress
+            if (command_complete and self.report_progress is not None and
+                    future.progress != reported_progress):
+                reported_progress = future.progress
+                self.report_progress(0.5 + reported_progress/2, '')
+            Application.processEvents()
 
-                    details = "code: %s\n" % final_code
-                    details += '\n'.join(msgs)
-                    self._log(details)
+        # Re-raise UserFeedback from the monitor
+        future.result()
 
-                self.ios.remove(self.status_fs)
+        if command_complete and self.report_progress is not None:
+            self.report_progress(1.0, _('finished'))
 
-                self._log("%s: '%s' complete" %
-                          (datetime.now().strftime('%H:%M:%S.%f'),
-                           command_name))
-                break
+    def _wait_for_event(self, event, description, timeout):
+        '''
+        Wait up to timeout seconds for event, processing GUI events while waiting.
+        Return True if event was set, False (logged) on timeout
+        '''
+        POLLING_DELAY = 0.10
 
-        if command_complete:
-            if self.report_progress is not None:
-                self.report_progress(1.0, _('finished'))
-            if send_signal:
-                # Emit a signal for Marvin Manager
-                self.marvin_device_signals.reader_app_status_changed.emit({'cmd':command_name})
+        start_time = time.time()
+        while not event.wait(POLLING_DELAY):
+            Application.processEvents()
+            if time.time() - start_time > timeout:
+                self._log("timed out after %.0fs waiting for %s" % (timeout, description))
+                return False
+        return True
 
-    def _watchdog_timed_out(self):
+    def _watchdog_timed_out(self, future):
         '''
-        Set flag if I/O operation times out
+        Flag future if its command times out
         '''
         self._log_location(datetime.now().strftime('%H:%M:%S.%f'))
-        self.operation_timed_out = True
+        future.timed_out = True
 
     def _xform_metadata_via_plugboard(self, book, format):
         '''